@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+'''
+Compares attaching an AllContentNotificationAdapter, which visits every
+object of the tree, with adding a content adapter to the root, and the
+cost of a write deep in the tree under each.
+
+Run from the top of the source tree:
+
+    python benchmarks/content.py
+'''
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pmf.core import MObject
+from pmf.adapters import NotificationAdapter, AllContentNotificationAdapter
+
+class PurchaseOrder(MObject):
+    mContainment = frozenset(['items'])
+
+    def __init__(self):
+        MObject.__init__(self)
+        self.items = []
+
+class Item(MObject):
+    def __init__(self):
+        MObject.__init__(self)
+        self.upc = None
+        self.tags = {}
+
+def build(orders, items):
+    root = PurchaseOrder()
+    for i in xrange(orders):
+        po = PurchaseOrder()
+        for j in xrange(items):
+            po.items.append(Item())
+        root.items.append(po)
+    return root
+
+def timed(label, function, count=1):
+    start = time.time()
+    for i in xrange(count):
+        function()
+    elapsed = (time.time() - start) / count
+    print "%-32s %10.1f us" % (label, elapsed * 1e6)
+
+if __name__ == "__main__":
+    root = build(1000, 100)
+    leaf = root.items[-1].items[-1]
+    print "%d objects" % (1 + sum(1 for o in root.mAllContents()))
+
+    def write():
+        leaf.upc = "0123-4567"
+
+    adapter = AllContentNotificationAdapter(callback=lambda n: None)
+    timed("attach AllContent", lambda: root.mAddAdapter(adapter))
+    timed("write under AllContent", write, 10000)
+    root.mRemoveAdapter(adapter)
+
+    adapter = NotificationAdapter(callback=lambda n: None)
+    timed("add content adapter", lambda: root.mAddContentAdapter(adapter))
+    timed("write under content adapter", write, 10000)
+    root.mRemoveContentAdapter(adapter)
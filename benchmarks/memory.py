@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+'''
+Measures the memory used per MObject in a model of 1M objects.
+
+Each layout is measured in a fresh interpreter.  tracemalloc is used
+where the interpreter provides it; otherwise the growth of the resident
+set is measured instead.
+
+Run from the top of the source tree:
+
+    python benchmarks/memory.py [count]
+'''
+import gc
+import os
+import subprocess
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pmf.core import MObject, Feature
+
+class Item(MObject):
+    def __init__(self):
+        MObject.__init__(self)
+        self.upc = None
+
+class EagerItem(Item):
+    '''
+    Allocates the per-instance state that MObject used to allocate
+    eagerly, for comparison.
+    '''
+    def __init__(self):
+        Item.__init__(self)
+        self._mDeliver = True
+        self._mContainer = None
+        self._mAdapters = []
+        self._mContainment = frozenset(getattr(type(self), "mContainment", ()))
+
+class DeclaredItem(MObject):
+    upc = Feature()
+
+LAYOUTS = [
+           ("eager state (previous)", EagerItem),
+           ("lazy state", Item),
+           ("declared features", DeclaredItem),
+          ]
+
+def residentBytes():
+    with open("/proc/self/statm") as statm:
+        return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+def measure(cls, count):
+    gc.collect()
+    try:
+        import tracemalloc
+    except ImportError:
+        tracemalloc = None
+    if tracemalloc is not None:
+        tracemalloc.start()
+    else:
+        before = residentBytes()
+    objects = []
+    for i in xrange(count):
+        objects.append(cls())
+    if tracemalloc is not None:
+        used = tracemalloc.get_traced_memory()[0]
+    else:
+        used = residentBytes() - before
+    # Exclude the list holding the objects
+    return (used - sys.getsizeof(objects)) / float(count)
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    if len(sys.argv) > 2:
+        print measure(dict(LAYOUTS)[sys.argv[2]], count)
+        sys.exit(0)
+    for name, cls in LAYOUTS:
+        output = subprocess.check_output([sys.executable, __file__, str(count), name])
+        print "%-24s %8.1f bytes/object" % (name, float(output))
@@ -40,6 +40,13 @@ def po_change(notification):
     '''
     print "po_change", notification
     
+def ship_to_change(notification):
+    '''
+    This callback will only get called when the ship to address of the
+    purchase order is replaced
+    '''
+    print "ship_to_change", notification
+
 def all_mo_change(notification):
     '''
     This callback will get called for changes anywhere in
@@ -61,6 +68,9 @@ if __name__ == "__main__":
     # Attach an notification listener that will listen to all
     # content of the PurchaseOrder
     po.mAddAdapter(NotificationAdapter(callback=po_change))
+    # Attach a notification listener for a single feature
+    po.mAddAdapter(NotificationAdapter(callback=ship_to_change),
+                   features=["PurchaseOrder.shipTo"])
     po.mAddAdapter(AllContentNotificationAdapter(callback=all_mo_change))
     
     addr = Address()
@@ -78,4 +88,6 @@ if __name__ == "__main__":
     
     # Should trigger an all_mo_change callback
     item.upc = "1111-1111"
+    # The address is referenced, not contained, so this is not part
+    # of the purchase order's content and won't trigger all_mo_change
     addr.name = "Joe Smith"
@@ -1,3 +1,10 @@
 #!/usr/bin/env python
 import core
 import adapters
+import domain
+import query
+import derived
+import resources
+import binary
+import journal
+import store
@@ -1,21 +1,42 @@
+import collections
+import contextlib
+import weakref
+
+import core
 from core import *
 
 class NotificationAdapter(object):
     """
     An adapter that binds a callback to
     object notifications. 
+
+    Notifications delivered as a group arrive through notifyMany.
+
+    The event types of interest may be given as an iterable of event types
+    (or their names) or as an integer mask, and are held as eventMask so
+    that MObject.mNotify can skip uninterested adapters with a single AND.
     """
     __slots__ = [
                  "callback",
-                 "eventTypes",
+                 "eventMask",
                  "target",
                  "__target",
                 ]
 
     def __init__(self, callback=None, eventTypes=Notification.EventTypes):
         self.callback = callback
-        self.eventTypes = eventTypes
         self.__target = None
+        self.eventTypes = eventTypes
+
+    def setEventTypes(self, eventTypes):
+        self.eventMask = eventMask(eventTypes)
+        # Only the objects an adapter is attached to have indexed it
+        if self.target is not None:
+            invalidateAdapterIndex()
+
+    def getEventTypes(self):
+        return frozenset(t for t in Notification.EventTypes if t.mask & self.eventMask)
+    eventTypes = property(fset=setEventTypes, fget=getEventTypes)
 
     def setTarget(self, target):
         self.__target = target
@@ -25,10 +46,21 @@ class NotificationAdapter(object):
     target = property(fset=setTarget, fget=getTarget)
 
     def notify(self, notification):
-        if notification.eventType not in self.eventTypes:
+        if not (notification.eventType.mask & self.eventMask):
             return # We aren't interested in this type of event
         self.callback(notification)
 
+    def notifyMany(self, notifications):
+        """
+        Called with a sequence of notifications when they are delivered
+        together: at the end of a Batch, or of an undo, redo or rollback
+        of a ChangeRecorder.  Adapters that can
+        handle a group of changes at once (a single write to disk, say)
+        should override this; by default each is passed to notify.
+        """
+        for notification in notifications:
+            self.notify(notification)
+
 
 
 
@@ -37,38 +69,849 @@ class AllContentNotificationAdapter(NotificationAdapter):
     An adapter that binds a callback to
     object notifications for the object and
     all decendants of the object. 
+
+    The decendants are those reached through containment features, and
+    the MLists and MDicts they own.  Only the content actually added or
+    removed through a containment feature is walked when it changes.
+
+    Every notification is needed to follow changes to the content, so the
+    event types only restrict which notifications reach the callback.
+
+    This adapter is attached to every object of the tree.  For large trees
+    prefer adding a NotificationAdapter to the root with
+    MObject.mAddContentAdapter, which is O(1) and uses no memory in the
+    contained objects.
     """
+    def setEventTypes(self, eventTypes):
+        self.contentMask = eventMask(eventTypes)
+        self.eventMask = ALL_EVENTS
+
+    def getEventTypes(self):
+        return frozenset(t for t in Notification.EventTypes if t.mask & self.contentMask)
+    eventTypes = property(fset=setEventTypes, fget=getEventTypes)
+
     def setTarget(self, target):
         if self.target != None:
-            self.__recursiveRemoveAdapter(self.target)
+            self.__removeContent(self.target)
         super(AllContentNotificationAdapter, self).setTarget(target)
-        self.__recursiveAddAdapter(target)
+        if target != None:
+            self.__addContent(target)
     target = property(fset=setTarget, fget=NotificationAdapter.getTarget)
 
-    def __recursiveAddAdapter(self, obj):
-        if isinstance(obj, MObject):
+    def __addContent(self, value):
+        for obj in _contentTree(value):
             obj.mAddAdapter(self)
-            for k in dir(obj):
-                if k.startswith("_") or callable(k): continue
-                attr = getattr(obj, k)
-                self.__recursiveAddAdapter(attr)
 
-    def __recursiveRemoveAdapter(self, obj):           
-        if isinstance(obj, MObject):
+    def __removeContent(self, value):
+        for obj in _contentTree(value):
             obj.mRemoveAdapter(self)
-            for k in dir(obj):
-                attr = getattr(obj, k)
-                self.__recursiveRemoveAdapter(attr)
 
     def notify(self, notification):
-        self.callback(notification)
-        if notification.newValue != None:
-            try:
-                for nv in notification.newValue:  self.__recursiveAddAdapter(nv)
-            except TypeError:
-                self.__recursiveAddAdapter(notification.newValue)
-        if notification.oldValue != None:
-            try:
-                for nv in notification.oldValue:  self.__recursiveRemoveAdapter(nv)
-            except TypeError:
-                self.__recursiveRemoveAdapter(notification.newValue)
\ No newline at end of file
+        if notification.eventType.mask & self.contentMask:
+            self.callback(notification)
+        notifier = notification.notifier
+        if isinstance(notifier, (MList, MDict)):
+            # Moves leave the content unchanged
+            if notifier._containment and notification.eventType is not MOVE_MANY:
+                for value in _changedValues(notification, notification.oldValue):
+                    self.__removeContent(value)
+                for value in _changedValues(notification, notification.newValue):
+                    self.__addContent(value)
+        elif notification.eventType == SET and notification.feature:
+            # Owned collections are part of the content, other objects
+            # only when they are held by a containment feature
+            key = notification.feature.rpartition(".")[2]
+            containment = key in notifier._mContainment
+            if containment or isinstance(notification.oldValue, (MList, MDict)):
+                self.__removeContent(notification.oldValue)
+            if containment or isinstance(notification.newValue, (MList, MDict)):
+                self.__addContent(notification.newValue)
+
+
+
+
+def _contentTree(value):
+    """
+    Yields value, if it is a MObject, everything it contains and every
+    MList and MDict owned by any of them.
+    """
+    if not isinstance(value, MObject):
+        return
+    yield value
+    objects = [value]
+    objects.extend(value.mAllContents())
+    for obj in objects:
+        if isinstance(obj, (MList, MDict)):
+            continue
+        for key in obj.mFeatureNames():
+            attr = getattr(obj, key, None)
+            if isinstance(attr, (MList, MDict)):
+                yield attr
+        if obj is not value:
+            yield obj
+
+def _changedValues(notification, value):
+    """
+    Returns the elements added or removed by a MList or MDict notification,
+    given its newValue or oldValue.
+    """
+    if value is None:
+        return ()
+    if notification.eventType in (ADD_MANY, REMOVE_MANY, SET_MANY):
+        if isinstance(notification.notifier, MDict):
+            return [v for k, v in value]
+        return value
+    return (value,)
+
+def _contentChanges(notification):
+    """
+    Returns the values removed from and added to the content of an object
+    by a notification, as two sequences, or None if its content did not
+    change.  The MLists and MDicts owned by an object are part of its
+    content.
+    """
+    notifier = notification.notifier
+    eventType = notification.eventType
+    if isinstance(notifier, (MList, MDict)):
+        if notifier._containment and eventType is not MOVE_MANY:
+            return (_changedValues(notification, notification.oldValue),
+                    _changedValues(notification, notification.newValue))
+    elif eventType == SET and notification.feature:
+        oldValue = notification.oldValue
+        newValue = notification.newValue
+        if (notification.feature.rpartition(".")[2] in notifier._mContainment or
+            isinstance(oldValue, (MList, MDict)) or
+            isinstance(newValue, (MList, MDict))):
+            return (oldValue,), (newValue,)
+    return None
+
+def _isContained(obj, root):
+    """
+    Returns True if obj is root or is contained by root, following the
+    container chain of obj.
+    """
+    while obj is not None:
+        if obj is root:
+            return True
+        obj = obj._mContainer
+    return False
+
+
+
+
+class CrossReferenceAdapter(NotificationAdapter):
+    """
+    An adapter that indexes the references between the objects contained
+    by its target, from each referenced object to the (source, feature)
+    pairs that refer to it.  It is added as a content adapter:
+
+        xref = CrossReferenceAdapter()
+        po.mAddContentAdapter(xref)
+        xref.getInverseReferences(address)  # [(po, "PurchaseOrder.shipTo")]
+        xref.delete(address)
+
+    References are the MObjects held by features that are not containment
+    features, including the elements of MLists and MDicts that are not
+    containment collections.  The index is built once when the adapter is
+    added and then kept up to date from the notifications of the content,
+    only walking content that is added or removed.
+    """
+    def __init__(self):
+        NotificationAdapter.__init__(self)
+        self._inverse = {}
+
+    def setTarget(self, target):
+        if self.target != None:
+            self._inverse.clear()
+        super(CrossReferenceAdapter, self).setTarget(target)
+        if target != None:
+            self._addContent(target)
+    target = property(fset=setTarget, fget=NotificationAdapter.getTarget)
+
+    def getInverseReferences(self, target):
+        """
+        Returns the (source, feature) pairs of the content that refer to
+        target, where feature is named as in Notification.feature.
+        """
+        return self._inverse.get(target, {}).keys()
+
+    def delete(self, obj):
+        """
+        Removes obj from its container, and removes every indexed reference
+        to obj and to the objects it contains.  The work done is in
+        proportion to the number of referrers, not to the size of the
+        model.
+        """
+        for target in [obj] + list(obj.mAllContents()):
+            for source, feature in self.getInverseReferences(target):
+                _unset(source, feature.rpartition(".")[2], target)
+        container = obj._mContainer
+        if container is not None:
+            for key in container._mContainment:
+                _unset(container, key, obj)
+
+    def notify(self, notification):
+        eventType = notification.eventType
+        if eventType is MOVE_MANY:
+            return
+        notifier = notification.notifier
+        oldValue = notification.oldValue
+        newValue = notification.newValue
+        if isinstance(notifier, (MList, MDict)):
+            if notifier._containment:
+                for value in _changedValues(notification, oldValue):
+                    self._removeContent(value)
+                for value in _changedValues(notification, newValue):
+                    self._addContent(value)
+            else:
+                source = (notifier._container, notifier._feature)
+                for value in _changedValues(notification, oldValue):
+                    self._count(value, source, -1)
+                for value in _changedValues(notification, newValue):
+                    self._count(value, source, 1)
+        elif eventType == SET and notification.feature:
+            key = notification.feature.rpartition(".")[2]
+            if (key in notifier._mContainment or
+                isinstance(oldValue, (MList, MDict)) or
+                isinstance(newValue, (MList, MDict))):
+                self._removeContent(oldValue)
+                self._addContent(newValue)
+            else:
+                source = (notifier, notification.feature)
+                self._count(oldValue, source, -1)
+                self._count(newValue, source, 1)
+
+    def _addContent(self, value):
+        for obj in _contentTree(value):
+            self._index(obj, 1)
+
+    def _removeContent(self, value):
+        for obj in _contentTree(value):
+            self._index(obj, -1)
+
+    def _index(self, obj, delta):
+        """
+        Adds (delta 1) or removes (delta -1) the references held by obj.
+        """
+        if isinstance(obj, (MList, MDict)):
+            if not obj._containment:
+                source = (obj._container, obj._feature)
+                for value in (obj.itervalues() if isinstance(obj, MDict) else obj):
+                    self._count(value, source, delta)
+            return
+        prefix = type(obj).__name__ + "."
+        for key in obj.mFeatureNames():
+            if key not in obj._mContainment:
+                self._count(getattr(obj, key, None), (obj, prefix + key), delta)
+
+    def _count(self, value, source, delta):
+        if not isinstance(value, MObject) or isinstance(value, (MList, MDict)):
+            return
+        sources = self._inverse.get(value)
+        if sources is None:
+            sources = self._inverse[value] = {}
+        count = sources.get(source, 0) + delta
+        if count > 0:
+            sources[source] = count
+        else:
+            sources.pop(source, None)
+            if not sources:
+                del self._inverse[value]
+
+def _unset(source, key, value):
+    """
+    Removes every occurrence of value from the feature key of source.
+    """
+    current = getattr(source, key, None)
+    if current is value:
+        setattr(source, key, None)
+    elif isinstance(current, MList):
+        position = current._mIndexOf(value)
+        while position >= 0:
+            del current[position]
+            position = current._mIndexOf(value)
+    elif isinstance(current, MDict):
+        for k in [k for k, v in current.iteritems() if v is value]:
+            del current[k]
+
+
+
+class ListIndex(NotificationAdapter):
+    """
+    An adapter that indexes the MObjects of a MList by the value of one of
+    their features, or by the tuple of values of several, for O(1) exact
+    lookup:
+
+        byUpc = ListIndex("upc", unique=True)
+        po.items.mAddAdapter(byUpc)
+        item = byUpc.get("0123-4567")
+
+    The index follows the ADD and REMOVE notifications of the list, and is
+    added to each element to follow the SETs of the indexed features.
+    Elements whose key is None are not indexed, and keys must be hashable.
+
+    If unique is True, a change that would give two elements the same key
+    is rejected with ValueError before it is made.  The index is notified
+    of each change as it is made, even inside a Batch, so that it is
+    current when the next change is checked.
+    """
+    mFirst = True
+
+    def __init__(self, features, unique=False):
+        NotificationAdapter.__init__(self)
+        if isinstance(features, basestring):
+            features = (features,)
+        self.features = tuple(features)
+        self.unique = unique
+        self._entries = {}
+        # Maps the id of each element to [element, key, occurrences]
+        self._members = {}
+
+    def setTarget(self, target):
+        if self.target is not None:
+            for obj, key, count in self._members.values():
+                obj.mRemoveAdapter(self)
+            self._entries.clear()
+            self._members.clear()
+        super(ListIndex, self).setTarget(target)
+        if target is not None:
+            for obj in target:
+                if not self._add(obj):
+                    self._duplicate(self._keyOf(obj))
+    target = property(fset=setTarget, fget=NotificationAdapter.getTarget)
+
+    def get(self, key, default=None):
+        """
+        Returns the element with the given key, or the first of them if
+        the index is not unique.
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            return default
+        return entry if self.unique else entry[0]
+
+    def lookup(self, key):
+        """
+        Returns the list of elements with the given key.
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            return []
+        return [entry] if self.unique else list(entry)
+
+    def keys(self):
+        return self._entries.keys()
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def validate(self, notification):
+        if not self.unique:
+            return
+        eventType = notification.eventType
+        notifier = notification.notifier
+        if notifier is not self.target:
+            if eventType == SET:
+                self._checkSet(notifier, notification)
+            return
+        if eventType is MOVE_MANY:
+            return
+        # Elements removed by the change, by id, with how often they go
+        removed = {}
+        for value in _changedValues(notification, notification.oldValue):
+            if id(value) in self._members:
+                removed[id(value)] = removed.get(id(value), 0) + 1
+        freed = set(self._members[i][1] for i, count in removed.iteritems()
+                    if count == self._members[i][2])
+        added = set()
+        taken = set()
+        for value in _changedValues(notification, notification.newValue):
+            if not isinstance(value, MObject) or id(value) in added:
+                continue
+            added.add(id(value))
+            member = self._members.get(id(value))
+            if member is not None and removed.get(id(value), 0) < member[2]:
+                continue # Stays in the list
+            key = self._keyOf(value)
+            if key is None:
+                continue
+            if key in taken or (key in self._entries and key not in freed):
+                self._duplicate(key)
+            taken.add(key)
+
+    def _checkSet(self, obj, notification):
+        """
+        Rejects the SET of an indexed feature of an element that would give
+        it the key of another.
+        """
+        member = self._members.get(id(obj))
+        if member is None:
+            return
+        name = notification.feature.rpartition(".")[2]
+        values = tuple(notification.newValue if f == name else getattr(obj, f, None)
+                       for f in self.features)
+        key = values[0] if len(values) == 1 else values
+        if key is not None and key != member[1] and key in self._entries:
+            self._duplicate(key)
+
+    def _duplicate(self, key):
+        raise ValueError("duplicate key %r in %s" % (key, self.target._feature))
+
+    def notify(self, notification):
+        eventType = notification.eventType
+        notifier = notification.notifier
+        if notifier is not self.target:
+            if eventType == SET:
+                self._rekey(notifier)
+            return
+        if eventType is MOVE_MANY:
+            return
+        for value in _changedValues(notification, notification.oldValue):
+            self._remove(value)
+        for value in _changedValues(notification, notification.newValue):
+            self._add(value)
+
+    def _keyOf(self, obj):
+        if len(self.features) == 1:
+            return getattr(obj, self.features[0], None)
+        return tuple(getattr(obj, f, None) for f in self.features)
+
+    def _add(self, obj):
+        """
+        Indexes an element added to the list.  Returns False, leaving it
+        out of the index, if its key is taken.
+        """
+        if not isinstance(obj, MObject):
+            return True
+        member = self._members.get(id(obj))
+        if member is not None:
+            member[2] += 1
+            return True
+        key = self._keyOf(obj)
+        if self.unique and key is not None and key in self._entries:
+            return False
+        self._members[id(obj)] = [obj, key, 1]
+        self._enter(key, obj)
+        prefix = type(obj).__name__ + "."
+        obj.mAddAdapter(self, features=[prefix + f for f in self.features])
+        return True
+
+    def _remove(self, obj):
+        member = self._members.get(id(obj))
+        if member is None:
+            return
+        member[2] -= 1
+        if not member[2]:
+            del self._members[id(obj)]
+            self._leave(member[1], obj)
+            obj.mRemoveAdapter(self)
+
+    def _rekey(self, obj):
+        """
+        Moves an element whose indexed features changed to its new key.
+        Returns False, leaving it under its old key, if the key is taken.
+        """
+        member = self._members.get(id(obj))
+        if member is None:
+            return True
+        key = self._keyOf(obj)
+        if key == member[1]:
+            return True
+        if self.unique and key is not None and key in self._entries:
+            return False
+        self._leave(member[1], obj)
+        member[1] = key
+        self._enter(key, obj)
+        return True
+
+    def _enter(self, key, obj):
+        if key is None:
+            return
+        if self.unique:
+            self._entries[key] = obj
+        else:
+            self._entries.setdefault(key, []).append(obj)
+
+    def _leave(self, key, obj):
+        if key is None:
+            return
+        if self.unique:
+            if self._entries.get(key) is obj:
+                del self._entries[key]
+            return
+        entry = self._entries.get(key, ())
+        for position, element in enumerate(entry):
+            if element is obj:
+                del entry[position]
+                break
+        if not entry:
+            self._entries.pop(key, None)
+
+
+
+class InstanceRegistry(NotificationAdapter):
+    """
+    An adapter that keeps track of the MObjects of each class contained by
+    its target, so that they can be found without walking the tree.  It is
+    added as a content adapter:
+
+        registry = InstanceRegistry()
+        po.mAddContentAdapter(registry)
+        registry.allInstances(Item)
+
+    The tree is walked once when the registry is added.  After that only
+    content added or removed through containment features is walked, and
+    removed content is only dropped once its container chain no longer
+    leads to the target.  Objects are held by weak references, so the
+    registry never keeps an object alive.
+    """
+    def __init__(self):
+        NotificationAdapter.__init__(self)
+        self._byClass = {}
+
+    def setTarget(self, target):
+        self._byClass.clear()
+        super(InstanceRegistry, self).setTarget(target)
+        if target is not None:
+            self._register(target)
+    target = property(fset=setTarget, fget=NotificationAdapter.getTarget)
+
+    def allInstances(self, cls):
+        """
+        Returns the contained instances of cls, including instances of its
+        subclasses.
+        """
+        instances = []
+        for k, objects in self._byClass.items():
+            if issubclass(k, cls):
+                instances.extend(objects)
+        return instances
+
+    def notify(self, notification):
+        changes = _contentChanges(notification)
+        if changes is not None:
+            removed, added = changes
+            for value in removed:
+                self._unregister(value)
+            for value in added:
+                self._register(value)
+
+    def _register(self, value):
+        for obj in _contentTree(value):
+            if not isinstance(obj, (MList, MDict)):
+                objects = self._byClass.get(type(obj))
+                if objects is None:
+                    objects = self._byClass[type(obj)] = weakref.WeakSet()
+                objects.add(obj)
+
+    def _unregister(self, value):
+        if not isinstance(value, MObject) or _isContained(value, self.target):
+            return
+        for obj in _contentTree(value):
+            if not isinstance(obj, (MList, MDict)):
+                objects = self._byClass.get(type(obj))
+                if objects is not None:
+                    objects.discard(obj)
+
+
+
+class ChangeRecorder(NotificationAdapter):
+    """
+    An adapter that records the changes made to a model and can undo and
+    redo them.  It is normally added as a content adapter of the root of
+    the model, so that it records the changes of all of its content:
+
+        recorder = ChangeRecorder()
+        po.mAddContentAdapter(recorder)
+        po.shipTo = addr
+        with recorder.compound("Add items"):
+            po.items.append(item1)
+            po.items.append(item2)
+        recorder.undo()     # removes both items
+        recorder.undo()     # restores the previous shipTo
+        recorder.redo()
+
+    Each change is kept as a small tuple built from the fields of its
+    Notification, and is undone by applying its inverse, so the model is
+    never copied.  Changes made outside a compound are commands of their
+    own, together with the changes made to keep their opposites in sync.
+    Notifications delivered by a Batch are commands of their own unless
+    they are recorded within a compound.
+
+    If maxChanges is given, the oldest commands are discarded when more
+    changes than that are retained, counting each element of a _MANY
+    change.  Undoing and redoing are applied immediately even while a
+    Batch is active, and the changes they make are delivered to the other
+    adapters together, as a Batch delivers them, once all are applied.
+    """
+    def __init__(self, maxChanges=None):
+        NotificationAdapter.__init__(self)
+        self.maxChanges = maxChanges
+        self._undo = collections.deque()
+        self._redo = []
+        self._size = 0
+        self._compound = None
+        self._depth = 0
+        self._replaying = False
+        # Collects the changes of the next command outside a compound
+        self._pending = _Command(None, [], 0)
+
+    def notify(self, notification):
+        if self._replaying:
+            return
+        change = _change(notification)
+        weight = _weight(change)
+        command = self._compound or self._pending
+        command.changes.append(change)
+        command.weight += weight
+        self._size += weight
+        if command is self._pending and not core._opposites.depth:
+            self._undo.append(command)
+            self._pending = _Command(None, [], 0)
+        for command in self._redo:
+            self._size -= command.weight
+        del self._redo[:]
+        self._trim()
+
+    def _trim(self):
+        if self.maxChanges is None:
+            return
+        while (self._size > self.maxChanges and self._undo and
+               self._undo[0] is not self._compound):
+            self._size -= self._undo.popleft().weight
+
+    def beginCompound(self, label=None):
+        """
+        Starts a compound command: the changes recorded until the matching
+        endCompound are undone and redone together.  Compounds nest; inner
+        compounds join the outermost one.
+        """
+        self._depth += 1
+        if self._depth == 1:
+            self._compound = _Command(label, [], 0)
+            self._undo.append(self._compound)
+
+    def endCompound(self):
+        """
+        Ends the compound command started by beginCompound.
+        """
+        self._depth -= 1
+        if self._depth == 0:
+            if not self._compound.changes:
+                self._undo.remove(self._compound)
+            self._compound = None
+            self._trim()
+
+    @contextlib.contextmanager
+    def compound(self, label=None):
+        """
+        Returns a context manager that records the changes made within it
+        as one compound command.
+        """
+        self.beginCompound(label)
+        try:
+            yield self
+        finally:
+            self.endCompound()
+
+    def mark(self):
+        """
+        Returns a mark of the changes recorded so far by the open compound,
+        to be passed to rollback.
+        """
+        return len(self._compound.changes)
+
+    def rollback(self, mark=0):
+        """
+        Reverts and forgets the changes recorded by the open compound since
+        mark, or all of them.
+        """
+        changes = self._compound.changes
+        reverted = changes[mark:]
+        del changes[mark:]
+        weight = sum(_weight(change) for change in reverted)
+        self._compound.weight -= weight
+        self._size -= weight
+        self._replay(reversed(reverted), _undoChange)
+
+    def canUndo(self):
+        return bool(self._undo) and self._compound is None
+
+    def canRedo(self):
+        return bool(self._redo) and self._compound is None
+
+    def undoLabel(self):
+        """
+        Returns the label of the command that undo would revert.
+        """
+        return self._undo[-1].label if self._undo else None
+
+    def redoLabel(self):
+        """
+        Returns the label of the command that redo would reapply.
+        """
+        return self._redo[-1].label if self._redo else None
+
+    def undo(self):
+        """
+        Reverts the most recent command.
+        """
+        if not self.canUndo():
+            raise IndexError("nothing to undo")
+        command = self._undo.pop()
+        self._replay(reversed(command.changes), _undoChange)
+        self._redo.append(command)
+
+    def redo(self):
+        """
+        Reapplies the most recently undone command.
+        """
+        if not self.canRedo():
+            raise IndexError("nothing to redo")
+        command = self._redo.pop()
+        self._replay(command.changes, _redoChange)
+        self._undo.append(command)
+
+    def clear(self):
+        """
+        Discards all of the recorded history.
+        """
+        self._undo.clear()
+        del self._redo[:]
+        self._size = 0
+        self._pending = _Command(None, [], 0)
+        if self._compound is not None:
+            self._compound.changes = []
+            self._compound.weight = 0
+            self._undo.append(self._compound)
+
+    def _replay(self, changes, apply):
+        # Both sides of opposite features were recorded, so they are not
+        # synced again
+        batch, core._batching.batch = core._batching.batch, None
+        suspended, core._opposites.suspended = core._opposites.suspended, True
+        self._replaying = True
+        try:
+            with Batch():
+                for change in changes:
+                    apply(change)
+        finally:
+            self._replaying = False
+            core._opposites.suspended = suspended
+            core._batching.batch = batch
+
+
+
+
+class _Command(object):
+    """
+    A group of changes that are undone and redone together.
+    """
+    __slots__ = ("label", "changes", "weight")
+
+    def __init__(self, label, changes, weight):
+        self.label = label
+        self.changes = changes
+        self.weight = weight
+
+def _change(notification):
+    """
+    Returns the (notifier, eventType, position, oldValue, newValue, key)
+    tuple recorded for a notification.  Only SETs of MObjects have a key,
+    the name of the attribute.
+    """
+    notifier = notification.notifier
+    eventType = notification.eventType
+    oldValue = notification.oldValue
+    newValue = notification.newValue
+    key = None
+    if eventType in (ADD_MANY, REMOVE_MANY, SET_MANY, MOVE_MANY):
+        # The values may be the caller's own list
+        oldValue = tuple(oldValue or ())
+        newValue = tuple(newValue or ())
+    elif not isinstance(notifier, (MList, MDict)):
+        key = notification.feature.rpartition(".")[2]
+    return (notifier, eventType, notification.position, oldValue, newValue, key)
+
+def _weight(change):
+    if change[1] in (ADD_MANY, REMOVE_MANY, SET_MANY, MOVE_MANY):
+        return max(len(change[3]) + len(change[4]), 1)
+    return 1
+
+def _reorder(target, order, previous):
+    """
+    Puts the elements of a MList back into a previous order.
+    """
+    list.__setslice__(target, 0, len(target), order)
+    target.mNotify(MOVE_MANY, target._feature, tuple(order), tuple(previous),
+                   slice(0, len(target)-1))
+
+def _undoChange(change):
+    """
+    Applies the inverse of a recorded change.
+    """
+    target, eventType, position, oldValue, newValue, key = change
+    if isinstance(target, MList):
+        if eventType == ADD:
+            del target[position]
+        elif eventType == ADD_MANY:
+            del target[position.start:position.start + len(newValue)]
+        elif eventType == REMOVE:
+            target.insert(position, oldValue)
+        elif eventType == REMOVE_MANY:
+            target[position.start:position.start] = oldValue
+        elif eventType == SET:
+            target[position] = oldValue
+        elif eventType == SET_MANY:
+            target[position.start:position.start + len(newValue)] = oldValue
+        elif eventType == MOVE_MANY:
+            _reorder(target, oldValue, newValue)
+    elif isinstance(target, MDict):
+        if eventType == ADD:
+            del target[position]
+        elif eventType in (SET, REMOVE):
+            target[position] = oldValue
+        elif eventType == SET_MANY:
+            existed = set(k for k, v in oldValue)
+            for k, v in newValue:
+                if k not in existed:
+                    del target[k]
+            if oldValue:
+                target.update(oldValue)
+        elif eventType == REMOVE_MANY:
+            if oldValue:
+                target.update(oldValue)
+    else:
+        setattr(target, key, oldValue)
+
+def _redoChange(change):
+    """
+    Applies a recorded change again.
+    """
+    target, eventType, position, oldValue, newValue, key = change
+    if isinstance(target, MList):
+        if eventType == ADD:
+            target.insert(position, newValue)
+        elif eventType == ADD_MANY:
+            target[position.start:position.start] = newValue
+        elif eventType == REMOVE:
+            del target[position]
+        elif eventType == REMOVE_MANY:
+            del target[position.start:position.start + len(oldValue)]
+        elif eventType == SET:
+            target[position] = newValue
+        elif eventType == SET_MANY:
+            target[position.start:position.start + len(oldValue)] = newValue
+        elif eventType == MOVE_MANY:
+            _reorder(target, newValue, oldValue)
+    elif isinstance(target, MDict):
+        if eventType in (ADD, SET):
+            target[position] = newValue
+        elif eventType == REMOVE:
+            del target[position]
+        elif eventType == SET_MANY:
+            target.update(newValue)
+        elif eventType == REMOVE_MANY:
+            target.clear()
+    else:
+        setattr(target, key, newValue)
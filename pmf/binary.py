@@ -0,0 +1,322 @@
+#!/usr/bin/env python
+"""
+A compact binary format for containment trees, read lazily through mmap.
+
+    BinaryResource("orders.pmfb").save(po)
+    ...
+    po = BinaryResource("orders.pmfb").load()
+
+Loading only maps the file.  Objects are created, without calling
+__init__, when something first refers to them, and their features are only
+decoded when one of them is first read or written (see MObject.mLoad), so
+the cost of opening a model does not depend on its size and reading one
+object decodes nothing else.  Lists and dicts are built when the feature
+holding them is decoded, with the objects in them still undecoded.
+
+The file holds, after an 8 byte magic number:
+
+    records     the features of each object, in containment order
+    strings     the names of classes and features, each stored once
+    classes     the string of each class, as "module.Class"
+    index       the offset of the record of each object
+    trailer     the offsets of the three tables and the number of objects
+
+Each record gives the class of the object, the number of its container
+plus one (0 for the root) and its features, as pairs of a string and a
+tagged value.  Objects, whether contained or referred to, are stored as
+their number, and must be contained by the root.
+"""
+import mmap
+import os
+import struct
+import sys
+
+from core import *
+from core import _defer, _setattr
+from resources import _collection, _items, _put
+
+_MAGIC = "PMFB\x00\x00\x00\x01"
+_TRAILER = struct.Struct("<QQQQ")
+
+_U32 = struct.Struct("<I")
+_U64 = struct.Struct("<Q")
+_I64 = struct.Struct("<q")
+_DOUBLE = struct.Struct("<d")
+_HEAD = struct.Struct("<III")
+
+class BinaryResource(object):
+    """
+    A file holding a containment tree in the binary format.
+    """
+    def __init__(self, path, root=None):
+        self.path = path
+        self.root = root
+
+    def save(self, root=None):
+        """
+        Writes root, by default the root of the resource, to the file.  The
+        file is only replaced once the tree has been written completely,
+        so objects still being read lazily from it remain readable.
+        """
+        if root is not None:
+            self.root = root
+        temporary = self.path + ".tmp"
+        with open(temporary, "wb") as stream:
+            _Writer(self.root, stream).write()
+        os.rename(temporary, self.path)
+
+    def load(self):
+        """
+        Maps the file and returns its root, whose features, like those of
+        every object in it, are read on first use.
+        """
+        self.root = _Image(self.path).object(0)
+        return self.root
+
+
+
+
+class _Writer(object):
+    def __init__(self, root, stream):
+        self.root = root
+        self.stream = stream
+        self.position = 0
+        self.numbers = {}
+        self.strings = {}
+        self.classes = {}
+
+    def _write(self, data):
+        self.stream.write(data)
+        self.position += len(data)
+
+    def write(self):
+        objects = [self.root]
+        objects.extend(self.root.mAllContents())
+        for number, obj in enumerate(objects):
+            self.numbers[id(obj)] = number
+        self._write(_MAGIC)
+        offsets = []
+        for obj in objects:
+            offsets.append(self.position)
+            self._write(self._record(obj))
+        del objects
+        # The string table: the offset of each string, then the strings
+        stringsOffset = self.position
+        strings = sorted(self.strings, key=self.strings.get)
+        self._write(_U32.pack(len(strings)))
+        offset = self.position + 8 * len(strings)
+        for string in strings:
+            self._write(_U64.pack(offset))
+            offset += 4 + len(string)
+        for string in strings:
+            self._write(_U32.pack(len(string)) + string)
+        classesOffset = self.position
+        classes = sorted(self.classes, key=self.classes.get)
+        self._write(_U32.pack(len(classes)))
+        self._write("".join(_U32.pack(self.strings[c]) for c in classes))
+        indexOffset = self.position
+        self._write("".join(_U64.pack(o) for o in offsets))
+        self._write(_TRAILER.pack(stringsOffset, classesOffset, indexOffset, len(offsets)))
+
+    def _string(self, string):
+        if isinstance(string, unicode):
+            string = string.encode("utf-8")
+        number = self.strings.get(string)
+        if number is None:
+            number = self.strings[string] = len(self.strings)
+        return number
+
+    def _record(self, obj):
+        cls = type(obj)
+        name = cls.__module__ + "." + cls.__name__
+        classId = self.classes.get(name)
+        if classId is None:
+            classId = self.classes[name] = len(self.classes)
+            self._string(name)
+        container = obj._mContainer
+        parts = [None]
+        count = 0
+        for name, value in _items(obj):
+            parts.append(_U32.pack(self._string(name)))
+            self._encode(value, parts)
+            count += 1
+        parts[0] = _HEAD.pack(classId, 0 if container is None else
+                              self.numbers[id(container)] + 1, count)
+        return "".join(parts)
+
+    def _encode(self, value, parts):
+        if value is None:
+            parts.append("N")
+        elif value is True:
+            parts.append("T")
+        elif value is False:
+            parts.append("F")
+        elif isinstance(value, (int, long)):
+            if -1 << 63 <= value < 1 << 63:
+                parts.append("i" + _I64.pack(value))
+            else:
+                digits = str(value)
+                parts.append("I" + _U32.pack(len(digits)) + digits)
+        elif isinstance(value, float):
+            parts.append("d" + _DOUBLE.pack(value))
+        elif isinstance(value, str):
+            parts.append("b" + _U32.pack(len(value)) + value)
+        elif isinstance(value, unicode):
+            value = value.encode("utf-8")
+            parts.append("u" + _U32.pack(len(value)) + value)
+        elif isinstance(value, (list, tuple)):
+            parts.append(("t" if isinstance(value, tuple) else "l") + _U32.pack(len(value)))
+            for element in value:
+                self._encode(element, parts)
+        elif isinstance(value, dict):
+            parts.append("m" + _U32.pack(len(value)))
+            for key, element in value.iteritems():
+                self._encode(key, parts)
+                self._encode(element, parts)
+        elif isinstance(value, MObject):
+            number = self.numbers.get(id(value))
+            if number is None:
+                raise ValueError("%r is not contained by %r" % (value, self.root))
+            parts.append("o" + _U32.pack(number))
+        else:
+            raise TypeError("%r can not be saved" % (value,))
+
+
+
+
+class _Image(object):
+    """
+    A mapped file, and the objects created from it so far.
+    """
+    def __init__(self, path):
+        with open(path, "rb") as stream:
+            self.map = mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.map[:len(_MAGIC)] != _MAGIC:
+            raise ValueError("%s is not a pmf binary model" % path)
+        (self.stringsOffset, self.classesOffset,
+         self.indexOffset, self.count) = _TRAILER.unpack_from(self.map, len(self.map) - _TRAILER.size)
+        self.strings = {}
+        self.classes = {}
+        self.objects = {}
+
+    def string(self, number):
+        string = self.strings.get(number)
+        if string is None:
+            offset, = _U64.unpack_from(self.map, self.stringsOffset + 4 + 8 * number)
+            length, = _U32.unpack_from(self.map, offset)
+            string = self.strings[number] = self.map[offset + 4:offset + 4 + length]
+        return string
+
+    def cls(self, number):
+        cls = self.classes.get(number)
+        if cls is None:
+            name, = _U32.unpack_from(self.map, self.classesOffset + 4 + 4 * number)
+            module, _, name = self.string(name).rpartition(".")
+            __import__(module)
+            cls = self.classes[number] = getattr(sys.modules[module], name)
+        return cls
+
+    def offset(self, number):
+        if not 0 <= number < self.count:
+            raise ValueError("no object %d in the model" % number)
+        return _U64.unpack_from(self.map, self.indexOffset + 8 * number)[0]
+
+    def object(self, number):
+        """
+        Returns object number, creating it, and its containers, with their
+        features unread if it does not exist yet.
+        """
+        obj = self.objects.get(number)
+        if obj is None:
+            classId, container, count = _HEAD.unpack_from(self.map, self.offset(number))
+            cls = self.cls(classId)
+            obj = cls.__new__(cls)
+            MObject.__init__(obj)
+            self.objects[number] = obj
+            if container:
+                _setattr(obj, "_mContainer", self.object(container - 1))
+            _defer(obj, _Pending(self, number))
+        return obj
+
+    def read(self, obj, number):
+        """
+        Decodes the features of object number into obj.
+        """
+        offset = self.offset(number)
+        classId, container, count = _HEAD.unpack_from(self.map, offset)
+        offset += _HEAD.size
+        for i in xrange(count):
+            name = self.string(_U32.unpack_from(self.map, offset)[0])
+            value, offset = self._decode(offset + 4, obj, name)
+            _put(obj, name, value)
+
+    def _decode(self, offset, obj=None, name=None):
+        """
+        Decodes the value at offset, wrapping lists and dicts as feature
+        name of obj would, and returns it with the offset that follows it.
+        """
+        data = self.map
+        tag = data[offset]
+        offset += 1
+        if tag == "o":
+            return self.object(_U32.unpack_from(data, offset)[0]), offset + 4
+        if tag == "b" or tag == "u" or tag == "I":
+            length, = _U32.unpack_from(data, offset)
+            offset += 4
+            value = data[offset:offset + length]
+            if tag == "u":
+                value = value.decode("utf-8")
+            elif tag == "I":
+                value = long(value)
+            return value, offset + length
+        if tag == "i":
+            return _I64.unpack_from(data, offset)[0], offset + 8
+        if tag == "d":
+            return _DOUBLE.unpack_from(data, offset)[0], offset + 8
+        if tag == "N":
+            return None, offset
+        if tag == "T":
+            return True, offset
+        if tag == "F":
+            return False, offset
+        if tag == "l" or tag == "t":
+            length, = _U32.unpack_from(data, offset)
+            offset += 4
+            if tag == "t":
+                values = []
+            else:
+                values = _collection(obj, name, list)
+            for i in xrange(length):
+                value, offset = self._decode(offset)
+                list.append(values, value)
+            if tag == "t":
+                return tuple(values), offset
+            if isinstance(values, MUniqueList):
+                values._mReindex()
+            return values, offset
+        if tag == "m":
+            length, = _U32.unpack_from(data, offset)
+            offset += 4
+            values = _collection(obj, name, dict)
+            for i in xrange(length):
+                key, offset = self._decode(offset)
+                value, offset = self._decode(offset)
+                dict.__setitem__(values, key, value)
+            return values, offset
+        raise ValueError("corrupt value at offset %d" % (offset - 1))
+
+
+
+
+class _Pending(object):
+    """
+    The loader of an object whose features have not been read yet.
+    """
+    __slots__ = ("image", "number")
+
+    def __init__(self, image, number):
+        self.image = image
+        self.number = number
+
+    def mLoad(self, obj):
+        self.image.read(obj, self.number)
@@ -6,20 +6,68 @@ found in the Eclipse Modeling Framework using Pythonic approaches.
 Currently, the two primary features being implemented are notification,
 containment, and adapters.
 """
+import copy
+import functools
+import inspect
+import itertools
+import threading
+
+class EventType(str):
+    """
+    The type of a Notification.
+
+    Event types compare equal to their names, so existing code that checks
+    notification.eventType == "SET" keeps working, but each also carries a
+    distinct bit so that a set of event types can be held as an integer
+    mask and tested with a single AND.  Event types may be combined into
+    masks directly, e.g. ADD | REMOVE.
+    """
+    def __new__(cls, name, mask):
+        self = str.__new__(cls, name)
+        self.mask = mask
+        return self
+
+    def __or__(self, other):
+        return self.mask | eventMask(other)
+    __ror__ = __or__
+
+ADD         = EventType("ADD",         0x01)
+ADD_MANY    = EventType("ADD_MANY",    0x02)
+MOVE        = EventType("MOVE",        0x04)
+MOVE_MANY   = EventType("MOVE_MANY",   0x08)
+REMOVE      = EventType("REMOVE",      0x10)
+REMOVE_MANY = EventType("REMOVE_MANY", 0x20)
+SET         = EventType("SET",         0x40)
+SET_MANY    = EventType("SET_MANY",    0x80)
+
+ALL_EVENTS = 0xFF
+
+# The event types by name
+EVENT_TYPES = dict((t, t) for t in (ADD, ADD_MANY, MOVE, MOVE_MANY,
+                                    REMOVE, REMOVE_MANY, SET, SET_MANY))
+
+def eventMask(eventTypes):
+    """
+    Returns the integer mask for an iterable of event types or event type
+    names.  Integer masks are returned unchanged.
+    """
+    if isinstance(eventTypes, (int, long)):
+        return eventTypes
+    if isinstance(eventTypes, basestring):
+        eventTypes = (eventTypes,)
+    mask = 0
+    for eventType in eventTypes:
+        mask |= EVENT_TYPES[eventType].mask
+    return mask
+
+# The event types whose position is a slice or a list of keys
+_MANY_EVENTS = ADD_MANY | MOVE_MANY | REMOVE_MANY | SET_MANY
 
 class Notification(object):
     """
     Notifications indicate that something about the object has been modified.
     """
-    EventTypes = frozenset(["ADD",
-                            "ADD_MANY",
-                            "MOVE",
-                            "MOVE_MANY",
-                            "REMOVE",
-                            "REMOVE_MANY",
-                            "SET",
-                            "SET_MANY",
-                           ]) 
+    EventTypes = frozenset(EVENT_TYPES.values())
 
     # Use slots for memory efficency, since a large model may
     # have a large number of Notifications
@@ -32,11 +80,14 @@ class Notification(object):
                  "feature",
                 ]
 
-    def __init__(self, **kw):
-        for k in self.__slots__:
-            setattr(self, k, None)
-        for k, v in kw.items():
-            setattr(self, k, v)
+    def __init__(self, notifier=None, eventType=None, newValue=None,
+                 oldValue=None, position=None, feature=None):
+        self.notifier = notifier
+        self.eventType = eventType
+        self.newValue = newValue
+        self.oldValue = oldValue
+        self.position = position
+        self.feature = feature
     
     def __str__(self):
         return self.__repr__()
@@ -49,6 +100,632 @@ class Notification(object):
 
 
 
+# Bumped to discard the adapter index of every MObject at once
+_dispatchEpoch = 0
+
+def invalidateAdapterIndex():
+    """
+    Discards the cached adapter index of every MObject.  Must be called
+    when an adapter that is already attached changes the event types it
+    is interested in.
+    """
+    global _dispatchEpoch
+    _dispatchEpoch += 1
+
+class _AdapterIndex(dict):
+    """
+    Maps each event type to the normalized event type and the tuple of
+    adapters interested in it, for one MObject.
+
+    Adapters registered for specific features are kept in per-feature
+    sub-indexes, so that a notification only visits the adapters that
+    want its feature.
+    """
+    __slots__ = ("epoch", "adapters", "features")
+
+    def __init__(self, adapters, adapterFeatures=None):
+        dict.__init__(self)
+        self.epoch = _dispatchEpoch
+        self.features = {}
+        if adapterFeatures:
+            self.adapters = [a for a in adapters if a not in adapterFeatures]
+            # Each sub-index keeps the order of adapters, in which those
+            # with mFirst come first
+            for feature in frozenset().union(*adapterFeatures.values()):
+                self.features[feature] = _AdapterIndex(
+                    [a for a in adapters
+                     if a not in adapterFeatures or feature in adapterFeatures[a]])
+        else:
+            self.adapters = list(adapters)
+
+    def add(self, eventType):
+        eventType = EVENT_TYPES[eventType]
+        entry = self[eventType] = (eventType,
+                                   tuple(a for a in self.adapters
+                                         if getattr(a, "eventMask", ALL_EVENTS) & eventType.mask))
+        return entry
+
+
+
+
+# The number of objects with content adapters, and an epoch bumped whenever
+# content adapters or containment change while there are any
+_deepObservers = 0
+_contentEpoch = 0
+
+def _contentChanged():
+    global _contentEpoch
+    _contentEpoch += 1
+
+def _setContainer(value, container):
+    """
+    Records container as the container of value.
+    """
+    value._mContainer = container
+    if _deepObservers:
+        _contentChanged()
+
+def _adopt(collection, value):
+    """
+    Makes value contained by the owner of collection, if collection is a
+    containment MList or MDict, and links it back to the owner if the
+    collection has an opposite.  Called once value is in the collection.
+    """
+    if collection._containment and isinstance(value, MObject):
+        _setContainer(value, collection._container)
+    if collection._opposite is not None and not _opposites.suspended:
+        _oppositeAdd(value, collection._opposite, collection._container)
+
+def _orphan(collection, value):
+    """
+    Releases value from the owner of collection, if collection is a
+    containment MList or MDict, and unlinks it from the owner if the
+    collection has an opposite.  Called once value has left the collection.
+    """
+    if collection._containment and isinstance(value, MObject):
+        _setContainer(value, None)
+    if collection._opposite is not None and not _opposites.suspended:
+        _oppositeRemove(value, collection._opposite, collection._container)
+
+def _claim(collection):
+    """
+    Adopts every element of a collection that has been given to its owner.
+    """
+    if collection._containment or collection._opposite is not None:
+        for value in (collection.values() if isinstance(collection, MDict) else list(collection)):
+            _adopt(collection, value)
+
+# The sets of managed features of objects, shared by the objects having
+# the same ones
+_managedSets = {}
+
+def _manage(obj, key):
+    """
+    Keeps writes of feature key of obj, whose class has no declared
+    features, off the unobserved fast path, as obj owns the collection
+    the feature holds and has to let go of it when it is replaced.
+    """
+    managed = obj._mManaged
+    if key not in managed:
+        managed = managed | frozenset([key])
+        _setattr(obj, "_mManaged", _managedSets.setdefault(managed, managed))
+
+def _release(collection):
+    """
+    Orphans every element of a collection that its owner has let go of.
+    """
+    if collection._containment or collection._opposite is not None:
+        for value in (collection.values() if isinstance(collection, MDict) else list(collection)):
+            _orphan(collection, value)
+
+
+
+
+class _Opposites(threading.local):
+    """
+    Whether opposite features are kept in sync in each thread, which
+    replaying recorded changes suspends since both sides were recorded,
+    and how deeply the changes being made are nested in syncing.
+
+    The changes made to sync opposites are made, and notified, before the
+    notification of the change that caused them.
+    """
+    suspended = False
+    depth = 0
+
+_opposites = _Opposites()
+
+def _oppositeAdd(obj, key, other):
+    """
+    Makes the feature key of obj refer to other, unless it already does.
+    """
+    if not isinstance(obj, MObject) or isinstance(obj, (MList, MDict)):
+        return
+    current = getattr(obj, key, None)
+    _opposites.depth += 1
+    try:
+        if isinstance(current, MList):
+            if current._mIndexOf(other) < 0:
+                current.append(other)
+        elif current is not other:
+            setattr(obj, key, other)
+    finally:
+        _opposites.depth -= 1
+
+def _oppositeRemove(obj, key, other):
+    """
+    Makes the feature key of obj stop referring to other, if it does.
+    """
+    if not isinstance(obj, MObject) or isinstance(obj, (MList, MDict)):
+        return
+    current = getattr(obj, key, None)
+    _opposites.depth += 1
+    try:
+        if isinstance(current, MList):
+            position = current._mIndexOf(other)
+            if position >= 0:
+                del current[position]
+        elif current is other:
+            setattr(obj, key, None)
+    finally:
+        _opposites.depth -= 1
+
+def _relink(obj, opposite, oldValue, newValue):
+    """
+    Updates the other side of a single valued feature of obj, whose
+    opposite is named opposite, that changed from oldValue to newValue.
+    """
+    if oldValue is not newValue and not _opposites.suspended:
+        if oldValue is not None:
+            _oppositeRemove(oldValue, opposite, obj)
+        if newValue is not None:
+            _oppositeAdd(newValue, opposite, obj)
+
+
+
+
+# Plain values of these types are adapted into MList and MDict on assignment
+_WRAPPED_TYPES = frozenset([list, dict])
+_setattr = object.__setattr__
+
+# Per-instance bookkeeping of MObject, stored in slots by declared classes,
+# whose instances never allocate their __dict__; the rest stays at its
+# class defaults unless the object is observed
+_INTERNAL_SLOTS = ("_mContainer", "_mDeepCache", "_mStamp", "_mDeliver", "_mLoader",
+                   "_mDirty", "_mOid", "_mAdapters", "_mDispatch", "_mAdapterFeatures",
+                   "_mContentAdapters", "_mMemo")
+
+# The source of modification stamps, shared by all objects so that stamps
+# only ever grow, whichever object bumped them last.  Nothing is stamped,
+# or marked dirty, until the first stamp is read or something starts
+# tracking changes, so unobserved writes pay nothing for them in programs
+# that never use either.  Tracking is global: once mStamp has been called,
+# or a Resource has loaded or saved a tree, every change to any object in
+# the process stamps it and the objects containing it, whether or not
+# anything reads those stamps.  Only tracking the watched trees would
+# mean walking up the containers of every change to find out.
+_clock = itertools.count(1)
+_tracking = False
+
+# Set once an adapter that validates changes has been added, see
+# MObject.mAddAdapter; until then no change is validated
+_validating = False
+
+def _checkValidator(adapter):
+    global _validating
+    if not _validating and getattr(adapter, "validate", None) is not None:
+        _validating = True
+
+def _trackChanges():
+    """
+    Starts stamping, and marking dirty, the objects that change, all of
+    them and for the rest of the process.
+    """
+    global _tracking
+    _tracking = True
+
+def _defer(obj, loader):
+    """
+    Makes obj read its features with loader.mLoad(obj) on first use.
+    """
+    _setattr(obj, "_mLoader", loader)
+    if not obj.mFeatures:
+        # Writes to classes without declared features do not check
+        # _mLoader on their fast path, so keep them off it
+        _setattr(obj, "_mFastSetattr", False)
+
+# Held while loading objects whose loader has no mLock of its own
+_loadLock = threading.RLock()
+
+class _Loading(threading.local):
+    """
+    The ids of the objects being loaded in each thread.
+    """
+    def __init__(self):
+        self.ids = set()
+
+_loading = _Loading()
+
+def _load(obj):
+    """
+    Reads the features of obj, if it is an object whose features are
+    loaded on first use that has not been loaded yet.  Returns False if
+    obj is being loaded by the calling thread, and True once it has been
+    loaded.
+
+    Loading holds the lock of the loader, and obj keeps its loader until
+    all of its features have been stored, so other threads using obj wait
+    for them.
+    """
+    loader = obj._mLoader
+    if loader is None:
+        return True
+    with getattr(loader, "mLock", _loadLock):
+        if obj._mLoader is None:
+            # Loaded by another thread meanwhile
+            return True
+        if id(obj) in _loading.ids:
+            return False
+        _loading.ids.add(id(obj))
+        try:
+            loader.mLoad(obj)
+        finally:
+            _loading.ids.discard(id(obj))
+        if obj.mFeatures:
+            _setattr(obj, "_mLoader", None)
+        else:
+            del obj.__dict__["_mLoader"]
+            del obj.__dict__["_mFastSetattr"]
+    return True
+
+def _touch(obj):
+    """
+    Marks obj dirty, or the owner of obj if it is a MList or MDict, and
+    gives obj and all of its containers a new modification stamp.
+    """
+    stamp = next(_clock)
+    if isinstance(obj, (MList, MDict)) and obj._container is not None:
+        _setattr(obj._container, "_mDirty", True)
+    else:
+        _setattr(obj, "_mDirty", True)
+    while obj is not None:
+        _setattr(obj, "_mStamp", stamp)
+        obj = obj._mContainer
+
+class Feature(object):
+    """
+    Declares a model feature on a MObject subclass.
+
+        class PurchaseOrder(MObject):
+            shipTo = Feature()
+            items = ListFeature(containment=True)
+
+    A feature may name its opposite, the feature of the objects it refers
+    to that refers back, and both sides are then kept in sync:
+
+        class Order(MObject):
+            customer = Feature(opposite="orders")
+
+        class Customer(MObject):
+            orders = ListFeature(opposite="customer")
+
+    Declared features are compiled by MClass into slots of the same name.
+    The feature name used in notifications, the containment flag and the
+    list/dict wrapping are all resolved once per class, so a write does no
+    more work than the feature actually requires and reads are plain slot
+    reads.
+
+    Each feature of a class is assigned a small integer id, its index in
+    the class's mFeatures tuple, for reflective access.
+    """
+    # Used to recover declaration order from the (unordered) class namespace
+    _mCounter = 0
+
+    # True for features whose values are wrapped by _mAdapt
+    _mWraps = False
+
+    def __init__(self, containment=False, default=None, opposite=None):
+        self.containment = containment
+        self.default = default
+        self.opposite = opposite
+        self.name = None
+        self.feature = None
+        self.id = None
+        self._slot = None
+        Feature._mCounter += 1
+        self._mOrder = Feature._mCounter
+
+    def _mBind(self, cls, name, slot, id):
+        """
+        Called by MClass to attach the feature to its class.
+        """
+        self.name = name
+        self.feature = cls.__name__ + "." + name
+        self.id = id
+        self._slot = slot
+        # Writes to a plain feature of an unobserved object are slot writes
+        self._mPlain = not (self.containment or self._mWraps or self.opposite)
+
+    def _mDefault(self, obj):
+        """
+        Returns the value of a feature that has never been set.
+        """
+        return self.default
+
+    def _mAdapt(self, obj, value):
+        """
+        Converts a value into the form stored by the feature.
+        """
+        return value
+
+    def get(self, obj):
+        """
+        Returns the value of this feature of obj.
+        """
+        try:
+            return self._slot.__get__(obj, type(obj))
+        except AttributeError:
+            # Read again once loaded, also if another thread has just
+            # finished loading obj
+            if _load(obj):
+                try:
+                    return self._slot.__get__(obj, type(obj))
+                except AttributeError:
+                    pass
+            return self._mDefault(obj)
+
+    def set(self, obj, value):
+        """
+        Sets the value of this feature of obj, producing a notification.
+        """
+        if (self._mPlain and not obj._mAdapters and obj._mFastSetattr and
+            obj._mLoader is None and not (_deepObservers and obj._mDeepAdapters())):
+            self._slot.__set__(obj, value)
+            if _tracking:
+                _touch(obj)
+            return
+        _load(obj)
+        try:
+            oldValue = self._slot.__get__(obj, type(obj))
+        except AttributeError:
+            oldValue = None
+        value = self._mAdapt(obj, value)
+        if _validating:
+            obj._mValidate(SET, self.feature, value, oldValue)
+        if value is not oldValue:
+            # If the oldValue is a MObject, unset containment
+            if self._mWraps:
+                if oldValue is not None and oldValue._mContainer is obj:
+                    _setContainer(oldValue, None)
+                    _release(oldValue)
+            elif self.containment and isinstance(oldValue, MObject):
+                _setContainer(oldValue, None)
+        self._slot.__set__(obj, value)
+        if value is not oldValue:
+            # If the value is a MObject, set containment
+            if self._mWraps:
+                if value._container is obj:
+                    _setContainer(value, obj)
+                    _claim(value)
+            elif self.containment and isinstance(value, MObject):
+                _setContainer(value, obj)
+        if self.opposite is not None and not self._mWraps:
+            _relink(obj, self.opposite, oldValue, value)
+        obj.mNotify(SET, self.feature, value, oldValue)
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__.__name__, self.feature)
+
+
+
+
+class ListFeature(Feature):
+    """
+    Declares a many-valued feature.  Values are stored as a MList, which
+    is created empty on first access.  Setting the feature to None empties
+    it.
+
+    Containment features and features with an opposite are stored as a
+    MUniqueList, unless unique is given.
+    """
+    _mWraps = True
+
+    def _mDefault(self, obj):
+        value = self._mAdapt(obj, ())
+        self._slot.__set__(obj, value)
+        return value
+
+    def __init__(self, containment=False, default=None, opposite=None, unique=None):
+        Feature.__init__(self, containment, default, opposite)
+        self.unique = unique
+
+    def _mAdapt(self, obj, value):
+        if isinstance(value, MList) and value._container is obj:
+            return value
+        unique = self.unique
+        if unique is None:
+            unique = self.containment or self.opposite is not None
+        cls = MUniqueList if unique else MList
+        return cls(value or (),
+                   container=obj,
+                   feature=self.feature,
+                   containment=self.containment,
+                   opposite=self.opposite)
+
+
+
+
+class DictFeature(Feature):
+    """
+    Declares a keyed feature.  Values are stored as a MDict, which is
+    created empty on first access.  Setting the feature to None empties
+    it.
+    """
+    _mWraps = True
+
+    def _mDefault(self, obj):
+        value = self._mAdapt(obj, ())
+        self._slot.__set__(obj, value)
+        return value
+
+    def _mAdapt(self, obj, value):
+        if isinstance(value, MDict) and value._container is obj:
+            return value
+        return MDict(value or (),
+                     container=obj,
+                     feature=self.feature,
+                     containment=self.containment)
+
+
+
+
+def _setDeclared(self, key, value):
+    """
+    The __setattr__ of classes with declared features.
+    """
+    feature = self._mFeatureMap.get(key)
+    if feature is None:
+        if key[:1] != "_":
+            raise AttributeError("'%s' object has no feature '%s'" % (type(self).__name__, key))
+        _setattr(self, key, value)
+    elif (feature._mPlain and not self._mAdapters and self._mFastSetattr and
+          self._mLoader is None and not (_deepObservers and self._mDeepAdapters())):
+        feature._slot.__set__(self, value)
+        if _tracking:
+            _touch(self)
+    else:
+        feature.set(self, value)
+
+def _getDeclared(self, key):
+    """
+    The __getattr__ of classes with declared features, only reached for
+    features that have not been set yet.
+    """
+    feature = self._mFeatureMap.get(key)
+    if feature is None:
+        raise AttributeError("'%s' object has no attribute '%s'" % (type(self).__name__, key))
+    if _load(self):
+        try:
+            return feature._slot.__get__(self, type(self))
+        except AttributeError:
+            pass
+    return feature._mDefault(self)
+
+def _getDeclaredState(self):
+    """
+    The __getstate__ of classes with declared features: the slots that
+    are set, by name, for MObject.__setstate__.
+    """
+    _load(self)
+    slots = {}
+    for cls in type(self).__mro__:
+        for name in cls.__dict__.get("__slots__", ()):
+            if name[:2] == "__":
+                continue
+            feature = self._mFeatureMap.get(name)
+            try:
+                if feature is None:
+                    slots[name] = object.__getattribute__(self, name)
+                else:
+                    slots[name] = feature._slot.__get__(self, cls)
+            except AttributeError:
+                pass
+    return None, slots
+
+# The arguments of MObject.mNotify, in order
+_NOTIFY_ARGUMENTS = ("eventType", "feature", "newValue", "oldValue", "position", "notifier")
+
+def _keywordNotify(method):
+    """
+    Wraps an mNotify that takes its arguments as keywords only.
+    """
+    @functools.wraps(method)
+    def mNotify(self, *args, **kw):
+        kw.update(zip(_NOTIFY_ARGUMENTS, args))
+        if kw.get("notifier") is None:
+            kw["notifier"] = self
+        return method(self, **kw)
+    return mNotify
+
+class MClass(type):
+    """
+    The metaclass of all model objects.
+
+    Information that only depends on the class is resolved here, once,
+    rather than on every attribute write.  This includes compiling any
+    declared Features into slots.
+    """
+    def __new__(mcs, name, bases, namespace):
+        declared = [(k, v) for k, v in namespace.items() if isinstance(v, Feature)]
+        inherits = any(getattr(base, "mFeatures", ()) for base in bases)
+        if declared or inherits:
+            slots = namespace.get("__slots__", ())
+            if isinstance(slots, basestring):
+                slots = (slots,)
+            slots = list(slots)
+            # Features are stored in slots of the same name
+            for k, v in declared:
+                del namespace[k]
+                slots.append(k)
+            if not inherits:
+                slots.extend(_INTERNAL_SLOTS)
+            namespace["__slots__"] = tuple(slots)
+            namespace.setdefault("__setattr__", _setDeclared)
+            namespace.setdefault("__getattr__", _getDeclared)
+            namespace.setdefault("__getstate__", _getDeclaredState)
+        cls = super(MClass, mcs).__new__(mcs, name, bases, namespace)
+        inherited = getattr(cls, "mFeatures", ())
+        if declared or inherited:
+            cls._mCompile(inherited, declared)
+        return cls
+
+    def __init__(cls, name, bases, namespace):
+        super(MClass, cls).__init__(name, bases, namespace)
+        cls._mContainment = frozenset(getattr(cls, "mContainment", ()))
+        # Features whose writes have bookkeeping to do even when unobserved
+        # Objects owning a collection add its feature, see _manage
+        cls._mManaged = cls._mContainment | frozenset(getattr(cls, "mOpposites", ()))
+        # A class that hooks mNotify wants to see every write, so the
+        # unobserved fast path in MObject.__setattr__ must not bypass it.
+        # Such classes may opt back in by setting _mFastSetattr themselves.
+        if "mNotify" in namespace and "_mFastSetattr" not in namespace:
+            cls._mFastSetattr = False
+        # mNotify used to be called with keywords only, so an override
+        # taking nothing else is handed the arguments as keywords
+        if "mNotify" in namespace:
+            args, varargs, keywords, _ = inspect.getargspec(namespace["mNotify"])
+            if len(args) == 1 and varargs is None and keywords is not None:
+                cls.mNotify = _keywordNotify(namespace["mNotify"])
+
+    def _mCompile(cls, inherited, declared):
+        """
+        Binds the features of a class, giving every class its own copy of
+        inherited features so that notifications name the concrete class.
+        """
+        declared.sort(key=lambda kv: kv[1]._mOrder)
+        overrides = dict(declared)
+        features = []
+        for base in inherited:
+            feature = overrides.pop(base.name, None)
+            if feature is None:
+                feature = copy.copy(base)
+            feature._mBind(cls, base.name, getattr(cls, base.name), len(features))
+            features.append(feature)
+        for k, feature in declared:
+            if k in overrides:
+                feature._mBind(cls, k, getattr(cls, k), len(features))
+                features.append(feature)
+        cls.mFeatures = tuple(features)
+        cls.mFeatureIds = dict((f.name, f.id) for f in features)
+        cls._mFeatureMap = dict((f.name, f) for f in features)
+        cls.mContainment = (frozenset(getattr(cls, "mContainment", ())) |
+                            frozenset(f.name for f in features if f.containment))
+        cls.mOpposites = dict(getattr(cls, "mOpposites", {}))
+        cls.mOpposites.update((f.name, f.opposite) for f in features if f.opposite)
+
+
+
+
 class MObject(object):
     """
     The base class for all model objects.
@@ -65,59 +742,233 @@ class MObject(object):
        attribute = The attribute name
        
     Notifications can be disabled by setting _mDeliver to False.
+
+    Writes to an object that has no adapters attached take a fast path
+    that skips the old-value lookup and notification entirely; this is
+    invisible to callers unless a subclass overrides mNotify.
+
+    Pairs of features that refer to each other are declared as opposites
+    by naming, in mOpposites, the feature of the referenced objects that
+    refers back:
+
+        class Order(MObject):
+            mOpposites = {"customer": "orders"}
+
+        class Customer(MObject):
+            mOpposites = {"orders": "customer"}
+
+    Setting order.customer then adds the order to customer.orders and
+    removes it from the orders of its previous customer, and adding or
+    removing an order from customer.orders sets or unsets its customer.
+
+    Alternatively, a subclass may declare its features up front using
+    Feature, ListFeature and DictFeature.  Such classes are backed by
+    __slots__ and only the declared features produce notifications.
     """
+    __metaclass__ = MClass
+
+    # Cleared by MClass for subclasses that override mNotify
+    _mFastSetattr = True
+
+    # The opposites of features, by feature name
+    mOpposites = {}
+
+    # The declared features, indexed by feature id, and their ids by name
+    mFeatures = ()
+    mFeatureIds = {}
+    _mFeatureMap = {}
+
+    # The adapter index used by mNotify, built on first use
+    _mDispatch = None
+
+    # Maps adapters added for specific features to those features
+    _mAdapterFeatures = None
+
+    # Adapters receiving the notifications of every object this one contains
+    _mContentAdapters = ()
+
+    # Instance state that most objects never change is left at these
+    # shared defaults, so an unobserved object allocates nothing for it.
+    # _mContainment is resolved once per class by MClass.
+    _mDeliver = True
+    _mContainer = None
+    _mAdapters = ()
+    _mDeepCache = None
+    _mStamp = 0
+
+    # Maintained while changes are tracked, see mIsDirty, and the number
+    # of the object in the Resource it was saved to
+    _mDirty = False
+    _mOid = None
+
+    # Set on objects whose features are read on first use, see mLoad
+    _mLoader = None
+
     def __init__(self):
-        self._mDeliver = True
-        self._mContainer = None
-        self._mAdapters = []
-        if hasattr(type(self), "mContainment"):
-            self._mContainment = frozenset(getattr(type(self), "mContainment"))
-        else:
-            self._mContainment = frozenset([])
+        # Declared classes keep these in slots, which have no defaults
+        if self.mFeatures:
+            self._mContainer = None
+            self._mDeepCache = None
+            self._mStamp = 0
+            self._mDeliver = True
+            self._mLoader = None
+            self._mDirty = False
+            self._mOid = None
+            self._mAdapters = ()
+            self._mDispatch = None
+            self._mAdapterFeatures = None
+            self._mContentAdapters = ()
+            self._mMemo = None
+
+    def __setstate__(self, state):
+        """
+        Restores the state of a copy, or of an unpickled object, as it was
+        stored, without producing notifications.
+        """
+        if isinstance(state, tuple):
+            state, slots = state
+            # Slots that were unset in the original keep their defaults
+            MObject.__init__(self)
+            for name, value in (slots or {}).iteritems():
+                feature = self._mFeatureMap.get(name)
+                if feature is None:
+                    _setattr(self, name, value)
+                else:
+                    feature._slot.__set__(self, value)
+        if state:
+            self.__dict__.update(state)
 
     def __setattr__(self, key, value):
         """
         Implement __setattr__ to produce notfications.
         """
-        if key.startswith("_"):
-            super(MObject, self).__setattr__(key, value)
+        if key[:1] == "_":
+            _setattr(self, key, value)
+        elif (not self._mAdapters and
+              self._mFastSetattr and
+              key not in self._mManaged and
+              type(value) not in _WRAPPED_TYPES and
+              not (_deepObservers and self._mDeepAdapters())):
+            # Nobody is listening and there is no containment or wrapping
+            # to maintain, so this is a plain attribute write.
+            _setattr(self, key, value)
+            if _tracking:
+                _touch(self)
         else:
+            feature = self.__class__.__name__ + "." + key
             try:
                 oldValue = getattr(self, key)
             except AttributeError:
                 oldValue = None
-            # If the oldValue is a MObject, unset containment
-            if isinstance(oldValue, MObject) and key in self._mContainment:
-                oldValue._mContainer = None
+            if _validating:
+                self._mValidate(SET, feature, value, oldValue)
+            if oldValue is not value:
+                # If the oldValue is a MObject, unset containment
+                if isinstance(oldValue, (MList, MDict)):
+                    if oldValue._mContainer is self:
+                        _setContainer(oldValue, None)
+                        _release(oldValue)
+                elif isinstance(oldValue, MObject) and key in self._mContainment:
+                    _setContainer(oldValue, None)
             # Adapt regular lists/dicts into their PMF equivalents
             if type(value) == list:
-                value = MList(value,
+                opposite = self.mOpposites.get(key)
+                containment = key in self._mContainment
+                cls = MUniqueList if containment or opposite else MList
+                value = cls(value,
+                            container=self,
+                            feature=feature,
+                            containment=containment,
+                            opposite=opposite)
+            if type(value) == dict:
+                value = MDict(value,
                               container=self,
-                              feature=self.__class__.__name__ + "." + key,
+                              feature=feature,
                               containment=(key in self._mContainment))
-            if type(value) == dict:
-                value = MDict(value)
             # Call the regular Python set attribute
-            super(MObject, self).__setattr__(key, value)
-            # If the value is a MObject, set containment
-            if isinstance(value, MObject) and key in self._mContainment:
-                value._mContainer = self
+            _setattr(self, key, value)
+            if oldValue is not value:
+                # A collection owned by this object, either new or put
+                # back by undo, takes its elements
+                if isinstance(value, (MList, MDict)):
+                    if value._container is self:
+                        _setContainer(value, self)
+                        _claim(value)
+                        _manage(self, key)
+                # If the value is a MObject, set containment
+                elif isinstance(value, MObject) and key in self._mContainment:
+                    _setContainer(value, self)
+            opposite = self.mOpposites.get(key)
+            if opposite is not None:
+                _relink(self, opposite, oldValue, value)
             # Emit a notification
-            self.mNotify(notifier=self,
-                         eventType="SET",
-                         newValue=value,
-                         oldValue=oldValue,
-                         feature=self.__class__.__name__ + "." + key)
+            self.mNotify(SET, feature, value, oldValue)
 
-    def mAddAdapter(self, adapter):
+    def __getattr__(self, key):
+        """
+        Only reached for attributes that are not set, which for an object
+        that has not been loaded yet may just not have been read.
+        """
+        if key[:1] != "_" and _load(self) and key in self.__dict__:
+            return self.__dict__[key]
+        raise AttributeError("'%s' object has no attribute '%s'" % (type(self).__name__, key))
+
+    def mLoad(self):
+        """
+        Reads the features of this object now, if it is one whose features
+        are read on first use.
+
+        Such objects are created by persistence layers, which hand them to
+        _defer with a loader: an object whose mLoad(obj) method stores the
+        features of obj without producing notifications.  Any read or
+        write of a feature loads the object first.  Loading holds the
+        mLock of the loader, if it has one, or else a lock shared by all
+        loaders, so that other threads using the object wait until it has
+        been read.
+        """
+        _load(self)
+
+    def mAddAdapter(self, adapter, features=None):
         """
         Add an adapter to this object.  Has no effect if the adapter
         has already been added.
+
+        If features is given, the adapter only receives notifications for
+        those features, named as in Notification.feature (for example
+        "PurchaseOrder.shipTo").  Adding an adapter again with more
+        features extends the features it receives.
+
+        Adapters with a true mFirst attribute, such as those invalidating
+        cached values, are notified ahead of the others, so that nothing
+        reads a stale value while a change is being delivered.
+
+        Adapters with a validate method are also given each change they
+        would be notified of before it is made, as a Notification, and
+        may reject it by raising, in which case nothing is changed.
         """
-        if adapter not in self._mAdapters:
-            self._mAdapters.append(adapter)
-            if adapter.target == None:
-                adapter.target = self
+        _checkValidator(adapter)
+        if adapter in self._mAdapters:
+            restricted = self._mAdapterFeatures and adapter in self._mAdapterFeatures
+            if not restricted:
+                return
+            if features is None:
+                del self._mAdapterFeatures[adapter]
+            else:
+                self._mAdapterFeatures[adapter] |= frozenset(features)
+        else:
+            if getattr(adapter, "mFirst", False):
+                self._mAdapters = [adapter] + list(self._mAdapters)
+            elif self._mAdapters:
+                self._mAdapters.append(adapter)
+            else:
+                self._mAdapters = [adapter]
+            if features is not None:
+                if self._mAdapterFeatures is None:
+                    self._mAdapterFeatures = {}
+                self._mAdapterFeatures[adapter] = frozenset(features)
+        self._mDispatch = None
+        if adapter.target == None:
+            adapter.target = self
 
     def mRemoveAdapter(self, adapter):
         """
@@ -126,6 +977,11 @@ class MObject(object):
         """
         if adapter in self._mAdapters:
             self._mAdapters.remove(adapter)
+            if not self._mAdapters:
+                self._mAdapters = ()
+            if self._mAdapterFeatures:
+                self._mAdapterFeatures.pop(adapter, None)
+            self._mDispatch = None
             if adapter.target == self:
                 adapter.target = None
                     
@@ -136,17 +992,392 @@ class MObject(object):
         """
         return ((len(self._mAdapters) > 0) and self._mDeliver)
     
-    def mNotify(self, **kw):
+    def mFeatureNames(self):
+        """
+        Returns the names of the features of this object: the declared
+        features, or for other classes the public attributes set so far.
+        """
+        if self.mFeatures:
+            return [f.name for f in self.mFeatures]
+        _load(self)
+        return [k for k in self.__dict__ if k[:1] != "_"]
+
+    def mContainer(self):
+        """
+        Returns the MObject that contains this one, or None.
+        """
+        return self._mContainer
+
+    def mStamp(self):
+        """
+        Returns the modification stamp of this object, which grows
+        whenever this object, or anything it contains, changes.  A cache
+        of anything computed from the tree under this object is valid for
+        as long as the stamp is the one it was computed at.
+
+        Changes to attributes that are not features, such as private
+        ones, do not count.
+
+        The first call starts tracking changes, after which every change
+        to any MObject stamps it and the objects containing it, which
+        more than doubles the cost of an unobserved write.
+        """
+        _trackChanges()
+        return self._mStamp
+
+    def mIsDirty(self):
+        """
+        Returns True if a feature of this object, including the contents
+        of its lists and dicts, has changed since it was last saved or
+        loaded by a Resource, or since changes started being tracked.
+        """
+        return self._mDirty
+
+    def mContents(self):
+        """
+        Returns the MObjects directly contained by this object through its
+        containment features.
+        """
+        contents = []
+        for key in self._mContainment:
+            value = getattr(self, key, None)
+            if isinstance(value, (MList, MDict)):
+                contents.extend(value.mContents())
+            elif isinstance(value, MObject):
+                contents.append(value)
+        return contents
+
+    def mAllContents(self):
+        """
+        Iterates, depth first and without recursion, over every MObject
+        contained by this object directly or indirectly.
+        """
+        stack = self.mContents()
+        stack.reverse()
+        while stack:
+            obj = stack.pop()
+            yield obj
+            children = obj.mContents()
+            children.reverse()
+            stack.extend(children)
+
+    def mBatch(self):
+        """
+        Returns a Batch, to be used as a context manager, that buffers and
+        coalesces the notifications of the whole model until it exits.
+
+            with po.mBatch():
+                po.items.append(item1)
+                po.items.append(item2)
+        """
+        return Batch()
+
+    def mAddContentAdapter(self, adapter):
+        """
+        Add an adapter that receives the notifications of this object and
+        of every object it contains, directly or indirectly, including
+        those added later.  Has no effect if the adapter has already been
+        added.
+
+        Unlike AllContentNotificationAdapter, nothing is attached to the
+        contained objects: their notifications bubble up the containment
+        chain, so adding a content adapter is O(1) whatever the size of
+        the tree.
+        """
+        global _deepObservers
+        _checkValidator(adapter)
+        if adapter not in self._mContentAdapters:
+            if not self._mContentAdapters:
+                _deepObservers += 1
+            self._mContentAdapters = self._mContentAdapters + (adapter,)
+            _contentChanged()
+            if adapter.target == None:
+                adapter.target = self
+
+    def mRemoveContentAdapter(self, adapter):
+        """
+        Remove a content adapter from the object.  Has no effect if the
+        adapter has not been added to the object.
+        """
+        global _deepObservers
+        if adapter in self._mContentAdapters:
+            self._mContentAdapters = tuple(a for a in self._mContentAdapters if a is not adapter)
+            if not self._mContentAdapters:
+                _deepObservers -= 1
+            _contentChanged()
+            if adapter.target == self:
+                adapter.target = None
+
+    def mNotify(self, eventType, feature=None, newValue=None, oldValue=None,
+                position=None, notifier=None):
         """
         Called when a notification needs to be sent.
+
+        The adapters interested in each event type and feature are looked
+        up in an index built on first use, and the Notification is only
+        built if there is at least one of them.  While a Batch is active
+        the Notification is handed to it instead of the adapters, except
+        for adapters with a true mFirst attribute, which are still
+        notified at once so that cached values are never read stale.
+
+        Every change passing through here, delivered or not, bumps the
+        modification stamps of this object and its containers.
         """
-        if self.mNotificationRequired():
-            notification = Notification(**kw)
-            for adapter in self._mAdapters:
+        if _tracking:
+            _touch(self)
+        if not self._mDeliver:
+            return
+        if _deepObservers:
+            eventType, adapters = self._mRecipients(eventType, feature)
+        elif self._mAdapters:
+            eventType, adapters = self._mInterested(eventType, feature)
+        else:
+            return
+        if adapters:
+            notification = Notification(self if notifier is None else notifier,
+                                        eventType, newValue, oldValue,
+                                        position, feature)
+            batch = _batching.batch
+            if batch is not None:
+                for adapter in adapters:
+                    if getattr(adapter, "mFirst", False):
+                        adapter.notify(notification)
+                batch.mRecord(self, notification)
+                return
+            for adapter in adapters:
                 adapter.notify(notification)
+
+    def _mValidate(self, eventType, feature=None, newValue=None, oldValue=None,
+                   position=None):
+        """
+        Passes a change that is about to be made to the validate method of
+        the adapters that would be notified of it.
+        """
+        if not self._mDeliver:
+            return
+        if _deepObservers:
+            eventType, adapters = self._mRecipients(eventType, feature)
+        elif self._mAdapters:
+            eventType, adapters = self._mInterested(eventType, feature)
+        else:
+            return
+        for adapter in adapters:
+            validate = getattr(adapter, "validate", None)
+            if validate is not None:
+                validate(Notification(self, eventType, newValue, oldValue, position, feature))
+
+    def _mInterested(self, eventType, feature):
+        """
+        Returns the normalized event type and the adapters of this object
+        interested in a notification.
+        """
+        index = self._mDispatch
+        if index is None or index.epoch != _dispatchEpoch:
+            index = self._mDispatch = _AdapterIndex(self._mAdapters,
+                                                    self._mAdapterFeatures)
+        if index.features:
+            index = index.features.get(feature, index)
+        try:
+            return index[eventType]
+        except KeyError:
+            return index.add(eventType)
+
+    def _mRecipients(self, eventType, feature):
+        """
+        Like _mInterested, but also includes the interested content
+        adapters of this object and its containers.
+        """
+        if self._mAdapters:
+            eventType, adapters = self._mInterested(eventType, feature)
+        else:
+            eventType, adapters = EVENT_TYPES[eventType], ()
+        deep = self._mDeepAdapters()
+        if deep:
+            mask = eventType.mask
+            adapters += tuple(a for a in deep if getattr(a, "eventMask", ALL_EVENTS) & mask)
+        return eventType, adapters
+
+    def _mDeepAdapters(self):
+        """
+        Returns the content adapters of this object and its containers.
+        The result is cached until content adapters or containment change.
+        """
+        cache = self._mDeepCache
+        if cache is not None and cache[0] == _contentEpoch:
+            return cache[1]
+        adapters = []
+        obj = self
+        while obj is not None:
+            adapters.extend(obj._mContentAdapters)
+            obj = obj._mContainer
+        adapters = tuple(adapters)
+        self._mDeepCache = (_contentEpoch, adapters)
+        return adapters
                     
 
 
+
+class Batch(object):
+    """
+    Buffers the notifications produced in the current thread and delivers
+    the net changes when the outermost batch exits:
+
+      - repeated SETs of the same feature (or MDict key) collapse into one
+        SET carrying the original oldValue, and disappear if the value ends
+        up unchanged
+      - consecutive ADDs to the end of a run on the same MList become one
+        ADD_MANY
+      - removing an element that was added earlier in the batch, before
+        anything else happened to the list, cancels both, as does
+        removing a MDict key added earlier in the batch, whose later SETs
+        are folded into its ADD; a change to several keys at once is kept
+        as it is, and ends the coalescing of the keys of its feature
+
+    Notifications are delivered to the adapters interested in them, through
+    their notifyMany method, or one by one to notify if they have none,
+    when the batch exits, so a coalesced ADD_MANY only reaches adapters that
+    want ADD_MANY.  Adapters with a true mFirst attribute are the exception:
+    they are notified of each change as it is made, and not again when the
+    batch exits.  Batches nest; inner batches join the outermost one.
+    """
+    def __init__(self):
+        self._mOuter = None
+        self._mPending = []
+        # Last pending entry for each MList, and for each position of the
+        # features of other notifiers, by (notifier, feature)
+        self._mTails = {}
+        self._mKeys = {}
+
+    def __enter__(self):
+        self._mOuter = _batching.batch
+        if self._mOuter is None:
+            _batching.batch = self
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        if self._mOuter is None:
+            _batching.batch = None
+            self.mFlush()
+        return False
+
+    def mRecord(self, source, notification):
+        """
+        Adds a notification from source to the batch, coalescing it with
+        the pending notifications where possible.
+        """
+        eventType = notification.eventType
+        if isinstance(source, MList):
+            tail = self._mTails.get(id(source))
+            if tail is not None and self._mCoalesceList(tail, notification):
+                if tail[1] is None:
+                    del self._mTails[id(source)]
+                return
+            entry = [source, notification]
+            self._mTails[id(source)] = entry
+        elif eventType.mask & _MANY_EVENTS:
+            # Its positions are a list of keys
+            self._mKeys.pop((id(source), notification.feature), None)
+            entry = [source, notification]
+        else:
+            keys = self._mKeys.setdefault((id(source), notification.feature), {})
+            position = notification.position
+            entry = keys.get(position)
+            if entry is not None:
+                pending = entry[1]
+                if eventType is SET and pending.eventType in (SET, ADD):
+                    pending.newValue = notification.newValue
+                    if pending.eventType is SET and pending.newValue is pending.oldValue:
+                        entry[1] = None
+                        del keys[position]
+                    return
+                if eventType is REMOVE and pending.eventType is ADD:
+                    entry[1] = None
+                    del keys[position]
+                    return
+            entry = [source, notification]
+            keys[position] = entry
+        self._mPending.append(entry)
+
+    def _mCoalesceList(self, tail, notification):
+        """
+        Merges a list notification into the last pending notification of
+        the same list.  Returns False if they can not be merged.
+        """
+        pending = tail[1]
+        if pending is None or pending.eventType not in (ADD, ADD_MANY):
+            return False
+        if pending.eventType is ADD:
+            start = end = pending.position
+            values = [pending.newValue]
+        else:
+            start, end = pending.position.start, pending.position.stop
+            values = list(pending.newValue)
+        if notification.eventType is ADD and notification.position == end + 1:
+            values.append(notification.newValue)
+            end += 1
+        elif (notification.eventType is REMOVE and
+              start <= notification.position <= end and
+              values[notification.position - start] is notification.oldValue):
+            del values[notification.position - start]
+            end -= 1
+        else:
+            return False
+        if not values:
+            tail[1] = None
+        elif len(values) == 1:
+            tail[1] = Notification(pending.notifier, ADD, values[0], None,
+                                   start, pending.feature)
+        else:
+            tail[1] = Notification(pending.notifier, ADD_MANY, values, None,
+                                   slice(start, end), pending.feature)
+        return True
+
+    def mFlush(self):
+        """
+        Delivers the pending notifications.  Each adapter receives all of
+        its notifications, in order, with a single call to notifyMany.
+        """
+        pending, self._mPending = self._mPending, []
+        self._mTails.clear()
+        self._mKeys.clear()
+        deliveries = {}
+        order = []
+        for source, notification in pending:
+            if notification is None:
+                continue
+            eventType, adapters = source._mRecipients(notification.eventType,
+                                                      notification.feature)
+            for adapter in adapters:
+                if getattr(adapter, "mFirst", False):
+                    # Already notified as the change was made
+                    continue
+                notifications = deliveries.get(adapter)
+                if notifications is None:
+                    notifications = deliveries[adapter] = []
+                    order.append(adapter)
+                notifications.append(notification)
+        for adapter in order:
+            notifyMany = getattr(adapter, "notifyMany", None)
+            if notifyMany is not None:
+                notifyMany(deliveries[adapter])
+            else:
+                for notification in deliveries[adapter]:
+                    adapter.notify(notification)
+
+
+
+
+class _Batching(threading.local):
+    """
+    The Batch active in each thread.
+    """
+    batch = None
+
+_batching = _Batching()
+
+
+
+
  
 class MList(list, MObject):
     """
@@ -176,182 +1407,483 @@ class MList(list, MObject):
        
        eventType = MOVE_MANY
        notifier = The list object
-       oldValue = None
-       newValue = None
+       oldValue = The elements in their previous order
+       newValue = The elements in their new order
        position = A slice object for the entire list
+
+    Positions are always reported as non-negative indexes into the list,
+    so a notification carries everything needed to reverse it.
     """
-    def __init__(self, iterable=tuple(), container=None, containment=False, feature=None):
+    def __init__(self, iterable=tuple(), container=None, containment=False, feature=None,
+                 opposite=None):
         MObject.__init__(self)
         list.__init__(self, iterable)
+        self._mContainer = container
         self._container = container
         self._containment = containment
         self._feature = feature
+        self._opposite = opposite
+
+    def __reduce_ex__(self, protocol):
+        # The elements are restored with the rest of the state, as adding
+        # them to the copy would adopt them and notify
+        return type(self), (), (self.__dict__, list(self))
+
+    def __setstate__(self, state):
+        state, elements = state
+        self.__dict__.update(state)
+        list.extend(self, elements)
+
+    def mContents(self):
+        if not self._containment:
+            return []
+        return [v for v in self if isinstance(v, MObject)]
 
     def append(self, value):
+        if _validating:
+            self._mValidate(ADD, self._feature, value, None, len(self))
         list.append(self, value)
-        if isinstance(value, MObject) and self._container != None:
-            value._mContainer = self._container
-        self.mNotify(notifier=self,
-                     eventType="ADD",
-                     newValue=value,
-                     position=len(self)-1,
-                     feature=self._feature)
+        _adopt(self, value)
+        self.mNotify(ADD, self._feature, value, None, len(self)-1)
 
     def extend(self, values):
+        values = list(values)
+        if _validating:
+            self._mValidate(ADD_MANY, self._feature, values, None,
+                            slice(len(self), len(self)+len(values)-1))
         list.extend(self, values)
         for value in values:
-            if isinstance(value, MObject) and self._container != None:
-                value._mContainer = self._container
-        self.mNotify(notifier=self,
-                     eventType="ADD_MANY",
-                     newValue=values,
-                     position=slice(len(self)-len(values), len(self)-1),
-                     feature=self._feature)
+            _adopt(self, value)
+        self.mNotify(ADD_MANY, self._feature, values, None,
+                     slice(len(self)-len(values), len(self)-1))
 
     def insert(self, key, value):
-        list.append(self, value)
-        if isinstance(value, MObject) and self._container != None:
-            value._mContainer = self._container
-        self.mNotify(notifier=self,
-                     eventType="ADD",
-                     newValue=value,
-                     position=key,
-                     feature=self._feature)
+        # Clamp the position the way list.insert does
+        size = len(self)
+        if key < 0:
+            key = max(key + size, 0)
+        elif key > size:
+            key = size
+        if _validating:
+            self._mValidate(ADD, self._feature, value, None, key)
+        list.insert(self, key, value)
+        _adopt(self, value)
+        self.mNotify(ADD, self._feature, value, None, key)
     
-    def pop(self, key):
+    def pop(self, key=-1):
         try:
             oldValue = self[key]
         except IndexError:
             raise IndexError("pop index out of range")
-        if isinstance(oldValue, MObject) and self._container != None:
-            oldValue._mContainer = None
+        if key < 0:
+            key += len(self)
+        if _validating:
+            self._mValidate(REMOVE, self._feature, None, oldValue, key)
         list.pop(self, key)
-        self.mNotify(notifier=self,
-                     eventType="REMOVE",
-                     oldValue=oldValue,
-                     position=key,
-                     feature=self._feature)
+        _orphan(self, oldValue)
+        self.mNotify(REMOVE, self._feature, None, oldValue, key)
+        return oldValue
 
     def remove(self, value):
-        try:
-            position = self.index(value)
-        except IndexError:
-            position = None
-        if isinstance(value, MObject) and self._container != None:
-            value._mContainer = None
-        list.remove(self, value)
-        self.mNotify(notifier=self,
-                     eventType="REMOVE",
-                     oldValue=value,
-                     position=position,
-                     feature=self._feature)
+        position = self.index(value)
+        oldValue = list.__getitem__(self, position)
+        if _validating:
+            self._mValidate(REMOVE, self._feature, None, oldValue, position)
+        list.__delitem__(self, position)
+        _orphan(self, oldValue)
+        self.mNotify(REMOVE, self._feature, None, oldValue, position)
 
     def reverse(self):
+        oldValues = tuple(self)
+        if _validating:
+            self._mValidate(MOVE_MANY, self._feature, None, oldValues, slice(0, len(self)-1))
         list.reverse(self)
-        self.mNotify(notifier=self,
-                     eventType="MOVE_MANY",
-                     position=slice(0, len(self)-1),
-                     feature=self._feature)
-
-    def sort(self):
-        list.sort(self)
-        self.mNotify(notifier=self,
-                     eventType="MOVE_MANY",
-                     position=slice(0, len(self)-1),
-                     feature=self._feature)
+        self.mNotify(MOVE_MANY, self._feature, tuple(self), oldValues, slice(0, len(self)-1))
+
+    def sort(self, *args, **kw):
+        oldValues = tuple(self)
+        if _validating:
+            self._mValidate(MOVE_MANY, self._feature, None, oldValues, slice(0, len(self)-1))
+        list.sort(self, *args, **kw)
+        self.mNotify(MOVE_MANY, self._feature, tuple(self), oldValues, slice(0, len(self)-1))
 
     def __setslice__(self, i, j, values):
+        i, j = self._mClamp(i, j)
         oldValues = tuple(self[i:j])
+        values = list(values)
+        if _validating:
+            self._mValidate(SET_MANY, self._feature, values, oldValues, slice(i,j))
         list.__setslice__(self, i, j, values)
+        for oldValue in oldValues:
+            _orphan(self, oldValue)
         for value in values:
-            if isinstance(value, MObject) and self._container != None:
-                value._mContainer = self._container
-        self.mNotify(notifier=self,
-                     eventType="SET_MANY",
-                     newValue=values,
-                     oldValue=oldValues,
-                     position=slice(i,j),
-                     feature=self._feature)
+            _adopt(self, value)
+        self.mNotify(SET_MANY, self._feature, values, oldValues, slice(i,j))
 
     def __setitem__(self, key, value):
         try:
             oldValue = self[key]
         except IndexError:
             oldValue = None
+        if _validating:
+            self._mValidate(SET, self._feature, value, oldValue,
+                            key + len(self) if isinstance(key, (int, long)) and key < 0 else key)
         list.__setitem__(self, key, value)
-        if isinstance(value, MObject) and self._container != None:
-            value._mContainer = self._container
-        self.mNotify(notifier=self,
-                     eventType="SET",
-                     newValue=value,
-                     oldValue=oldValue,
-                     position=key,
-                     feature=self._feature)
-
-    def __delslice__(self, i, j, values):
+        if isinstance(key, (int, long)) and key < 0:
+            key += len(self)
+        _orphan(self, oldValue)
+        _adopt(self, value)
+        self.mNotify(SET, self._feature, value, oldValue, key)
+
+    def __delslice__(self, i, j):
+        i, j = self._mClamp(i, j)
         oldValues = tuple(self[i:j])
+        if _validating:
+            self._mValidate(REMOVE_MANY, self._feature, None, oldValues, slice(i,j))
+        list.__delslice__(self, i, j)
         for oldValue in oldValues:
-            if isinstance(oldValue, MObject) and self._container != None:
-                oldValue._mContainer = None
-        list.__setslice__(self, i, j, values)
-        self.mNotify(notifier=self,
-                     eventType="REMOVE_MANY",
-                     oldValue=oldValues,
-                     position=slice(i,j),
-                     feature=self._feature)
+            _orphan(self, oldValue)
+        self.mNotify(REMOVE_MANY, self._feature, None, oldValues, slice(i,j))
 
     def __delitem__(self, key):
         try:
             oldValue = self[key]
         except IndexError:
             oldValue = None
-        if isinstance(oldValue, MObject) and self._container != None:
-            oldValue._mContainer = None
+        if isinstance(key, (int, long)) and key < 0:
+            key += len(self)
+        if _validating:
+            self._mValidate(REMOVE, self._feature, None, oldValue, key)
         list.__delitem__(self, key)
-        self.mNotify(notifier=self,
-                     eventType="REMOVE",
-                     oldValue=oldValue,
-                     position=key,
-                     feature=self._feature)
+        _orphan(self, oldValue)
+        self.mNotify(REMOVE, self._feature, None, oldValue, key)
+
+    def __iadd__(self, values):
+        self.extend(values)
+        return self
+
+    def _mIndexOf(self, value):
+        """
+        Returns the position of value in the list, by identity, or -1.
+        """
+        for position, element in enumerate(self):
+            if element is value:
+                return position
+        return -1
+
+    def _mClamp(self, i, j):
+        """
+        Returns the bounds of a simple slice as indexes into the list.
+        """
+        size = len(self)
+        i = min(max(i, 0), size)
+        return i, min(max(j, i), size)
   
 
 
+class _Identity(object):
+    """
+    Stands for a value that can not be hashed, such as a MList, in the
+    index of a MUniqueList, comparing by identity.
+    """
+    __slots__ = ("value",)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __hash__(self):
+        return id(self.value)
+
+    def __eq__(self, other):
+        return type(other) is _Identity and other.value is self.value
+
+def _uniqueKey(value):
+    """
+    Returns the key of value in the index of a MUniqueList.
+    """
+    try:
+        hash(value)
+    except TypeError:
+        return _Identity(value)
+    return value
+
+class MUniqueList(MList):
+    """
+    A MList that holds each element at most once, like an ordered set.
+
+    Objects are compared by identity, and other values by equality, as
+    the keys of a dict are, except for values that can not be hashed,
+    which are compared by identity.  Elements are indexed, so that "in",
+    index, count, remove and the duplicate checks are O(1) rather than
+    scans of the list.  Adding an element that is already present through
+    append, insert or extend does nothing, and replacing elements with one
+    present elsewhere in the list raises ValueError.
+
+    The index also records a position for each element.  Positions are
+    only trusted below _mValid, which changes that shift elements lower.
+    A position above it is used if it still holds the element, and is
+    otherwise corrected by a search from _mValid, or by correcting all of
+    them once searching has cost as much.  Appending and removing at the
+    end of the list keep every position valid.
+
+    Containment features, and features with an opposite, use this class.
+    The notifications are the same as those of MList.
+    """
+    def __init__(self, iterable=tuple(), container=None, containment=False, feature=None,
+                 opposite=None):
+        index = {}
+        values = []
+        for value in iterable:
+            key = _uniqueKey(value)
+            if key not in index:
+                index[key] = len(values)
+                values.append(value)
+        MList.__init__(self, values, container, containment, feature, opposite)
+        self._mIndex = index
+        self._mValid = len(values)
+        self._mSearched = 0
+
+    def __contains__(self, value):
+        return _uniqueKey(value) in self._mIndex
+
+    def index(self, value, *args):
+        if args:
+            return MList.index(self, value, *args)
+        position = self._mIndexOf(value)
+        if position < 0:
+            raise ValueError("%r is not in list" % (value,))
+        return position
+
+    def count(self, value):
+        return 1 if _uniqueKey(value) in self._mIndex else 0
+
+    def append(self, value):
+        if _uniqueKey(value) in self._mIndex:
+            return
+        self._mAdding(len(self), (value,))
+        self._mChange(MList.append, value)
+
+    def extend(self, values):
+        index = self._mIndex
+        added = []
+        seen = set()
+        for value in values:
+            key = _uniqueKey(value)
+            if key not in index and key not in seen:
+                seen.add(key)
+                added.append(value)
+        self._mAdding(len(self), added)
+        self._mChange(MList.extend, added)
+
+    def insert(self, key, value):
+        if _uniqueKey(value) in self._mIndex:
+            return
+        size = len(self)
+        if key < 0:
+            key = max(key + size, 0)
+        elif key > size:
+            key = size
+        self._mAdding(key, (value,))
+        self._mChange(MList.insert, key, value)
+
+    def pop(self, key=-1):
+        if -len(self) <= key < len(self):
+            if key < 0:
+                key += len(self)
+            self._mRemoving(key, key + 1)
+        return self._mChange(MList.pop, key)
+
+    def remove(self, value):
+        self.__delitem__(self.index(value))
+
+    def reverse(self):
+        MList.reverse(self)
+        self._mValid = 0
+
+    def sort(self, *args, **kw):
+        MList.sort(self, *args, **kw)
+        self._mValid = 0
+
+    def __setslice__(self, i, j, values):
+        i, j = self._mClamp(i, j)
+        values = list(values)
+        replaced = set(map(_uniqueKey, list.__getslice__(self, i, j)))
+        keys = set()
+        for value in values:
+            key = _uniqueKey(value)
+            if (key in self._mIndex and key not in replaced) or key in keys:
+                raise ValueError("%r is already in the list" % (value,))
+            keys.add(key)
+        self._mRemoving(i, j)
+        self._mAdding(i, values)
+        self._mChange(MList.__setslice__, i, j, values)
+
+    def __setitem__(self, key, value):
+        if not isinstance(key, (int, long)):
+            MList.__setitem__(self, key, value)
+            self._mReindex()
+            return
+        oldValue = list.__getitem__(self, key)
+        oldKey, newKey = _uniqueKey(oldValue), _uniqueKey(value)
+        if newKey != oldKey:
+            if newKey in self._mIndex:
+                raise ValueError("%r is already in the list" % (value,))
+            if key < 0:
+                key += len(self)
+            del self._mIndex[oldKey]
+            self._mIndex[newKey] = key
+        self._mChange(MList.__setitem__, key, value)
+
+    def __delslice__(self, i, j):
+        i, j = self._mClamp(i, j)
+        self._mRemoving(i, j)
+        self._mChange(MList.__delslice__, i, j)
+
+    def __delitem__(self, key):
+        if not isinstance(key, (int, long)):
+            MList.__delitem__(self, key)
+            self._mReindex()
+            return
+        if -len(self) <= key < len(self):
+            if key < 0:
+                key += len(self)
+            self._mRemoving(key, key + 1)
+        self._mChange(MList.__delitem__, key)
+
+    def _mIndexOf(self, value):
+        key = _uniqueKey(value)
+        position = self._mIndex.get(key)
+        if position is None:
+            return -1
+        if position < self._mValid:
+            return position
+        if position < len(self) and _uniqueKey(list.__getitem__(self, position)) == key:
+            return position
+        # The element has moved down; look for it from the first position
+        # that may be stale, unless searching has already cost as much as
+        # correcting every stale position would
+        start = self._mValid
+        position = list.index(self, value, start)
+        self._mSearched += position - start
+        if (_uniqueKey(list.__getitem__(self, position)) != key or
+            self._mSearched > len(self) - start):
+            self._mReindex(start)
+            return self._mIndex[key]
+        self._mIndex[key] = position
+        return position
+
+    def _mChange(self, change, *args):
+        """
+        Makes a change, with a MList method, for which the index has been
+        updated, correcting the index if the change is rejected.
+        """
+        try:
+            return change(self, *args)
+        except:
+            self._mReindex()
+            raise
+
+    def _mAdding(self, position, values):
+        """
+        Indexes values that are about to be inserted at position.
+        """
+        if position < self._mValid:
+            self._mValid = position
+        elif position == self._mValid == len(self):
+            self._mValid += len(values)
+        index = self._mIndex
+        for value in values:
+            index[_uniqueKey(value)] = position
+            position += 1
+
+    def _mRemoving(self, i, j):
+        """
+        Unindexes the elements between i and j, which are about to be
+        removed.
+        """
+        index = self._mIndex
+        for value in list.__getslice__(self, i, j):
+            del index[_uniqueKey(value)]
+        if i < self._mValid:
+            self._mValid = i
+
+    def __setstate__(self, state):
+        MList.__setstate__(self, state)
+        self._mReindex()
+
+    def _mReindex(self, start=0):
+        """
+        Corrects the positions of the elements from start on.
+        """
+        size = len(self)
+        if not start:
+            self._mIndex = {}
+        self._mIndex.update(zip(map(_uniqueKey, list.__getslice__(self, start, size)),
+                                xrange(start, size)))
+        self._mValid = size
+        self._mSearched = 0
+
+
+
+
 class MDict(dict, MObject):
     """
     A dict object that provides notifications.
     
     For _MANY notifications, the oldValue and newValues are returned
     as a list of [(key, value)] paris, similar to .items()
+
+    Adding a key that was not present produces ADD rather than SET, so
+    that a notification carries everything needed to reverse it.
     """
     def __init__(self, arg=tuple(), container=None, containment=False, feature=None):
         MObject.__init__(self)
         dict.__init__(self, arg)
+        self._mContainer = container
         self._container = container
         self._containment = containment
         self._feature = feature
+        self._opposite = None
+
+    def __reduce_ex__(self, protocol):
+        # As for MList
+        return type(self), (), (self.__dict__, dict(self))
+
+    def __setstate__(self, state):
+        state, elements = state
+        self.__dict__.update(state)
+        dict.update(self, elements)
+
+    def mContents(self):
+        if not self._containment:
+            return []
+        return [v for v in self.itervalues() if isinstance(v, MObject)]
 
     def __setitem__(self, key, value):
-        oldValue = self.get(key, None)
+        if key not in self:
+            if _validating:
+                self._mValidate(ADD, self._feature, value, None, key)
+            dict.__setitem__(self, key, value)
+            _adopt(self, value)
+            self.mNotify(ADD, self._feature, value, None, key)
+            return
+        oldValue = dict.__getitem__(self, key)
+        if _validating:
+            self._mValidate(SET, self._feature, value, oldValue, key)
         dict.__setitem__(self, key, value)
-        if isinstance(value, MObject) and self._container != None:
-            value._mContainer = self._container
-        self.mNotify(notifier=self,
-                     eventType="SET",
-                     newValue=value,
-                     oldValue=oldValue,
-                     position=key)
+        _orphan(self, oldValue)
+        _adopt(self, value)
+        self.mNotify(SET, self._feature, value, oldValue, key)
         
-    def setdefault(self, key, value):
-        oldValue = self.get(key, None)
-        newValue = dict.setdefault(self, key, value)
-        if isinstance(newValue, MObject) and self._container != None:
-            newValue._mContainer = self._container
-        self.mNotify(notifier=self,
-                     eventType="SET",
-                     newValue=newValue,
-                     oldValue=oldValue,
-                     position=key)
-        return newValue
+    def setdefault(self, key, value=None):
+        if key in self:
+            return dict.__getitem__(self, key)
+        if _validating:
+            self._mValidate(ADD, self._feature, value, None, key)
+        dict.__setitem__(self, key, value)
+        _adopt(self, value)
+        self.mNotify(ADD, self._feature, value, None, key)
+        return value
 
     def update(self, *args, **kw):
         newValues = {}
@@ -362,65 +1894,58 @@ class MDict(dict, MObject):
         oldValues = {}
         for k in newValues.keys():
             try:
-                oldValues[k, self[k]]
+                oldValues[k] = self[k]
             except KeyError:
                 pass
+        if _validating:
+            self._mValidate(SET_MANY, self._feature,
+                            newValues.items(), oldValues.items(), newValues.keys())
         for oldValue in oldValues.values():
-            if isinstance(oldValue, MObject) and self._container != None:
-                oldValue._mContainer = None
+            _orphan(self, oldValue)
         dict.update(self, *args, **kw)
         for newValue in newValues.values():
-            if isinstance(newValue, MObject) and self._container != None:
-                newValue._mContainer = self._container
-        self.mNotify(notifier=self,
-                     eventType="SET_MANY",
-                     newValue=newValues.items(),
-                     oldValue=oldValues.items(),
-                     position=newValues.keys())
+            _adopt(self, newValue)
+        self.mNotify(SET_MANY, self._feature,
+                     newValues.items(), oldValues.items(), newValues.keys())
         
     def pop(self, key, default=None):
-        oldValue = self.get(key, None)
-        v = dict.pop(self, key, default)
-        if isinstance(oldValue, MObject) and self._container != None:
-            oldValue._mContainer = None
-        self.mNotify(notifier=self,
-                     eventType="REMOVE",
-                     oldValue=oldValue,
-                     position=key)
-        return v
+        if key not in self:
+            return default
+        if _validating:
+            self._mValidate(REMOVE, self._feature, None, dict.__getitem__(self, key), key)
+        oldValue = dict.pop(self, key)
+        _orphan(self, oldValue)
+        self.mNotify(REMOVE, self._feature, None, oldValue, key)
+        return oldValue
         
     def popitem(self):
-        oldValue = dict.popitem(self)
-        if isinstance(oldValue, MObject) and self._container != None:
-            oldValue._mContainer = None
-        self.mNotify(notifier=self,
-                     eventType="REMOVE",
-                     oldValue=oldValue[1],
-                     position=oldValue[0])
+        if _validating and self:
+            key = next(self.iterkeys())
+            self._mValidate(REMOVE, self._feature, None, dict.__getitem__(self, key), key)
+            oldValue = (key, dict.pop(self, key))
+        else:
+            oldValue = dict.popitem(self)
+        _orphan(self, oldValue[1])
+        self.mNotify(REMOVE, self._feature, None, oldValue[1], oldValue[0])
         return oldValue
 
     def __delitem__(self, key):
         oldValue = self.get(key, None)
+        if _validating and key in self:
+            self._mValidate(REMOVE, self._feature, None, oldValue, key)
         dict.__delitem__(self, key)
-        if isinstance(oldValue, MObject) and self._container != None:
-            oldValue._mContainer = None
-        self.mNotify(notifier=self,
-                     eventType="REMOVE",
-                     oldValue=oldValue,
-                     position=key)
+        _orphan(self, oldValue)
+        self.mNotify(REMOVE, self._feature, None, oldValue, key)
 
     def clear(self):
         oldValues = self.items()
         oldKeys = self.keys()
+        if _validating:
+            self._mValidate(REMOVE_MANY, self._feature, None, oldValues, oldKeys)
         dict.clear(self)
-        for oldValue in oldValues.values():
-            if isinstance(oldValue, MObject) and self._container != None:
-                oldValue._mContainer = None
-        self.mNotify(notifier=self,
-                     eventType="REMOVE_MANY",
-                     oldValue=oldValues,
-                     position=oldKeys,
-                     feature=self._feature)
+        for key, oldValue in oldValues:
+            _orphan(self, oldValue)
+        self.mNotify(REMOVE_MANY, self._feature, None, oldValues, oldKeys)
 
 
 
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+"""
+Derived features, computed from other features and cached until one of
+them changes.
+
+    class PurchaseOrder(MObject):
+        items = ListFeature(containment=True)
+        total = Derived(lambda po: sum(item.price for item in po.items))
+
+    po.total        # computed, and remembered
+    po.total        # the remembered value
+    po.items[0].price = 5
+    po.total        # computed again
+
+The function is run against read-tracking proxies (see ReadTracker), so
+the features it reads, of any object, are known.  The value is forgotten
+when one of those, and nothing else, notifies a change; it is computed
+again on the next read.  Derived features may read other derived
+features, and may be read by the condition of a Query, which then depend
+on whatever the derived feature read.
+"""
+from core import *
+from query import ReadTracker, _Watcher, _readOf, _unwrap
+
+class Derived(object):
+    """
+    A read-only feature whose value is function(obj).
+
+    The value is returned as function returned it, so a derived feature
+    that is a list should be treated as read-only too.  Nothing is cached
+    if function raises.  Changes to derived values are not notified.
+    """
+    def __init__(self, function):
+        self.function = function
+
+    def __get__(self, obj, cls):
+        if obj is None:
+            return self
+        memo = getattr(obj, "_mMemo", None)
+        if memo is None:
+            memo = obj._mMemo = _Memo()
+        entry = memo.values.get(self)
+        if entry is None:
+            tracker = ReadTracker()
+            value = _unwrap(tracker.run(self.function, tracker.wrap(obj)))
+            entry = (value, tracker.reads)
+            memo.remember(self, entry)
+        ReadTracker.include(entry[1])
+        return entry[0]
+
+    def __set__(self, obj, value):
+        raise AttributeError("derived features can not be set")
+
+    def invalidate(self, obj):
+        """
+        Forgets the value of this feature for obj, if it has one.
+        """
+        memo = getattr(obj, "_mMemo", None)
+        if memo is not None:
+            memo.forget(self)
+
+
+
+
+class _Memo(object):
+    """
+    The cached derived values of one object.  It does not refer to the
+    object, so the objects it depends on do not keep it alive.
+    """
+    def __init__(self):
+        # Maps each Derived to (value, reads)
+        self.values = {}
+        # Maps each read feature to the Derived that read it
+        self._dependents = {}
+        self._watcher = _Watcher(self._changed, first=True)
+
+    def remember(self, derived, entry):
+        self.values[derived] = entry
+        for read, source in entry[1].items():
+            self._dependents.setdefault(read, set()).add(derived)
+            self._watcher.hold(source)
+
+    def forget(self, derived):
+        entry = self.values.pop(derived, None)
+        if entry is None:
+            return
+        for read, source in entry[1].items():
+            dependents = self._dependents[read]
+            dependents.discard(derived)
+            if not dependents:
+                del self._dependents[read]
+            self._watcher.release(source)
+
+    def _changed(self, notification):
+        dependents = self._dependents.get(_readOf(notification))
+        if dependents:
+            for derived in list(dependents):
+                self.forget(derived)
@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+"""
+Transactional editing of a model shared between threads.
+
+An EditingDomain guards the model under a containment root with a
+read/write lock.  Any number of threads may read at once, but changes
+are made in a write transaction, which has the model to itself and is
+rolled back if it fails:
+
+    domain = EditingDomain(po)
+
+    with domain.read():
+        total = sum(item.price for item in po.items)
+
+    with domain.transaction("Add item"):
+        po.items.append(item)
+        item.upc = upc      # if this raises, the item is removed again
+
+Rollback replays the inverse of the changes recorded from the
+notifications of the model, so nothing is copied up front.
+"""
+import threading
+
+from core import *
+from core import _batching
+from adapters import ChangeRecorder
+
+class ReadWriteLock(object):
+    """
+    A lock that is held either by any number of readers or by a single
+    writer.
+
+    Both sides are reentrant, and the writer may also take the read lock.
+    Waiting writers are given precedence over new readers so that a steady
+    stream of readers can not starve them.  A reader can not upgrade to
+    the write lock.
+    """
+    def __init__(self):
+        self._condition = threading.Condition(threading.Lock())
+        self._readers = {}
+        self._writer = None
+        self._writes = 0
+        self._waitingWriters = 0
+
+    def acquireRead(self):
+        me = threading.current_thread()
+        with self._condition:
+            if self._writer is me or me in self._readers:
+                self._readers[me] = self._readers.get(me, 0) + 1
+                return
+            while self._writer is not None or self._waitingWriters:
+                self._condition.wait()
+            self._readers[me] = 1
+
+    def releaseRead(self):
+        me = threading.current_thread()
+        with self._condition:
+            count = self._readers[me] - 1
+            if count:
+                self._readers[me] = count
+            else:
+                del self._readers[me]
+                if not self._readers:
+                    self._condition.notify_all()
+
+    def acquireWrite(self):
+        me = threading.current_thread()
+        with self._condition:
+            if self._writer is me:
+                self._writes += 1
+                return
+            if me in self._readers:
+                raise RuntimeError("can not upgrade a read lock to a write lock")
+            self._waitingWriters += 1
+            try:
+                while self._writer is not None or self._readers:
+                    self._condition.wait()
+            finally:
+                self._waitingWriters -= 1
+            self._writer = me
+            self._writes = 1
+
+    def releaseWrite(self):
+        with self._condition:
+            self._writes -= 1
+            if not self._writes:
+                self._writer = None
+                self._condition.notify_all()
+
+    def isWriter(self):
+        """
+        Returns True if the current thread holds the write lock.
+        """
+        return self._writer is threading.current_thread()
+
+    def read(self):
+        """
+        Returns a context manager that holds the read lock.
+        """
+        return _Holding(self.acquireRead, self.releaseRead)
+
+    def write(self):
+        """
+        Returns a context manager that holds the write lock.
+        """
+        return _Holding(self.acquireWrite, self.releaseWrite)
+
+
+
+
+class _Holding(object):
+    """
+    Holds one side of a ReadWriteLock for the duration of a with block.
+    """
+    __slots__ = ("acquire", "release")
+
+    def __init__(self, acquire, release):
+        self.acquire = acquire
+        self.release = release
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.release()
+        return False
+
+
+
+
+class EditingDomain(object):
+    """
+    Serializes the editing of the model contained by root.
+
+    Changes to the model must be made within a transaction; a change made
+    anywhere else raises RuntimeError, after the fact, from the thread
+    that made it.  Readers take the read lock and must not change the
+    model.  A Batch may be used within a transaction, but not around one.
+
+    The changes of committed transactions are kept for undo and redo up to
+    maxChanges, which by default keeps none, so that only the transaction
+    in progress is held in memory.
+    """
+    def __init__(self, root, maxChanges=0):
+        self.root = root
+        self.lock = ReadWriteLock()
+        self.recorder = _DomainRecorder(self, maxChanges)
+        root.mAddContentAdapter(self.recorder)
+
+    def dispose(self):
+        """
+        Stops guarding the model.
+        """
+        self.root.mRemoveContentAdapter(self.recorder)
+
+    def read(self):
+        """
+        Returns a context manager that holds the read lock.
+        """
+        return self.lock.read()
+
+    def transaction(self, label=None):
+        """
+        Returns a Transaction, to be used as a context manager, within which
+        the model may be changed.
+        """
+        return Transaction(self, label)
+
+    def undo(self):
+        """
+        Reverts the most recent committed transaction.
+        """
+        with self.lock.write():
+            self.recorder.undo()
+
+    def redo(self):
+        """
+        Reapplies the most recently undone transaction.
+        """
+        with self.lock.write():
+            self.recorder.redo()
+
+
+
+
+class Transaction(object):
+    """
+    Holds the write lock of an EditingDomain, and records the changes made
+    until it exits.  If it exits with an exception the changes are
+    reverted, otherwise they are committed as one command of the domain.
+
+    Transactions nest.  A nested transaction that fails only reverts its
+    own changes; the enclosing transaction decides whether to go on.
+
+    The changes made within a transaction are delivered as they are made,
+    one by one, unless they are made within a Batch; the changes reverting
+    them are delivered together, through notifyMany.  A transaction can not
+    be opened within a Batch, which would hold back the changes it has to
+    record until after it has exited.
+    """
+    def __init__(self, domain, label=None):
+        self.domain = domain
+        self.label = label
+        self._mark = None
+
+    def __enter__(self):
+        if _batching.batch is not None:
+            raise RuntimeError("can not open a transaction within a Batch")
+        self.domain.lock.acquireWrite()
+        recorder = self.domain.recorder
+        recorder.beginCompound(self.label)
+        self._mark = recorder.mark()
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        recorder = self.domain.recorder
+        try:
+            if excType is not None:
+                recorder.rollback(self._mark)
+            recorder.endCompound()
+        finally:
+            self.domain.lock.releaseWrite()
+        return False
+
+
+
+
+class _DomainRecorder(ChangeRecorder):
+    """
+    The ChangeRecorder of an EditingDomain, which also rejects changes made
+    outside of a transaction before they are made.
+    """
+    def __init__(self, domain, maxChanges):
+        ChangeRecorder.__init__(self, maxChanges)
+        self.domain = domain
+
+    def validate(self, notification):
+        if not self._inTransaction() and not self._replaying:
+            raise RuntimeError("%r changed outside of a transaction" % notification)
+
+    def notify(self, notification):
+        if self._inTransaction():
+            ChangeRecorder.notify(self, notification)
+
+    def _inTransaction(self):
+        return self.domain.lock.isWriter() and self._compound is not None
@@ -0,0 +1,280 @@
+#!/usr/bin/env python
+"""
+An append-only journal of the changes made to a containment tree, for
+recovering the changes made since the tree was last saved.
+
+    resource = Resource("orders.json", po)
+    resource.save()
+    journal = Journal(resource, "orders.journal")
+    po.mAddContentAdapter(journal)
+    ...
+    journal.checkpoint()            # saves the tree and empties the journal
+
+and after a crash:
+
+    resource = Resource("orders.json")
+    po = replay(resource, "orders.journal")
+
+The journal holds one JSON array per line.  The first line identifies the
+saved tree the journal follows, and every other line is either a change,
+given by the number of the object that changed (see Resource), the name
+of its feature, the event type, the position in a list or dict feature,
+and the new value:
+
+    [12, "items", "ADD", 3, {"$oid": 40}]
+    [40, "price", "SET", 4]
+
+or the state of the objects that a change is about to bring into the
+tree, or to refer to, as the records of a Resource delta:
+
+    ["put", [[40, "orders.Item", {"upc": "A-7", "price": 3}]]]
+
+Lines are flushed to the file as they are written, but only forced to
+disk every syncEvery changes, by sync, or when the journal is closed; a
+line cut short by a crash is ignored by replay.
+"""
+import json
+import os
+import weakref
+import zlib
+
+import core
+from core import *
+from adapters import NotificationAdapter, _contentChanges, _contentTree, _redoChange
+from resources import _DeltaWriter, _Loader, _isObject, _key
+
+class Journal(NotificationAdapter):
+    """
+    An adapter that appends every change of the content of its target to
+    a journal file.  It is added as a content adapter of the root of a
+    resource, once the resource has been saved or loaded, or the journal
+    has been replayed.  While a journal is kept, the resource should only
+    be saved by checkpoint.
+
+    A journal that already follows the saved tree is appended to, and any
+    other is replaced.
+    """
+    def __init__(self, resource, path, syncEvery=64):
+        NotificationAdapter.__init__(self)
+        self.resource = resource
+        self.path = path
+        self.syncEvery = syncEvery
+        self._unsynced = 0
+        self._encoder = _Encoder(resource.root, resource._nextOid, resource._numbered)
+        if _follows(path, _checksum(resource.path)):
+            self._stream = open(path, "ab")
+        else:
+            self._start()
+
+    def notify(self, notification):
+        self._write(notification)
+        if self._unsynced >= self.syncEvery:
+            self.sync()
+
+    def notifyMany(self, notifications):
+        for notification in notifications:
+            self._write(notification)
+        if self._unsynced >= self.syncEvery:
+            self.sync()
+
+    def sync(self):
+        """
+        Forces the changes written so far to disk.
+        """
+        self._stream.flush()
+        os.fsync(self._stream.fileno())
+        self._unsynced = 0
+
+    def checkpoint(self):
+        """
+        Saves the whole tree to the resource and starts an empty journal.
+        If this is interrupted, replay finds the journal older than the
+        tree and ignores it.
+        """
+        self.sync()
+        self.resource.save()
+        self._stream.close()
+        self._encoder = _Encoder(self.resource.root, self.resource._nextOid,
+                                 self.resource._numbered)
+        self._start()
+
+    def close(self):
+        """
+        Forces the journal to disk and closes it.
+        """
+        self.sync()
+        self._stream.close()
+
+    def _start(self):
+        temporary = self.path + ".tmp"
+        with open(temporary, "wb") as stream:
+            stream.write(json.dumps(["base", _checksum(self.resource.path)]) + "\n")
+            stream.flush()
+            os.fsync(stream.fileno())
+        os.rename(temporary, self.path)
+        self._stream = open(self.path, "ab")
+
+    def _write(self, notification):
+        encoder = self._encoder
+        notifier = notification.notifier
+        eventType = notification.eventType
+        if isinstance(notifier, (MList, MDict)):
+            obj = notifier._container
+        else:
+            obj = notifier
+        if not encoder._known(obj):
+            # Not known to the journal yet, so its state is written instead
+            encoder.pending.append(obj)
+            self._put()
+            return
+        changes = _contentChanges(notification)
+        if changes is not None:
+            # Whatever enters the tree is written in full, as it may have
+            # changed while it was out of it
+            for value in changes[1]:
+                for content in _contentTree(value):
+                    if _isObject(content):
+                        encoder._oid(content)
+                        encoder.pending.append(content)
+        change = [obj._mOid, notification.feature.rpartition(".")[2], eventType]
+        position = notification.position
+        newValue = notification.newValue
+        if isinstance(notifier, MList):
+            change.append(position.start if isinstance(position, slice) else position)
+        elif isinstance(notifier, MDict):
+            change.append(None if eventType == REMOVE_MANY else encoder._encode(position))
+            if eventType == SET_MANY:
+                newValue = dict(newValue)
+        change.append(encoder._encode(newValue))
+        if isinstance(notifier, MList) and eventType in (REMOVE_MANY, SET_MANY):
+            change.append(len(notification.oldValue))
+        self._put()
+        self._stream.write(encoder.encoder.encode(change) + "\n")
+        self._unsynced += 1
+
+    def _put(self):
+        """
+        Writes the state of the objects the next change needs.
+        """
+        encoder = self._encoder
+        records = []
+        written = set()
+        while encoder.pending:
+            obj = encoder.pending.pop()
+            if id(obj) not in written:
+                written.add(id(obj))
+                cls = type(obj)
+                records.append([encoder._oid(obj), cls.__module__ + "." + cls.__name__,
+                                encoder._features(obj)])
+        encoder.new.clear()
+        if records:
+            self._stream.write(encoder.encoder.encode(["put", records]) + "\n")
+            self._unsynced += 1
+
+
+
+
+class _Encoder(_DeltaWriter):
+    """
+    Encodes values as a delta would, numbering the objects new to the
+    journal, which are kept in pending until their state is written.
+    """
+    def __init__(self, root, nextOid, table):
+        _DeltaWriter.__init__(self, root, None, None, nextOid, table)
+        self.pending = []
+
+    def _reference(self, obj):
+        if not self._known(obj):
+            self.pending.append(obj)
+        return {"$oid": self._oid(obj)}
+
+
+
+
+def replay(resource, path):
+    """
+    Loads the tree saved by resource and applies the changes in the
+    journal at path to it, reading the journal a line at a time, and
+    returns its root.  A journal older than the saved tree is ignored.
+    A line cut short at the end of the journal is removed from it, so
+    that the journal can be continued.
+    """
+    root = resource.load()
+    if not _follows(path, _checksum(resource.path)):
+        return root
+    loader = _Loader()
+    loader.root = root
+    loader.table = dict(resource._numbered.items())
+    loader.nextOid = resource._nextOid
+    # Both sides of opposite features were journaled, so they are not
+    # synced again
+    batch, core._batching.batch = core._batching.batch, None
+    suspended, core._opposites.suspended = core._opposites.suspended, True
+    try:
+        with open(path, "rb") as stream:
+            end = len(stream.readline())
+            for line in stream:
+                if not line.endswith("\n"):
+                    break
+                _apply(loader, json.loads(line))
+                end += len(line)
+    finally:
+        core._opposites.suspended = suspended
+        core._batching.batch = batch
+    if os.path.getsize(path) != end:
+        with open(path, "r+b") as stream:
+            stream.truncate(end)
+    resource._nextOid = loader.nextOid
+    resource._numbered = weakref.WeakValueDictionary(loader.table)
+    return root
+
+def _apply(loader, entry):
+    if entry[0] == "put":
+        loader._applyDelta(entry[1])
+        return
+    obj = loader.table.get(entry[0])
+    if obj is None:
+        raise ValueError("object %r is not in the journal" % (entry[0],))
+    name = str(entry[1])
+    eventType = EVENT_TYPES[entry[2]]
+    newValue = loader._value(entry[-1] if len(entry) < 6 else entry[4], [None], 0)
+    loader._resolveDeferred()
+    target = obj
+    position = oldValue = None
+    if len(entry) > 4:
+        target = getattr(obj, name)
+        position = entry[3]
+        if isinstance(target, MDict):
+            position = _key(position)
+        elif eventType in (ADD_MANY, REMOVE_MANY, SET_MANY):
+            if len(entry) > 5:
+                oldValue = tuple(target[position:position + entry[5]])
+            position = slice(position, None)
+        elif eventType == MOVE_MANY:
+            oldValue = tuple(target)
+    _redoChange((target, eventType, position, oldValue, newValue, name))
+
+def _checksum(path):
+    """
+    Returns the CRC-32 of the file at path, read a chunk at a time.
+    """
+    crc = 0
+    with open(path, "rb") as stream:
+        for chunk in iter(lambda: stream.read(1 << 16), ""):
+            crc = zlib.crc32(chunk, crc)
+    return crc
+
+def _follows(path, checksum):
+    """
+    Returns True if the journal at path follows the saved tree whose
+    checksum is given.
+    """
+    try:
+        with open(path, "rb") as stream:
+            line = stream.readline()
+    except IOError:
+        return False
+    try:
+        return json.loads(line) == ["base", checksum]
+    except ValueError:
+        return False
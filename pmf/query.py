@@ -0,0 +1,317 @@
+#!/usr/bin/env python
+"""
+Queries over a model whose results are kept up to date as it changes.
+
+A Query selects the instances of a class, contained by the object it is
+added to, that satisfy a condition:
+
+    damaged = Query(Item, lambda item: item.tags.get("condition") == "damaged"
+                                       and item.mContainer().shipTo.state == "X")
+    root.mAddContentAdapter(damaged)
+
+    damaged.matches                          # the matching Items
+    damaged.matches.mAddAdapter(NotificationAdapter(callback))
+
+The condition is run against read-tracking proxies, which record every
+feature it reads, of any object.  When one of those features changes only
+the candidates that read it are evaluated again, and when content is
+added or removed only that content is visited, so a query is never
+answered by scanning the model.  Matches coming and going are ADD and
+REMOVE notifications of the matches list.
+"""
+import threading
+
+from core import *
+from adapters import NotificationAdapter, _contentChanges, _contentTree, _isContained
+
+class ReadTracker(object):
+    """
+    Hands out read-only proxies of MObjects, MLists and MDicts that record
+    the features read through them, and through the values they return,
+    in reads.
+
+    reads maps (id(obj), name) to obj for each feature read, where name is
+    None for the contents of a MList or MDict.  Reading a private
+    attribute, or calling a method, is not recorded, although the values
+    returned by methods are proxied.  Proxies compare equal to the object
+    they stand for, but are not identical to it.
+
+    While a function is run by a tracker, reads reported with include are
+    recorded by it as well, which is how the reads behind a cached value
+    are charged to whatever reads the value.
+    """
+    def __init__(self):
+        self.reads = {}
+
+    def read(self, obj, name):
+        self.reads[(id(obj), name)] = obj
+
+    def run(self, function, *args):
+        """
+        Calls function with args while this tracker is active.
+        """
+        outer = _active.trackers
+        _active.trackers = outer + (self,)
+        try:
+            return function(*args)
+        finally:
+            _active.trackers = outer
+
+    @staticmethod
+    def include(reads):
+        """
+        Records reads in every tracker active in this thread.
+        """
+        for tracker in _active.trackers:
+            tracker.reads.update(reads)
+
+    def wrap(self, value):
+        if isinstance(value, (MList, MDict)):
+            return _CollectionProxy(value, self)
+        if isinstance(value, MObject):
+            return _ObjectProxy(value, self)
+        if type(value) in (list, tuple):
+            return type(value)(self.wrap(v) for v in value)
+        return value
+
+    def call(self, function):
+        """
+        Returns function wrapped so that its arguments are unwrapped and
+        its result is proxied.
+        """
+        def tracked(*args, **kw):
+            return self.wrap(function(*[_unwrap(a) for a in args], **kw))
+        return tracked
+
+class _Active(threading.local):
+    trackers = ()
+
+_active = _Active()
+
+def _unwrap(value):
+    """
+    Returns the object behind a proxy, or value if it is not one.  The
+    items of a list or tuple are unwrapped as well.
+    """
+    if isinstance(value, (_ObjectProxy, _CollectionProxy)):
+        return value._mObj
+    if type(value) in (list, tuple):
+        return type(value)(_unwrap(v) for v in value)
+    return value
+
+def _readOf(notification):
+    """
+    Returns the read, as recorded by a ReadTracker, that a notification
+    reports has changed, or None.
+    """
+    notifier = notification.notifier
+    if isinstance(notifier, (MList, MDict)):
+        return (id(notifier), None)
+    if notification.feature:
+        return (id(notifier), notification.feature.rpartition(".")[2])
+    return None
+
+
+
+
+class _Proxy(object):
+    __slots__ = ("_mObj", "_mTracker")
+
+    def __init__(self, obj, tracker):
+        object.__setattr__(self, "_mObj", obj)
+        object.__setattr__(self, "_mTracker", tracker)
+
+    def __setattr__(self, key, value):
+        raise AttributeError("'%s' is read only here" % key)
+
+    def __eq__(self, other):
+        return self._mObj == _unwrap(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return repr(self._mObj)
+
+class _ObjectProxy(_Proxy):
+    __slots__ = ()
+
+    def __getattr__(self, key):
+        obj = self._mObj
+        value = getattr(obj, key)
+        if key[:1] == "_":
+            return value
+        if callable(value) and not isinstance(value, MObject):
+            return self._mTracker.call(value)
+        self._mTracker.read(obj, key)
+        return self._mTracker.wrap(value)
+
+    def __hash__(self):
+        return hash(self._mObj)
+
+class _CollectionProxy(_Proxy):
+    __slots__ = ()
+
+    def _mRead(self):
+        self._mTracker.read(self._mObj, None)
+        return self._mObj
+
+    def __getattr__(self, key):
+        value = getattr(self._mRead(), key)
+        if callable(value):
+            return self._mTracker.call(value)
+        return value
+
+    def __len__(self):
+        return len(self._mRead())
+
+    def __iter__(self):
+        wrap = self._mTracker.wrap
+        return (wrap(v) for v in self._mRead())
+
+    def __contains__(self, value):
+        return _unwrap(value) in self._mRead()
+
+    def __getitem__(self, key):
+        return self._mTracker.wrap(self._mRead()[_unwrap(key)])
+
+    def __getslice__(self, i, j):
+        return self._mTracker.wrap(self._mRead()[i:j])
+
+    __hash__ = None
+
+
+
+
+class Query(NotificationAdapter):
+    """
+    An adapter that maintains, in matches, the instances of cls contained
+    by its target for which condition returns true.  It is added as a
+    content adapter.
+
+    condition is called with a read-tracking proxy of each candidate, see
+    ReadTracker.  A condition that raises AttributeError, KeyError,
+    IndexError or TypeError, for example by navigating through None, does
+    not match.  The container of a candidate is only evaluated again when
+    the candidate itself is moved.
+    """
+    def __init__(self, cls, condition):
+        NotificationAdapter.__init__(self)
+        self.cls = cls
+        self.condition = condition
+        self.matches = MUniqueList(feature="Query.matches")
+        # Maps the id of each candidate to [candidate, reads]
+        self._candidates = {}
+        # Maps each read feature to the candidates that read it, by id
+        self._dependents = {}
+        self._watcher = _Watcher(self._changed)
+
+    def setTarget(self, target):
+        if self.target is not None:
+            for obj, reads in list(self._candidates.values()):
+                self._drop(obj)
+        super(Query, self).setTarget(target)
+        if target is not None:
+            self._visit(target)
+    target = property(fset=setTarget, fget=NotificationAdapter.getTarget)
+
+    def notify(self, notification):
+        changes = _contentChanges(notification)
+        if changes is None:
+            return
+        removed, added = changes
+        for value in removed:
+            if isinstance(value, MObject) and not _isContained(value, self.target):
+                for obj in _contentTree(value):
+                    self._drop(obj)
+        for value in added:
+            self._visit(value)
+
+    def _visit(self, value):
+        """
+        Evaluates the candidates among value and its content.
+        """
+        for obj in _contentTree(value):
+            if isinstance(obj, self.cls) and not isinstance(obj, (MList, MDict)):
+                self._evaluate(obj)
+
+    def _changed(self, notification):
+        """
+        Evaluates again the candidates that read what a notification
+        reports has changed.
+        """
+        dependents = self._dependents.get(_readOf(notification))
+        if dependents:
+            for obj in list(dependents.values()):
+                if id(obj) in self._candidates:
+                    self._evaluate(obj)
+
+    def _evaluate(self, obj):
+        tracker = ReadTracker()
+        try:
+            matched = bool(tracker.run(self.condition, tracker.wrap(obj)))
+        except (AttributeError, KeyError, IndexError, TypeError):
+            matched = False
+        entry = self._candidates.get(id(obj))
+        self._depend(obj, entry[1] if entry else {}, tracker.reads)
+        self._candidates[id(obj)] = [obj, tracker.reads]
+        if matched:
+            self.matches.append(obj)
+        elif obj in self.matches:
+            self.matches.remove(obj)
+
+    def _drop(self, obj):
+        entry = self._candidates.pop(id(obj), None)
+        if entry is not None:
+            self._depend(obj, entry[1], {})
+            if obj in self.matches:
+                self.matches.remove(obj)
+
+    def _depend(self, obj, oldReads, newReads):
+        """
+        Moves the dependencies of a candidate from oldReads to newReads.
+        """
+        for read, source in oldReads.items():
+            if read not in newReads:
+                dependents = self._dependents[read]
+                del dependents[id(obj)]
+                if not dependents:
+                    del self._dependents[read]
+                self._watcher.release(source)
+        for read, source in newReads.items():
+            if read not in oldReads:
+                self._dependents.setdefault(read, {})[id(obj)] = obj
+                self._watcher.hold(source)
+
+
+
+
+class _Watcher(NotificationAdapter):
+    """
+    The adapter added to every object whose features something depends on,
+    such as the condition of a Query.  It is held once for each feature
+    read, and is removed from the object when the last is released.
+
+    Watchers that invalidate cached values are created with first set, so
+    that they are notified before anything that might read those values,
+    and as each change is made inside a Batch.
+    """
+    def __init__(self, callback, first=False):
+        NotificationAdapter.__init__(self, callback)
+        self.mFirst = first
+        self._held = {}
+
+    def hold(self, obj):
+        entry = self._held.get(id(obj))
+        if entry is None:
+            self._held[id(obj)] = [obj, 1]
+            obj.mAddAdapter(self)
+        else:
+            entry[1] += 1
+
+    def release(self, obj):
+        entry = self._held[id(obj)]
+        entry[1] -= 1
+        if not entry[1]:
+            del self._held[id(obj)]
+            obj.mRemoveAdapter(self)
@@ -0,0 +1,745 @@
+#!/usr/bin/env python
+"""
+Saving and loading containment trees as JSON.
+
+    resource = Resource("orders.json")
+    resource.save(po)
+    ...
+    po = Resource("orders.json").load()
+
+A tree is written as one record per object, containers first, and read
+back one record at a time, so that neither side holds more than a record
+and the chain of containers above it, besides the model itself.  The file
+is a single JSON document:
+
+    {"format": "pmf", "version": 1, "records": [
+    [0, "orders.PurchaseOrder", null, null, null, {"comment": "Rush", "items": []}],
+    [1, "orders.Item", 0, "items", null, {"upc": "A-1", "price": 10}],
+    [2, "orders.Address", 0, "shipTo", null, {"lastItem": {"$ref": ["items", 0]}}]
+    ]}
+
+Each record gives the number of an object, its class, the number of its
+container, the containment feature holding it and, in a MDict, its key,
+followed by its other features.  Objects that are referred to, but not
+contained, through a feature are written as the path of containment
+features, list indexes and dict keys leading to them from the root, and
+must be contained by the root too.
+
+Objects are created without calling __init__, and notifications are
+disabled (_mDeliver is False) until an object and all of its content has
+been read.  Strings are read back as unicode, and tuples as lists.
+
+A saved tree may be followed by deltas, documents of the same form whose
+records hold the objects that changed since the previous save:
+
+    {"format": "pmf", "version": 1, "delta": true, "records": [
+    [0, "orders.PurchaseOrder", {"comment": "Rush", "items": [{"$oid": 1}, {"$oid": 7}]}],
+    [7, "orders.Item", {"upc": "A-7", "price": 3}]
+    ]}
+
+In a delta every object, contained or referred to, is given by its
+number, which objects keep from the save that first wrote them, and the
+record of an object gives all of its features, its contents included.
+A full save numbers the tree afresh; an object whose number was given
+before it, or by another file, is numbered again by the next delta.
+"""
+import StringIO
+import itertools
+import json
+import os
+import sys
+import weakref
+
+from core import *
+from core import _clock, _load, _manage, _setattr, _trackChanges
+from adapters import _isContained
+
+_HEADER = '{"format": "pmf", "version": 1, "records": [\n'
+_DELTA_HEADER = '{"format": "pmf", "version": 1, "delta": true, "records": [\n'
+_FOOTER = '\n]}\n'
+
+class Resource(object):
+    """
+    A file holding a containment tree.
+
+    Once a Resource has saved or loaded its tree, the changes made to the
+    tree are tracked (see MObject.mIsDirty), as are those made to every
+    other MObject from then on, and an incremental save only
+    appends the objects that changed as a delta.  Every maxDeltas deltas,
+    or once the deltas have grown larger than the tree they follow, an
+    incremental save compacts the file by writing the whole tree instead.
+    An object may only be saved incrementally to one Resource.
+    """
+    def __init__(self, path, root=None, maxDeltas=16):
+        self.path = path
+        self.root = root
+        self.maxDeltas = maxDeltas
+        # What is known of the file once the tree has been saved or loaded:
+        # the stamp of the last save, the next object number, the number
+        # of deltas, and the size of the file and of the tree before them
+        self._savedAt = None
+        self._nextOid = 0
+        self._deltas = 0
+        self._size = 0
+        self._baseSize = 0
+        # The objects numbered by the file, by number
+        self._numbered = weakref.WeakValueDictionary()
+
+    def save(self, root=None, incremental=False):
+        """
+        Writes root, by default the root of the resource, to the file.
+
+        A full save only replaces the file once the tree has been written
+        completely, and an incremental save appends a delta.  Either is
+        flushed to disk before returning.
+        """
+        if root is not None and root is not self.root:
+            self.root = root
+            self._savedAt = None
+        if (incremental and self._savedAt is not None and
+            self._deltas < self.maxDeltas and self._size < 2 * self._baseSize):
+            self._append()
+        else:
+            self._write()
+
+    def load(self):
+        """
+        Reads the tree in the file, applying its deltas, and returns its
+        root.
+        """
+        _trackChanges()
+        loader = _Loader()
+        with open(self.path, "rb") as stream:
+            self.root = loader.load(_Records(stream))
+        self._nextOid = loader.nextOid
+        self._numbered = weakref.WeakValueDictionary(loader.table)
+        self._deltas = loader.deltas
+        self._baseSize = loader.baseSize
+        self._saved()
+        return self.root
+
+    def _write(self):
+        _trackChanges()
+        temporary = self.path + ".tmp"
+        with open(temporary, "wb") as stream:
+            writer = _Writer(self.root, stream, track=True)
+            writer.write()
+            stream.flush()
+            os.fsync(stream.fileno())
+        os.rename(temporary, self.path)
+        self._nextOid = writer.count
+        self._numbered = writer.table
+        self._deltas = 0
+        self._baseSize = os.path.getsize(self.path)
+        self._saved()
+
+    def _append(self):
+        # The delta is encoded completely before anything is appended, and
+        # cut off again if it can not all be written, so that a failed save
+        # leaves the file, and the objects, as they were
+        buffer = StringIO.StringIO()
+        writer = _DeltaWriter(self.root, buffer, self._savedAt, self._nextOid,
+                              self._numbered)
+        try:
+            writer.write()
+            with open(self.path, "ab") as stream:
+                try:
+                    stream.write(buffer.getvalue())
+                    stream.flush()
+                    os.fsync(stream.fileno())
+                except:
+                    stream.truncate(self._size)
+                    raise
+        except:
+            for obj in itertools.chain([self.root], self.root.mAllContents()):
+                if id(obj) in writer.new:
+                    del self._numbered[obj._mOid]
+                    _setattr(obj, "_mOid", None)
+            raise
+        for obj in writer.written:
+            _setattr(obj, "_mDirty", False)
+        self._nextOid = writer.nextOid
+        self._deltas += 1
+        self._saved()
+
+    def _saved(self):
+        self._size = os.path.getsize(self.path)
+        self._savedAt = next(_clock)
+
+def dump(root, stream):
+    """
+    Writes the tree contained by root to stream.
+    """
+    _Writer(root, stream).write()
+
+def load(stream):
+    """
+    Reads a tree written by dump from stream, and any deltas following
+    it, and returns its root.
+    """
+    return _Loader().load(_Records(stream))
+
+
+
+
+def _isObject(value):
+    return isinstance(value, MObject) and not isinstance(value, (MList, MDict))
+
+def _items(obj):
+    """
+    Yields the name and value of each feature of obj that has been set.
+    """
+    _load(obj)
+    if obj.mFeatures:
+        for feature in obj.mFeatures:
+            try:
+                yield feature.name, feature._slot.__get__(obj, type(obj))
+            except AttributeError:
+                pass
+    else:
+        for name, value in obj.__dict__.iteritems():
+            if name[:1] != "_":
+                yield name, value
+
+def _owned(obj, value):
+    """
+    Returns True if value is a containment MList or MDict of obj.
+    """
+    return (isinstance(value, (MList, MDict)) and value._containment and
+            value._container is obj)
+
+def _get(obj, name):
+    """
+    Returns the stored value of a feature of obj, or None if it is unset.
+    """
+    feature = obj._mFeatureMap.get(name)
+    if feature is None:
+        return obj.__dict__.get(name)
+    try:
+        return feature._slot.__get__(obj, type(obj))
+    except AttributeError:
+        return None
+
+def _put(obj, name, value):
+    """
+    Stores the value of a feature of obj without any of the bookkeeping
+    of a write.
+    """
+    feature = obj._mFeatureMap.get(name)
+    if feature is None:
+        _setattr(obj, name, value)
+        if isinstance(value, (MList, MDict)) and value._container is obj:
+            _manage(obj, name)
+    else:
+        feature._slot.__set__(obj, value)
+
+def _collection(obj, name, kind):
+    """
+    Returns an empty collection of the kind stored by feature name of obj,
+    or of kind, list or dict, if obj is None or does not wrap the feature.
+    """
+    if obj is None:
+        return kind()
+    feature = obj._mFeatureMap.get(name)
+    if feature is not None:
+        if feature._mWraps:
+            return feature._mAdapt(obj, ())
+        return kind()
+    cls = type(obj)
+    feature = cls.__name__ + "." + name
+    containment = name in cls._mContainment
+    if kind is dict:
+        return MDict(container=obj, feature=feature, containment=containment)
+    opposite = cls.mOpposites.get(name)
+    listClass = MUniqueList if containment or opposite else MList
+    return listClass(container=obj, feature=feature, containment=containment,
+                     opposite=opposite)
+
+def _key(key):
+    """
+    Restores a dict key that was written as a tuple.
+    """
+    if type(key) is list:
+        return tuple(_key(k) for k in key)
+    return key
+
+
+
+
+class _Writer(object):
+    def __init__(self, root, stream, track=False):
+        self.root = root
+        self.stream = stream
+        # Whether to number the objects written, and mark them clean, and
+        # the objects numbered
+        self.track = track
+        self.table = weakref.WeakValueDictionary() if track else None
+        self.count = 0
+        self.encoder = json.JSONEncoder(separators=(",", ":"))
+
+    def write(self):
+        write = self.stream.write
+        write(_HEADER)
+        separator = ""
+        count = 0
+        # The contents still to be written of each open container
+        pending = [iter([(self.root, None, None, None)])]
+        while pending:
+            try:
+                value, parent, name, key = next(pending[-1])
+            except StopIteration:
+                pending.pop()
+                continue
+            if _isObject(value):
+                cls = type(value)
+                record = [count, cls.__module__ + "." + cls.__name__,
+                          parent, name, self._encode(key), self._features(value)]
+                pending.append(self._contents(value, count))
+                if self.track:
+                    _setattr(value, "_mOid", count)
+                    _setattr(value, "_mDirty", False)
+                    self.table[count] = value
+                count += 1
+            else:
+                record = [None, None, parent, name, self._encode(key), self._encode(value)]
+            write(separator)
+            write(self.encoder.encode(record))
+            separator = ",\n"
+        write(_FOOTER)
+        self.count = count
+
+    def _features(self, obj):
+        """
+        Encodes the features of obj other than its contents, which are
+        written as records of their own.
+        """
+        features = {}
+        containment = obj._mContainment
+        for name, value in _items(obj):
+            if _owned(obj, value):
+                features[name] = [] if isinstance(value, MList) else {"$dict": []}
+            elif not (name in containment and _isObject(value)):
+                features[name] = self._encode(value)
+        return features
+
+    def _contents(self, obj, number):
+        """
+        Yields the contents of obj, in order, with where each is held.
+        """
+        containment = obj._mContainment
+        for name, value in _items(obj):
+            if _owned(obj, value):
+                if isinstance(value, MList):
+                    for element in value:
+                        yield element, number, name, None
+                else:
+                    for key, element in value.iteritems():
+                        yield element, number, name, key
+            elif name in containment and _isObject(value):
+                yield value, number, name, None
+
+    def _encode(self, value):
+        if value is None or isinstance(value, (basestring, bool, int, long, float)):
+            return value
+        if isinstance(value, (list, tuple)):
+            return [self._encode(v) for v in value]
+        if isinstance(value, dict):
+            return {"$dict": [[self._encode(k), self._encode(v)]
+                              for k, v in value.iteritems()]}
+        if isinstance(value, MObject):
+            return self._reference(value)
+        raise TypeError("%r can not be saved" % (value,))
+
+    def _reference(self, obj):
+        return {"$ref": self._path(obj)}
+
+    def _path(self, target):
+        """
+        Returns the path from the root to target.
+        """
+        steps = []
+        obj = target
+        while obj is not self.root:
+            container = obj._mContainer
+            if container is None:
+                raise ValueError("%r is not contained by %r" % (target, self.root))
+            steps.append(self._step(container, obj))
+            obj = container
+        return [s for step in reversed(steps) for s in step]
+
+    def _step(self, container, obj):
+        """
+        Returns the steps of a path from container to obj, one of its
+        contents.
+        """
+        for name, value in _items(container):
+            # Only containment features lead to obj; it may also be
+            # referred to by others
+            if value is obj and name in container._mContainment:
+                return [name]
+            if _owned(container, value):
+                if isinstance(value, MList):
+                    position = value._mIndexOf(obj)
+                    if position >= 0:
+                        return [name, position]
+                else:
+                    for key, element in value.iteritems():
+                        if element is obj:
+                            return [name, self._encode(key)]
+        raise ValueError("%r is not held by its container" % (obj,))
+
+
+
+
+class _DeltaWriter(_Writer):
+    """
+    Writes a delta holding the objects of a tree that changed since stamp
+    since, giving numbers from nextOid on to the objects new to the file.
+    Only the subtrees stamped since then are visited.  The objects written
+    are kept in written, to be marked clean once the delta is on disk.
+
+    The numbers known to the file are those in table, by number; an object
+    whose number is not in table, or is that of another object, is new to
+    the file.
+    """
+    def __init__(self, root, stream, since, nextOid, table):
+        _Writer.__init__(self, root, stream)
+        self.since = since
+        self.nextOid = nextOid
+        self.table = table
+        # The ids of the objects numbered by this delta
+        self.new = set()
+        self.written = []
+
+    def write(self):
+        write = self.stream.write
+        write(_DELTA_HEADER)
+        separator = ""
+        pending = [self.root]
+        while pending:
+            obj = pending.pop()
+            oid = self._oid(obj)
+            if obj._mDirty or id(obj) in self.new:
+                cls = type(obj)
+                record = [oid, cls.__module__ + "." + cls.__name__, self._features(obj)]
+                write(separator)
+                write(self.encoder.encode(record))
+                separator = ",\n"
+                self.written.append(obj)
+            contents = [child for child in obj.mContents()
+                        if child._mStamp > self.since or not self._known(child) or
+                           id(child) in self.new]
+            contents.reverse()
+            pending.extend(contents)
+        write(_FOOTER)
+
+    def _features(self, obj):
+        return dict((name, self._encode(value)) for name, value in _items(obj))
+
+    def _reference(self, obj):
+        if not _isContained(obj, self.root):
+            raise ValueError("%r is not contained by %r" % (obj, self.root))
+        return {"$oid": self._oid(obj)}
+
+    def _known(self, obj):
+        """
+        Returns True if obj has been numbered by the file.
+        """
+        oid = obj._mOid
+        return oid is not None and self.table.get(oid) is obj
+
+    def _oid(self, obj):
+        if self._known(obj):
+            return obj._mOid
+        oid = self.nextOid
+        self.nextOid += 1
+        _setattr(obj, "_mOid", oid)
+        self.table[oid] = obj
+        self.new.add(id(obj))
+        return oid
+
+
+
+
+class _Records(object):
+    """
+    Reads the documents in a stream, and iterates over the records of
+    each, reading the stream a chunk at a time.
+    """
+    def __init__(self, stream, size=1 << 16):
+        self.stream = stream
+        self.size = size
+        self.buffer = ""
+        self.position = 0
+        # The offset in the stream of the start of the buffer
+        self.offset = 0
+        self.decoder = json.JSONDecoder()
+
+    def tell(self):
+        return self.offset + self.position
+
+    def document(self):
+        """
+        Reads the start of the next document, and returns True if it is a
+        delta, False if it is not, or None at the end of the stream.
+        """
+        if not self._skip(" \t\r\n"):
+            return None
+        for header in (_HEADER, _DELTA_HEADER):
+            while len(self.buffer) - self.position < len(header) and self._read(self.size):
+                pass
+            if self.buffer.startswith(header, self.position):
+                self.position += len(header)
+                return header is _DELTA_HEADER
+        raise ValueError("not a pmf document")
+
+    def __iter__(self):
+        while True:
+            c = self._skip(" \t\r\n,")
+            if c == "]":
+                self.position += 1
+                if self._skip(" \t\r\n") != "}":
+                    raise ValueError("malformed end of document")
+                self.position += 1
+                return
+            if not c:
+                raise ValueError("document ends before its last record")
+            yield self._decode()
+
+    def _read(self, size):
+        data = self.stream.read(size)
+        if not data:
+            return False
+        self.offset += self.position
+        self.buffer = self.buffer[self.position:] + data
+        self.position = 0
+        return True
+
+    def _skip(self, chars):
+        """
+        Skips over chars, and returns the next character or "" at the end
+        of the stream.
+        """
+        while True:
+            buffer = self.buffer
+            position = self.position
+            while position < len(buffer) and buffer[position] in chars:
+                position += 1
+            self.position = position
+            if position < len(buffer):
+                return buffer[position]
+            if not self._read(self.size):
+                return ""
+
+    def _decode(self):
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.position)
+            except ValueError:
+                # Read as much again as is buffered, so that a record larger
+                # than a chunk is only decoded a logarithmic number of times
+                if not self._read(max(self.size, len(self.buffer))):
+                    raise
+                continue
+            self.position = end
+            return value
+
+
+
+
+class _Loader(object):
+    def __init__(self):
+        self.root = None
+        self.classes = {}
+        # References to objects that had not been read yet, as
+        # (path or number, holder, slot)
+        self.deferred = []
+        # The objects by number
+        self.table = {}
+        self.nextOid = 0
+        self.deltas = 0
+        self.baseSize = 0
+
+    def load(self, records):
+        if records.document() is not False:
+            raise ValueError("not a pmf document")
+        self._loadTree(records)
+        self.baseSize = records.tell()
+        while True:
+            delta = records.document()
+            if delta is None:
+                return self.root
+            if not delta:
+                raise ValueError("a pmf document may only be followed by deltas")
+            self._applyDelta(records)
+            self.deltas += 1
+
+    def _loadTree(self, records):
+        # The open containers of the record being read, as (number, obj)
+        stack = []
+        for number, className, parent, name, key, value in records:
+            if className is None:
+                obj = None
+            else:
+                obj = self._create(className)
+                _setattr(obj, "_mOid", number)
+                self.table[number] = obj
+                self.nextOid = number + 1
+            if parent is None:
+                self.root = obj
+            else:
+                while stack[-1][0] != parent:
+                    stack.pop()[1]._mDeliver = True
+                container = stack[-1][1]
+                if obj is None:
+                    obj = self._decode(value, None, None)
+                self._attach(container, str(name), _key(key), obj)
+            if className is not None:
+                for feature, encoded in value.iteritems():
+                    feature = str(feature)
+                    _put(obj, feature, self._decode(encoded, obj, feature))
+                stack.append((number, obj))
+        while stack:
+            stack.pop()[1]._mDeliver = True
+        self._resolveDeferred()
+
+    def _applyDelta(self, records):
+        written = []
+        for oid, className, features in records:
+            obj = self.table.get(oid)
+            if obj is None:
+                obj = self.table[oid] = self._create(className)
+                _setattr(obj, "_mOid", oid)
+                self.nextOid = max(self.nextOid, oid + 1)
+            for feature, encoded in features.iteritems():
+                feature = str(feature)
+                _put(obj, feature, self._decode(encoded, obj, feature))
+            written.append(obj)
+        self._resolveDeferred()
+        for obj in written:
+            for child in obj.mContents():
+                _setattr(child, "_mContainer", obj)
+            obj._mDeliver = True
+
+    def _create(self, className):
+        cls = self.classes.get(className)
+        if cls is None:
+            module, _, name = className.rpartition(".")
+            __import__(module)
+            cls = self.classes[className] = getattr(sys.modules[module], name)
+        obj = cls.__new__(cls)
+        MObject.__init__(obj)
+        obj._mDeliver = False
+        return obj
+
+    def _attach(self, container, name, key, value):
+        """
+        Adds value to the contents of container held by feature name.
+        """
+        current = _get(container, name)
+        if isinstance(current, MList):
+            if isinstance(current, MUniqueList):
+                current._mAdding(len(current), (value,))
+            list.append(current, value)
+        elif isinstance(current, MDict):
+            dict.__setitem__(current, key, value)
+        else:
+            _put(container, name, value)
+        if _isObject(value):
+            _setattr(value, "_mContainer", container)
+
+    def _decode(self, encoded, obj, name):
+        """
+        Decodes the value of feature name of obj, wrapping lists and dicts
+        as the feature would.
+        """
+        if type(encoded) is list:
+            collection = _collection(obj, name, list)
+            for element in encoded:
+                list.append(collection, self._value(element, collection, len(collection)))
+            if isinstance(collection, MUniqueList):
+                collection._mReindex()
+            return collection
+        if type(encoded) is dict and "$dict" in encoded:
+            collection = _collection(obj, name, dict)
+            for key, element in encoded["$dict"]:
+                key = _key(key)
+                dict.__setitem__(collection, key, self._value(element, collection, key))
+            return collection
+        return self._value(encoded, obj, name)
+
+    def _value(self, encoded, holder, slot):
+        """
+        Decodes a value to be stored in slot of holder, which is either a
+        feature of an object or an index or key of a collection.
+        """
+        if type(encoded) is list:
+            values = []
+            for element in encoded:
+                values.append(self._value(element, values, len(values)))
+            return values
+        if type(encoded) is dict:
+            if "$ref" in encoded:
+                path = encoded["$ref"]
+                target = self._resolve(path)
+                if target is None:
+                    self.deferred.append((path, holder, slot))
+                return target
+            if "$oid" in encoded:
+                oid = encoded["$oid"]
+                target = self.table.get(oid)
+                if target is None:
+                    self.deferred.append((oid, holder, slot))
+                return target
+            values = {}
+            for key, element in encoded["$dict"]:
+                key = _key(key)
+                values[key] = self._value(element, values, key)
+            return values
+        return encoded
+
+    def _resolve(self, path):
+        """
+        Returns the object at the end of path, or None if it has not been
+        read yet.
+        """
+        obj = self.root
+        i = 0
+        try:
+            while i < len(path):
+                value = _get(obj, str(path[i]))
+                if isinstance(value, MList):
+                    value = list.__getitem__(value, path[i + 1])
+                    i += 2
+                elif isinstance(value, MDict):
+                    value = dict.__getitem__(value, _key(path[i + 1]))
+                    i += 2
+                else:
+                    i += 1
+                if value is None:
+                    return None
+                obj = value
+        except (IndexError, KeyError):
+            return None
+        return obj
+
+    def _resolveDeferred(self):
+        reindex = {}
+        for reference, holder, slot in self.deferred:
+            if isinstance(reference, list):
+                target = self._resolve(reference)
+            else:
+                target = self.table.get(reference)
+            if target is None:
+                raise ValueError("reference to %r is not in the document" % (reference,))
+            if isinstance(holder, list):
+                list.__setitem__(holder, slot, target)
+                if isinstance(holder, MUniqueList):
+                    reindex[id(holder)] = holder
+            elif isinstance(holder, dict):
+                dict.__setitem__(holder, slot, target)
+            else:
+                _put(holder, slot, target)
+        for collection in reindex.values():
+            collection._mReindex()
+        self.deferred = []
@@ -0,0 +1,427 @@
+#!/usr/bin/env python
+"""
+A containment tree kept in a SQLite database, for models larger than
+memory.
+
+    store = SQLiteStore("orders.db")
+    store.save(shop)                # writes the whole tree
+    ...
+    shop = SQLiteStore("orders.db").load()
+    shop.orders[3].items[0].price = 5
+    store.flush()                   # waits until the change is written
+
+Loading only reads the root.  Every other object is created, with its
+features unread, when the object holding it is read, and is read itself
+when one of its features is first used (see MObject.mLoad), so only the
+part of the model that is used is ever in memory.
+
+Once saved or loaded, the tree is watched by the store: the objects that
+change are written back by a background thread, in one transaction for
+each batch of batchSize changed objects, or whatever is pending when
+flush is called.  Each thread reading the model reads it through a
+connection of its own; objects are read, and changes recorded, holding
+the lock of the store.
+
+The database holds a row for each object, with its number, its class,
+the number of its container, and its features, encoded as in a Resource
+delta.  Objects referred to must be contained by the root, and objects
+kept by a store can not be saved to a Resource as well.
+"""
+import itertools
+import json
+import Queue
+import sqlite3
+import sys
+import threading
+
+from core import *
+from core import _defer, _setattr
+from adapters import NotificationAdapter, _contentChanges, _isContained
+from resources import _collection, _isObject, _key, _put
+from journal import _Encoder
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS objects (
+    oid INTEGER PRIMARY KEY,
+    class TEXT NOT NULL,
+    container INTEGER,
+    features TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    name TEXT PRIMARY KEY,
+    value
+);
+"""
+
+# The most numbers looked up by one query
+_CHUNK = 500
+
+class SQLiteStore(NotificationAdapter):
+    """
+    A SQLite database holding a containment tree.  The store is added as
+    a content adapter of the root it saves or loads.
+    """
+    def __init__(self, path, batchSize=256):
+        NotificationAdapter.__init__(self)
+        self.path = path
+        self.batchSize = batchSize
+        self.root = None
+        # The objects created so far, by number
+        self._objects = {}
+        self._classes = {}
+        self._encoder = _Encoder(None, 0, self._objects)
+        # The objects changed, and removed from the tree, since the last
+        # batch was handed to the writer, by id
+        self._dirty = {}
+        self._removed = {}
+        # Guards the above, and is held while objects are read
+        self._lock = threading.RLock()
+        self._local = threading.local()
+        self._queue = Queue.Queue()
+        self._thread = None
+        self._error = None
+        connection = self._connection()
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.executescript(_SCHEMA)
+
+    def save(self, root=None):
+        """
+        Replaces the content of the database with the tree contained by
+        root, by default the root of the store, and keeps it from then on.
+        """
+        if root is None:
+            root = self.root
+        self.flush()
+        with self._lock:
+            objects = [root]
+            objects.extend(root.mAllContents())
+            self._objects = {}
+            self._encoder = _Encoder(root, 0, self._objects)
+            for obj in objects:
+                self._encoder._oid(obj)
+            connection = self._connection()
+            with connection:
+                connection.execute("DELETE FROM objects")
+                connection.executemany("INSERT INTO objects VALUES (?, ?, ?, ?)",
+                                       self._rows(objects))
+                connection.execute("INSERT OR REPLACE INTO meta VALUES ('root', ?)",
+                                   (root._mOid,))
+            self._watch(root)
+
+    def load(self):
+        """
+        Returns the root of the tree in the database, with its features
+        unread, and keeps the tree from then on.
+        """
+        connection = self._connection()
+        row = connection.execute("SELECT value FROM meta WHERE name = 'root'").fetchone()
+        if row is None:
+            raise ValueError("%s holds no tree" % self.path)
+        nextOid, = connection.execute("SELECT coalesce(max(oid) + 1, 0) FROM objects").fetchone()
+        with self._lock:
+            self._objects = {}
+            root = self._object(row[0])
+            self._encoder = _Encoder(root, nextOid, self._objects)
+            self._watch(root)
+        return root
+
+    def notify(self, notification):
+        with self._lock:
+            self._record(notification)
+            if len(self._dirty) >= self.batchSize:
+                self._handOff()
+
+    def notifyMany(self, notifications):
+        with self._lock:
+            for notification in notifications:
+                self._record(notification)
+            if len(self._dirty) >= self.batchSize:
+                self._handOff()
+
+    def flush(self):
+        """
+        Writes the pending changes, and returns once every change made so
+        far is in the database.  Raises the error the writer met, if any.
+        """
+        with self._lock:
+            self._handOff()
+        self._queue.join()
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def close(self):
+        """
+        Flushes the store, stops keeping its tree and its writer, and
+        closes the connection of the calling thread.
+        """
+        try:
+            self.flush()
+        finally:
+            with self._lock:
+                if self.root is not None:
+                    self.root.mRemoveContentAdapter(self)
+                    self.root = None
+            if self._thread is not None:
+                self._queue.put(None)
+                self._thread.join()
+                self._thread = None
+            connection = getattr(self._local, "connection", None)
+            if connection is not None:
+                connection.close()
+                del self._local.connection
+
+    def _watch(self, root):
+        if self.root is not None and self.root is not root:
+            self.root.mRemoveContentAdapter(self)
+        self.root = root
+        self._encoder.root = root
+        root.mAddContentAdapter(self)
+
+    def _connection(self):
+        """
+        Returns the connection of the calling thread, opening it on first
+        use.
+        """
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = self._local.connection = sqlite3.connect(self.path, timeout=60)
+        return connection
+
+    def _object(self, oid):
+        """
+        Returns object oid, creating it with its features unread if it
+        does not exist yet.
+        """
+        obj = self._objects.get(oid)
+        if obj is None:
+            self._fetch([oid])
+            obj = self._objects.get(oid)
+            if obj is None:
+                raise ValueError("no object %r in %s" % (oid, self.path))
+        return obj
+
+    def _fetch(self, oids):
+        """
+        Creates the objects numbered oids, and their containers, with their
+        features unread.
+        """
+        connection = self._connection()
+        created = []
+        for i in xrange(0, len(oids), _CHUNK):
+            chunk = oids[i:i + _CHUNK]
+            rows = connection.execute(
+                "SELECT oid, class, container FROM objects WHERE oid IN (%s)" %
+                ",".join("?" * len(chunk)), chunk)
+            for oid, className, container in rows:
+                cls = self._class(className)
+                obj = cls.__new__(cls)
+                MObject.__init__(obj)
+                _setattr(obj, "_mOid", oid)
+                self._objects[oid] = obj
+                created.append((obj, container))
+        for obj, container in created:
+            if container is not None:
+                _setattr(obj, "_mContainer", self._object(container))
+            _defer(obj, _Row(self))
+
+    def _class(self, className):
+        cls = self._classes.get(className)
+        if cls is None:
+            module, _, name = className.rpartition(".")
+            __import__(module)
+            cls = self._classes[className] = getattr(sys.modules[module], name)
+        return cls
+
+    def _read(self, obj):
+        """
+        Reads the features of obj from the database.
+        """
+        row = self._connection().execute("SELECT features FROM objects WHERE oid = ?",
+                                         (obj._mOid,)).fetchone()
+        if row is None:
+            raise ValueError("no object %r in %s" % (obj._mOid, self.path))
+        features = json.loads(row[0])
+        missing = set()
+        _references(features, missing)
+        missing.difference_update(self._objects)
+        if missing:
+            self._fetch(list(missing))
+        for name, encoded in features.iteritems():
+            name = str(name)
+            _put(obj, name, self._decode(encoded, obj, name))
+
+    def _decode(self, encoded, obj, name):
+        """
+        Decodes the value of feature name of obj, wrapping lists and dicts
+        as the feature would.
+        """
+        if type(encoded) is list:
+            collection = _collection(obj, name, list)
+            for element in encoded:
+                list.append(collection, self._value(element))
+            if isinstance(collection, MUniqueList):
+                collection._mReindex()
+            return collection
+        if type(encoded) is dict and "$dict" in encoded:
+            collection = _collection(obj, name, dict)
+            for key, element in encoded["$dict"]:
+                dict.__setitem__(collection, _key(key), self._value(element))
+            return collection
+        return self._value(encoded)
+
+    def _value(self, encoded):
+        if type(encoded) is list:
+            return [self._value(element) for element in encoded]
+        if type(encoded) is dict:
+            if "$oid" in encoded:
+                return self._object(encoded["$oid"])
+            return dict((_key(key), self._value(element))
+                        for key, element in encoded["$dict"])
+        return encoded
+
+    def _record(self, notification):
+        notifier = notification.notifier
+        if isinstance(notifier, (MList, MDict)):
+            notifier = notifier._container
+        self._dirty[id(notifier)] = notifier
+        changes = _contentChanges(notification)
+        if changes is not None:
+            removed, added = changes
+            for value in removed:
+                if _isObject(value):
+                    self._removed[id(value)] = value
+            for value in added:
+                for obj in _loadedTree(value):
+                    self._dirty[id(obj)] = obj
+
+    def _handOff(self):
+        """
+        Encodes the objects changed since the last batch, and hands them
+        to the writer.
+        """
+        if not self._dirty and not self._removed:
+            return
+        root = self.root
+        objects = [obj for obj in self._dirty.itervalues() if _isContained(obj, root)]
+        removed = [obj for obj in self._removed.itervalues() if not _isContained(obj, root)]
+        self._dirty = {}
+        self._removed = {}
+        for obj in objects:
+            self._encoder._oid(obj)
+        rows = self._rows(objects)
+        deletes = []
+        for value in removed:
+            # Read whatever is left of the subtree, so that it can still
+            # be used once its rows are gone
+            for obj in itertools.chain([value], value.mAllContents()):
+                if self._encoder._known(obj):
+                    deletes.append((obj._mOid,))
+                    del self._objects[obj._mOid]
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._write, name="SQLiteStore writer")
+            self._thread.daemon = True
+            self._thread.start()
+        self._queue.put((rows, deletes))
+
+    def _rows(self, objects):
+        """
+        Returns the rows of objects, and of the objects new to the store
+        they refer to.
+        """
+        encoder = self._encoder
+        rows = []
+        written = set()
+        objects = list(objects)
+        while objects or encoder.pending:
+            obj = objects.pop() if objects else encoder.pending.pop()
+            if id(obj) in written:
+                continue
+            written.add(id(obj))
+            oid = encoder._oid(obj)
+            cls = type(obj)
+            container = obj._mContainer
+            rows.append((oid, cls.__module__ + "." + cls.__name__,
+                         None if container is None else encoder._oid(container),
+                         encoder.encoder.encode(encoder._features(obj))))
+        encoder.new.clear()
+        return rows
+
+    def _write(self):
+        """
+        Writes the batches handed off, merging those that are waiting into
+        one transaction, until it is handed None.
+        """
+        connection = self._connection()
+        while True:
+            batches = [self._queue.get()]
+            try:
+                while True:
+                    batches.append(self._queue.get_nowait())
+            except Queue.Empty:
+                pass
+            try:
+                with connection:
+                    for batch in batches:
+                        if batch is not None:
+                            rows, deletes = batch
+                            connection.executemany(
+                                "INSERT OR REPLACE INTO objects VALUES (?, ?, ?, ?)", rows)
+                            connection.executemany("DELETE FROM objects WHERE oid = ?", deletes)
+            except Exception as e:
+                self._error = e
+            finally:
+                for batch in batches:
+                    self._queue.task_done()
+            if None in batches:
+                connection.close()
+                return
+
+
+
+
+class _Row(object):
+    """
+    The loader of an object whose features are still in the database.
+    """
+    __slots__ = ("store",)
+
+    def __init__(self, store):
+        self.store = store
+
+    @property
+    def mLock(self):
+        return self.store._lock
+
+    def mLoad(self, obj):
+        self.store._read(obj)
+
+def _references(encoded, oids):
+    """
+    Adds the numbers of the objects an encoded value refers to to oids.
+    """
+    if type(encoded) is list:
+        for element in encoded:
+            _references(element, oids)
+    elif type(encoded) is dict:
+        if "$oid" in encoded:
+            oids.add(encoded["$oid"])
+        elif "$dict" in encoded:
+            for key, element in encoded["$dict"]:
+                _references(element, oids)
+        else:
+            for element in encoded.itervalues():
+                _references(element, oids)
+
+def _loadedTree(value):
+    """
+    Yields value, if it is an object, and the objects it contains that have
+    been read, since the others can not have changed.
+    """
+    if not _isObject(value):
+        return
+    pending = [value]
+    while pending:
+        obj = pending.pop()
+        yield obj
+        pending.extend(child for child in obj.mContents() if child._mLoader is None)
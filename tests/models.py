@@ -0,0 +1,106 @@
+"""
+Model classes shared by the tests.  They live in a module of their own
+so that the persistence tests can find them again by name when loading.
+"""
+from pmf.core import *
+
+class Item(MObject):
+    upc = Feature()
+    price = Feature(default=0)
+    related = Feature()
+
+class Address(MObject):
+    street = Feature()
+    lastItem = Feature()
+
+class PurchaseOrder(MObject):
+    items = ListFeature(containment=True)
+    shipTo = Feature(containment=True)
+    notes = DictFeature(containment=True)
+    tags = DictFeature()
+    refs = ListFeature()
+    customer = Feature(opposite="orders")
+    comment = Feature()
+
+class Customer(MObject):
+    orders = ListFeature(opposite="customer")
+
+class Shop(MObject):
+    mContainment = ["orders", "customers", "main"]
+
+class Dyn(MObject):
+    mContainment = ["kids"]
+
+class Order(MObject):
+    shipTo = Feature()
+    addresses = ListFeature(containment=True)
+    billTo = Feature(containment=True)
+    other = Feature()
+
+def build():
+    """
+    Returns a small shop: one customer, three orders of four items each,
+    and a dynamic object holding another.
+    """
+    shop = Shop()
+    shop.customers = []
+    shop.orders = []
+    customer = Customer()
+    shop.customers.append(customer)
+    for n in range(3):
+        po = PurchaseOrder()
+        po.comment = "po%d" % n
+        shop.orders.append(po)
+        for k in range(4):
+            item = Item()
+            item.upc = "u%d" % k
+            item.price = k
+            po.items.append(item)
+        po.items[0].related = po.items[3]
+        po.shipTo = Address()
+        po.shipTo.street = "S%d" % n
+        po.customer = customer
+    shop.main = Dyn()
+    shop.main.kids = [Dyn()]
+    return shop
+
+def snapshot(value):
+    """
+    Returns a comparable picture of value: the contents of objects are
+    pictured in full, and the objects they refer to by their path.
+    """
+    if isinstance(value, (list, tuple)):
+        return [snapshot(v) for v in value]
+    if isinstance(value, dict):
+        # Tuples apart, so that str and unicode keys sort alike
+        return sorted(((k, snapshot(v)) for k, v in value.items()),
+                      key=lambda item: (isinstance(item[0], tuple), item[0]))
+    if isinstance(value, MObject):
+        features = []
+        for name in value.mFeatureNames():
+            feature = getattr(value, name)
+            if _isContainment(value, name):
+                features.append((name, snapshot(feature)))
+            else:
+                features.append((name, pathOf(feature)))
+        return (type(value).__name__, sorted(features))
+    return value
+
+def _isContainment(obj, name):
+    if name in obj.mContainment:
+        return True
+    return getattr(getattr(type(obj), name, None), "containment", False)
+
+def pathOf(value):
+    """
+    Returns the class names of value and its containers, up to the root.
+    """
+    if isinstance(value, MObject):
+        path = []
+        while value.mContainer() is not None:
+            path.append(type(value).__name__)
+            value = value.mContainer()
+        return tuple(path)
+    if isinstance(value, (list, tuple)):
+        return [pathOf(v) for v in value]
+    return value
@@ -0,0 +1,289 @@
+import gc
+import unittest
+
+from pmf.core import *
+from pmf.adapters import *
+from tests.models import *
+
+class DynOrder(MObject):
+    mOpposites = {"customer": "orders"}
+
+    def __init__(self):
+        MObject.__init__(self)
+        self.customer = None
+
+class DynCustomer(MObject):
+    mOpposites = {"orders": "customer"}
+
+    def __init__(self):
+        MObject.__init__(self)
+        self.orders = []
+
+class Husband(MObject):
+    wife = Feature(opposite="husband")
+
+class Wife(MObject):
+    husband = Feature(opposite="wife")
+
+class Holder(MObject):
+    mContainment = ["things"]
+
+    def __init__(self):
+        MObject.__init__(self)
+        self.things = []
+
+class Bag(MObject):
+    things = ListFeature(containment=True, unique=True)
+
+
+
+
+class ChangeRecorderTest(unittest.TestCase):
+    def snapshot(self, po):
+        return (po.comment, list(po.items), dict(po.tags),
+                [(i.upc, i.price) for i in po.items])
+
+    def testUndoRedo(self):
+        po = PurchaseOrder()
+        recorder = ChangeRecorder()
+        po.mAddContentAdapter(recorder)
+        states = [self.snapshot(po)]
+        a, b, c = Item(), Item(), Item()
+        def compound():
+            with recorder.compound("two"):
+                with Batch():
+                    po.items.append(Item())
+                    po.comment = "y"
+                    po.comment = "z"
+        for change in [lambda: setattr(po, "comment", "x"),
+                       lambda: po.items.append(a),
+                       lambda: po.items.extend([b, c]),
+                       lambda: setattr(a, "upc", "1"),
+                       lambda: po.tags.__setitem__("k", 1),
+                       lambda: po.tags.update({"k": 3, "j": 4}),
+                       lambda: po.tags.clear(),
+                       lambda: po.items.insert(-1, Item()),
+                       lambda: po.items.pop(),
+                       lambda: po.items.reverse(),
+                       lambda: po.items.sort(key=id),
+                       lambda: po.items.__delslice__(0, 2),
+                       lambda: po.items.__setslice__(0, 1, [b, c]),
+                       lambda: po.items.remove(b),
+                       lambda: po.tags.setdefault("q", 5),
+                       lambda: po.tags.pop("q"),
+                       compound]:
+            change()
+            states.append(self.snapshot(po))
+        for state in reversed(states[1:]):
+            self.assertEqual(self.snapshot(po), state)
+            recorder.undo()
+        self.assertEqual(self.snapshot(po), states[0])
+        self.assertFalse(recorder.canUndo())
+        for state in states[1:]:
+            recorder.redo()
+            self.assertEqual(self.snapshot(po), state)
+        self.assertEqual(recorder.undoLabel(), "two")
+        po.comment = "new"
+        self.assertFalse(recorder.canRedo())
+
+    def testReplayIsDeliveredTogether(self):
+        calls = []
+        class Many(NotificationAdapter):
+            def notifyMany(self, notifications):
+                calls.append([n.eventType for n in notifications])
+        po = PurchaseOrder()
+        recorder = ChangeRecorder()
+        po.mAddContentAdapter(recorder)
+        po.mAddContentAdapter(Many(lambda n: None))
+        with recorder.compound():
+            po.comment = "x"
+            po.items.append(Item())
+        recorder.undo()
+        recorder.redo()
+        with recorder.compound():
+            po.comment = "y"
+            recorder.rollback()
+        self.assertEqual(calls, [[REMOVE, SET], [SET, ADD], [SET]])
+        self.assertEqual((po.comment, len(po.items), len(recorder._undo)), ("x", 1, 1))
+
+    def testMaxChanges(self):
+        po = PurchaseOrder()
+        recorder = ChangeRecorder(maxChanges=3)
+        po.mAddContentAdapter(recorder)
+        for i in range(10):
+            po.comment = i
+        self.assertEqual((len(recorder._undo), recorder._size), (3, 3))
+
+
+
+
+class OppositeTest(unittest.TestCase):
+    def checkOpposites(self, Order, Customer):
+        c1, c2, o1, o2 = Customer(), Customer(), Order(), Order()
+        o1.customer = c1
+        self.assertEqual(list(c1.orders), [o1])
+        o1.customer = c2
+        self.assertEqual((list(c1.orders), list(c2.orders)), ([], [o1]))
+        c1.orders.append(o1)
+        self.assertTrue(o1.customer is c1)
+        self.assertEqual(list(c2.orders), [])
+        c1.orders.append(o2)
+        c1.orders.remove(o1)
+        self.assertTrue(o1.customer is None and o2.customer is c1)
+        c2.orders = [o1]
+        self.assertTrue(o1.customer is c2)
+        c2.orders = []
+        self.assertTrue(o1.customer is None)
+        holder = Holder()
+        holder.things.extend([c1, c2, o1, o2])
+        recorder = ChangeRecorder()
+        holder.mAddContentAdapter(recorder)
+        o1.customer = c1
+        c2.orders.append(o2)
+        state = (list(c1.orders), list(c2.orders), o1.customer, o2.customer)
+        recorder.undo()
+        recorder.undo()
+        self.assertEqual((list(c1.orders), list(c2.orders), o1.customer), ([o2], [], None))
+        recorder.redo()
+        recorder.redo()
+        self.assertEqual((list(c1.orders), list(c2.orders), o1.customer, o2.customer), state)
+
+    def testDynamicOpposites(self):
+        self.checkOpposites(DynOrder, DynCustomer)
+
+    def testDeclaredOpposites(self):
+        self.checkOpposites(PurchaseOrder, Customer)
+
+    def testOneToOne(self):
+        husband, wife, other = Husband(), Wife(), Wife()
+        husband.wife = wife
+        self.assertTrue(wife.husband is husband)
+        other.husband = husband
+        self.assertTrue(husband.wife is other and wife.husband is None)
+
+
+
+
+class CrossReferenceTest(unittest.TestCase):
+    def testInverseReferences(self):
+        shop = build()
+        xref = CrossReferenceAdapter()
+        shop.mAddContentAdapter(xref)
+        po = shop.orders[0]
+        last = po.items[3]
+        self.assertEqual(xref.getInverseReferences(last), [(po.items[0], "Item.related")])
+        po.items[1].related = last
+        po.refs.append(last)
+        self.assertEqual(len(xref.getInverseReferences(last)), 3)
+        xref.delete(last)
+        self.assertEqual(xref.getInverseReferences(last), [])
+        self.assertTrue(po.items[0].related is None and list(po.refs) == [])
+        self.assertFalse(last in po.items)
+
+
+
+
+class InstanceRegistryTest(unittest.TestCase):
+    def testAllInstances(self):
+        shop = build()
+        registry = InstanceRegistry()
+        shop.mAddContentAdapter(registry)
+        self.assertEqual(len(registry.allInstances(Item)), 12)
+        po = shop.orders.pop()
+        self.assertEqual(len(registry.allInstances(Item)), 8)
+        self.assertFalse(po in registry.allInstances(PurchaseOrder))
+        shop.orders[0].items.append(Item())
+        self.assertEqual(len(registry.allInstances(Item)), 9)
+
+
+
+
+class ListIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.po = PurchaseOrder()
+        self.a = Item()
+        self.a.upc = "a"
+        self.b = Item()
+        self.b.upc = "b"
+        self.po.items.extend([self.a, self.b])
+        self.index = ListIndex("upc", unique=True)
+        self.po.items.mAddAdapter(self.index)
+
+    def item(self, upc):
+        item = Item()
+        item.upc = upc
+        return item
+
+    def testLookup(self):
+        index = self.index
+        self.assertTrue(index.get("a") is self.a and index.get("b") is self.b)
+        c = self.item("c")
+        self.po.items.append(c)
+        c.upc = "cc"
+        self.assertTrue(index.get("c") is None and index.get("cc") is c)
+        self.po.items.remove(c)
+        self.assertFalse("cc" in index)
+        self.assertFalse(index in c._mAdapters)
+
+    def testCurrentForOtherElementAdapters(self):
+        seen = []
+        def check(notification):
+            seen.append(self.index.get(notification.newValue))
+        self.a.mAddAdapter(NotificationAdapter(check))
+        self.po.items.mRemoveAdapter(self.index)
+        self.po.items.mAddAdapter(self.index)
+        self.a.upc = "aa"
+        self.assertEqual(seen, [self.a])
+
+    def testDuplicatesAreRejectedBeforeTheChange(self):
+        recorder = ChangeRecorder()
+        self.po.mAddContentAdapter(recorder)
+        seen = []
+        self.po.items.mAddAdapter(NotificationAdapter(seen.append))
+        self.assertRaises(ValueError, self.po.items.append, self.item("b"))
+        self.assertRaises(ValueError, self.po.items.extend, [self.item("x"), self.item("a")])
+        self.assertRaises(ValueError, setattr, self.b, "upc", "a")
+        self.assertEqual(list(self.po.items), [self.a, self.b])
+        self.assertEqual(self.b.upc, "b")
+        self.assertFalse(recorder.canUndo())
+        self.assertEqual(seen, [])
+
+    def testDuplicatesInsideBatch(self):
+        with Batch():
+            self.assertRaises(ValueError, self.po.items.append, self.item("b"))
+            e = self.item("e")
+            self.po.items.append(e)
+            self.assertRaises(ValueError, self.po.items.append, self.item("e"))
+            e.upc = "ee"
+            self.po.items.append(self.item("e"))
+        self.assertTrue(self.index.get("ee") is e)
+        self.assertTrue(self.index.get("e") is self.po.items[-1])
+
+    def testReplacingFreesKeys(self):
+        self.po.items[0:2] = [self.b, self.a]
+        self.assertTrue(self.index.get("a") is self.a)
+        other = self.item("a")
+        self.po.items[1] = other
+        self.assertTrue(self.index.get("a") is other)
+
+    def testUniqueList(self):
+        bag = Bag()
+        bag.things.append(self.item("x"))
+        bag.things.mAddAdapter(ListIndex("upc", unique=True))
+        self.assertRaises(ValueError, bag.things.append, self.item("x"))
+        y = self.item("y")
+        bag.things.append(y)
+        self.assertEqual(bag.things.index(y), 1)
+
+    def testCompositeAndNonUniqueKeys(self):
+        byBoth = ListIndex(["price", "upc"])
+        byPrice = ListIndex("price")
+        self.po.items.mAddAdapter(byBoth)
+        self.po.items.mAddAdapter(byPrice)
+        self.assertTrue(byBoth.get((0, "a")) is self.a)
+        self.assertEqual(byPrice.lookup(0), [self.a, self.b])
+        self.b.price = 2
+        self.assertEqual((byPrice.lookup(0), byPrice.lookup(2)), ([self.a], [self.b]))
+
+if __name__ == "__main__":
+    unittest.main()
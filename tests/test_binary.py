@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+
+from pmf.core import *
+from pmf.adapters import NotificationAdapter
+from pmf.binary import BinaryResource
+from tests.models import *
+
+class BinaryResourceTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "shop.pmfb")
+        self.shop = build()
+        po = self.shop.orders[0]
+        po.comment = u"po0 \xe9"
+        po.items[0].price = 10 ** 30
+        po.items[1].price = 1.5
+        po.tags = {"k": [1, 2, {"z": None}], 3: (True, False)}
+        po.notes[(1, "x")] = Item()
+        self.shop.main.kids.append(Dyn())
+        self.shop.main.kids[1].x = self.shop.main.kids[0]
+        BinaryResource(self.path).save(self.shop)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def testRoundTrip(self):
+        loaded = BinaryResource(self.path).load()
+        self.assertEqual(snapshot(loaded), snapshot(self.shop))
+        po = loaded.orders[0]
+        self.assertEqual(po.comment, u"po0 \xe9")
+        self.assertEqual((po.items[0].price, po.items[1].price), (10 ** 30, 1.5))
+        self.assertEqual(po.tags[3], (True, False))
+        self.assertTrue(loaded.main.kids[1].x is loaded.main.kids[0])
+
+    def testObjectsAreReadOnFirstUse(self):
+        loaded = BinaryResource(self.path).load()
+        self.assertTrue(loaded._mLoader is not None)
+        orders = loaded.orders
+        self.assertTrue(all(o._mLoader is not None for o in orders))
+        self.assertEqual(orders[1].comment, "po1")
+        self.assertTrue(orders[0]._mLoader is not None)
+
+    def testWritesLoadFirst(self):
+        loaded = BinaryResource(self.path).load()
+        item = loaded.orders[0].items[2]
+        item.price = 99
+        self.assertEqual((item.upc, item.price), ("u2", 99))
+        seen = []
+        po = loaded.orders[1]
+        po.mAddAdapter(NotificationAdapter(seen.append))
+        po.comment = "x"
+        self.assertEqual(seen[0].oldValue, "po1")
+        BinaryResource(self.path).save(loaded)
+        self.assertEqual(BinaryResource(self.path).load().orders[0].items[2].price, 99)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,438 @@
+import copy
+import gc
+import os
+import pickle
+import random
+import shutil
+import tempfile
+import unittest
+import weakref
+
+import pmf.core as core
+from pmf.core import *
+from pmf.adapters import AllContentNotificationAdapter, NotificationAdapter
+from pmf.resources import Resource
+from tests.models import *
+
+class Node(MObject):
+    mContainment = ["kids", "child"]
+
+    def __init__(self):
+        MObject.__init__(self)
+        self.kids = []
+        self.child = None
+        self.ref = None
+        self.tags = {}
+
+class Declared(MObject):
+    kids = ListFeature(containment=True)
+    name = Feature()
+
+class Special(Item):
+    pass
+
+class Thing(MObject):
+    pass
+
+class Recorder(object):
+    """
+    An adapter with nothing but notify.
+    """
+    target = None
+
+    def __init__(self):
+        self.got = []
+
+    def notify(self, notification):
+        self.got.append(notification)
+
+
+
+
+class FeatureTest(unittest.TestCase):
+    def testDeclaredFeatures(self):
+        po = PurchaseOrder()
+        self.assertEqual(po.comment, None)
+        self.assertEqual(Item().price, 0)
+        self.assertTrue(type(po.items) is MUniqueList)
+        self.assertEqual(po.items._feature, "PurchaseOrder.items")
+        self.assertTrue(isinstance(po.tags, MDict))
+        address = Address()
+        po.shipTo = address
+        self.assertTrue(address.mContainer() is po)
+        po.shipTo = None
+        self.assertTrue(address.mContainer() is None)
+
+    def testDeclaredInstancesAllocateNoDict(self):
+        po = PurchaseOrder()
+        po.mAddAdapter(NotificationAdapter(lambda n: None))
+        po.mAddContentAdapter(NotificationAdapter())
+        weakref.ref(po)
+        special = Special()
+        special.price = 3
+        copy.deepcopy(po)
+        for obj in (po, special):
+            self.assertFalse(any(type(r) is dict for r in gc.get_referents(obj)))
+
+    def testBareMObject(self):
+        obj = MObject()
+        log = []
+        obj.mAddAdapter(NotificationAdapter(log.append))
+        obj.x = 1
+        obj._private = 2
+        self.assertEqual((obj.x, obj._private, len(log)), (1, 2, 1))
+        self.assertTrue(weakref.ref(obj)() is obj)
+
+    def testCopy(self):
+        shop = build()
+        po = shop.orders[0]
+        shallow = copy.copy(po)
+        self.assertTrue(shallow.items is po.items)
+        self.assertEqual(shallow.comment, po.comment)
+        deep = copy.deepcopy(shop)
+        self.assertEqual(snapshot(deep), snapshot(shop))
+        item = deep.orders[0].items[0]
+        self.assertTrue(item in deep.orders[0].items and item not in po.items)
+        self.assertTrue(item.mContainer() is deep.orders[0])
+        for protocol in (0, 2):
+            self.assertEqual(snapshot(pickle.loads(pickle.dumps(shop, protocol))),
+                             snapshot(shop))
+
+    def testUndeclaredFeaturesAreRejected(self):
+        self.assertRaises(AttributeError, setattr, PurchaseOrder(), "shipto", Address())
+        self.assertRaises(AttributeError, setattr, Special(), "z", 1)
+        dyn = Dyn()
+        dyn.z = 1
+        self.assertEqual(dyn.__dict__["z"], 1)
+
+    def testReplacingAnOwnedCollection(self):
+        dyn = Dyn()
+        dyn.things = [1]
+        dyn.table = {"a": 1}
+        things, table = dyn.things, dyn.table
+        dyn.things = None
+        dyn.table = 2
+        self.assertTrue(things.mContainer() is None and table.mContainer() is None)
+        directory = tempfile.mkdtemp()
+        try:
+            resource = Resource(os.path.join(directory, "dyn.json"), Dyn())
+            resource.root.things = [1]
+            resource.save()
+            loaded = Resource(resource.path).load()
+            things = loaded.things
+            loaded.things = None
+            self.assertTrue(things.mContainer() is None)
+        finally:
+            shutil.rmtree(directory)
+
+    def testStamps(self):
+        po = PurchaseOrder()
+        s0 = po.mStamp()
+        item = Item()
+        po.items.append(item)
+        s1 = po.mStamp()
+        self.assertTrue(s1 > s0)
+        self.assertEqual(po.items.mStamp(), s1)
+        item.price = 3
+        s2 = po.mStamp()
+        self.assertTrue(s2 > s1 and item.mStamp() == s2)
+        po.tags["a"] = 1
+        s3 = po.mStamp()
+        self.assertTrue(s3 > s2 and item.mStamp() == s2)
+        with Batch():
+            item.price = 4
+        self.assertTrue(po.mStamp() > s3)
+        s4 = po.mStamp()
+        po.items.remove(item)
+        s5 = po.mStamp()
+        self.assertTrue(s5 > s4)
+        item.price = 10
+        self.assertEqual(po.mStamp(), s5)
+
+
+
+
+class DispatchTest(unittest.TestCase):
+    def testEventTypes(self):
+        thing = Thing()
+        log = []
+        adapter = NotificationAdapter(log.append, eventTypes=["ADD"])
+        thing.mAddAdapter(adapter)
+        thing.x = 1
+        self.assertEqual(log, [])
+        adapter.eventTypes = SET | ADD
+        thing.x = 2
+        self.assertTrue(log[0].eventType is SET)
+        self.assertEqual(log[0].eventType, "SET")
+
+    def testFeatureRestrictedAdapters(self):
+        thing = Thing()
+        a, b, c = [], [], []
+        fa = NotificationAdapter(a.append)
+        fb = NotificationAdapter(b.append, eventTypes=[ADD])
+        every = NotificationAdapter(c.append)
+        thing.mAddAdapter(fa, features=["Thing.x"])
+        thing.mAddAdapter(fb, features=["Thing.x"])
+        thing.mAddAdapter(every)
+        thing.x = 1
+        thing.y = 2
+        self.assertEqual((len(a), len(b), len(c)), (1, 0, 2))
+        thing.mAddAdapter(fa, features=["Thing.y"])
+        thing.y = 3
+        self.assertEqual(len(a), 2)
+        thing.mAddAdapter(fa)
+        thing.z = 1
+        self.assertEqual(len(a), 3)
+        thing.mRemoveAdapter(fa)
+        thing.z = 2
+        self.assertEqual(len(a), 3)
+
+    def testCreatingAdaptersKeepsIndexes(self):
+        epoch = core._dispatchEpoch
+        adapters = [NotificationAdapter() for i in range(100)]
+        self.assertEqual(core._dispatchEpoch, epoch)
+
+    def testAdaptersWithOnlyNotify(self):
+        po = PurchaseOrder()
+        direct = Recorder()
+        content = Recorder()
+        po.mAddAdapter(direct)
+        po.mAddContentAdapter(content)
+        po.comment = "x"
+        po.items.append(Item())
+        self.assertEqual((len(direct.got), len(content.got)), (1, 2))
+        with Batch():
+            po.comment = "y"
+            po.items.append(Item())
+        self.assertEqual((len(direct.got), len(content.got)), (2, 4))
+
+    def testKeywordNotifyOverride(self):
+        calls = []
+        class Hooked(MObject):
+            def mNotify(self, **kw):
+                calls.append(kw)
+                MObject.mNotify(self, **kw)
+        class HookedList(MList):
+            def mNotify(self, **kw):
+                calls.append(kw)
+        hooked = Hooked()
+        log = []
+        hooked.mAddAdapter(NotificationAdapter(log.append))
+        hooked.x = 1
+        self.assertEqual((calls[0]["eventType"], calls[0]["newValue"]), (SET, 1))
+        self.assertTrue(calls[0]["notifier"] is hooked)
+        self.assertEqual(len(log), 1)
+        HookedList().append(2)
+        self.assertEqual((calls[1]["eventType"], calls[1]["position"]), (ADD, 0))
+
+    def testContentAdapters(self):
+        root = Node()
+        a, b, c = Node(), Node(), Node()
+        root.kids.append(a)
+        a.child = b
+        b.kids.append(c)
+        referred = Node()
+        root.ref = referred
+        log = []
+        root.mAddContentAdapter(NotificationAdapter(log.append))
+        c.x = 1
+        self.assertTrue(log[-1].notifier is c)
+        c.tags["q"] = 2
+        self.assertTrue(log[-1].notifier is c.tags)
+        referred.x = 1
+        self.assertFalse(log[-1].notifier is referred)
+        a.child = None
+        count = len(log)
+        b.x = 5
+        self.assertEqual(len(log), count)
+
+    def testAllContentAdapter(self):
+        root = Node()
+        a, b = Node(), Node()
+        root.kids.append(a)
+        a.child = b
+        adapter = AllContentNotificationAdapter(lambda n: None)
+        root.mAddAdapter(adapter)
+        self.assertTrue(adapter in b._mAdapters and adapter in b.kids._mAdapters)
+        a.child = None
+        self.assertFalse(adapter in b._mAdapters)
+        root.mRemoveAdapter(adapter)
+        self.assertFalse(adapter in a._mAdapters)
+
+
+
+
+class BatchTest(unittest.TestCase):
+    def testCoalescing(self):
+        node = Node()
+        log = []
+        adapter = NotificationAdapter(log.append)
+        for target in (node, node.kids, node.tags):
+            target.mAddAdapter(adapter)
+        kids = [Node(), Node(), Node()]
+        with node.mBatch():
+            node.x = 1
+            node.x = 2
+            node.kids.append(kids[0])
+            node.kids.append(kids[1])
+            node.kids.append(kids[2])
+            with node.mBatch():
+                node.tags["k"] = 1
+                node.tags["k"] = 2
+            node.z = 1
+            node.z = None
+            self.assertEqual(log, [])
+        self.assertEqual([n.eventType for n in log], [SET, ADD_MANY, ADD])
+        self.assertEqual(log[0].newValue, 2)
+        self.assertEqual(log[2].newValue, 2)
+
+    def testAddThenRemoveCancels(self):
+        node = Node()
+        log = []
+        node.kids.mAddAdapter(NotificationAdapter(log.append))
+        kid = Node()
+        with Batch():
+            node.kids.append(kid)
+            node.kids.remove(kid)
+        self.assertEqual(log, [])
+
+    def testDictAddThenRemoveCancels(self):
+        po = PurchaseOrder()
+        seen = []
+        po.tags.mAddAdapter(NotificationAdapter(seen.append))
+        with Batch():
+            po.tags["a"] = 1
+            po.tags["a"] = 2
+            del po.tags["a"]
+        self.assertEqual(seen, [])
+        with Batch():
+            po.tags["b"] = 1
+            po.tags["b"] = 2
+        self.assertEqual([(n.eventType, n.newValue) for n in seen], [(ADD, 2)])
+
+    def testDictManyKeys(self):
+        po = PurchaseOrder()
+        seen = []
+        po.tags.mAddAdapter(NotificationAdapter(seen.append))
+        with Batch():
+            po.tags["a"] = 1
+            po.tags.update({"a": 2, "b": 3})
+            po.tags["a"] = 4
+            po.tags.clear()
+        self.assertEqual([n.eventType for n in seen], [ADD, SET_MANY, SET, REMOVE_MANY])
+        self.assertEqual(seen[0].newValue, 1)
+        self.assertEqual(dict(po.tags), {})
+
+    def testNotifyMany(self):
+        calls = []
+        class Many(NotificationAdapter):
+            def notifyMany(self, notifications):
+                calls.append(list(notifications))
+        node = Node()
+        node.mAddAdapter(Many())
+        with Batch():
+            node.x = 7
+            node.x = 8
+            node.y = 1
+        self.assertEqual(len(calls), 1)
+        self.assertEqual([n.newValue for n in calls[0]], [8, 1])
+
+
+
+
+class UniqueListTest(unittest.TestCase):
+    def testAgainstPlainList(self):
+        random.seed(1)
+        po = PurchaseOrder()
+        items = po.items
+        shadow = []
+        pool = [Item() for i in range(30)]
+        for step in range(2000):
+            op = random.randrange(8)
+            value = random.choice(pool)
+            if op == 0:
+                items.append(value)
+                if value not in shadow:
+                    shadow.append(value)
+            elif op == 1 and value in shadow:
+                items.remove(value)
+                shadow.remove(value)
+            elif op == 2:
+                position = random.randrange(-5, len(shadow) + 5)
+                items.insert(position, value)
+                if value not in shadow:
+                    shadow.insert(position, value)
+            elif op == 3 and shadow:
+                position = random.randrange(-len(shadow), len(shadow))
+                self.assertTrue(items.pop(position) is shadow.pop(position))
+            elif op == 4 and shadow:
+                i = random.randrange(len(shadow))
+                j = random.randrange(i, len(shadow) + 1)
+                del items[i:j]
+                del shadow[i:j]
+            elif op == 5:
+                values = random.sample(pool, 3)
+                items.extend(values)
+                shadow.extend(v for v in values if v not in shadow)
+            elif op == 6:
+                items.reverse()
+                shadow.reverse()
+            elif op == 7:
+                items.sort(key=id)
+                shadow.sort(key=id)
+            self.assertEqual(list(items), shadow)
+        for position, value in enumerate(shadow):
+            self.assertEqual(items.index(value), position)
+            self.assertTrue(value.mContainer() is po)
+
+    def testValuesAreComparedByEquality(self):
+        class Labelled(MObject):
+            labels = ListFeature(unique=True)
+        labels = Labelled().labels
+        label = "".join(["a", "b"])
+        labels.append("ab")
+        self.assertTrue(label in labels and label is not labels[0])
+        labels.append(label)
+        labels.extend([label, 1, 1.0])
+        self.assertEqual(list(labels), ["ab", 1])
+        self.assertEqual((labels.index(label), labels.count(1.0)), (0, 1))
+        self.assertRaises(ValueError, labels.__setitem__, 1, label)
+        first, second = [1], [1]
+        labels.extend([first, second, first])
+        self.assertEqual(len(labels), 4)
+        self.assertFalse([1] in labels)
+        labels.remove(label)
+        labels.remove(second)
+        self.assertTrue(labels[1] is first)
+
+    def testDuplicateSetIsRejected(self):
+        po = PurchaseOrder()
+        a, b = Item(), Item()
+        po.items.extend([a, b])
+        self.assertRaises(ValueError, po.items.__setitem__, 0, b)
+        self.assertEqual(list(po.items), [a, b])
+
+
+
+
+class ValidateTest(unittest.TestCase):
+    def testRejectedChangesAreNotMade(self):
+        class Veto(NotificationAdapter):
+            def validate(self, notification):
+                raise ValueError(notification)
+        po = PurchaseOrder()
+        item = Item()
+        po.items.append(item)
+        log = []
+        po.mAddContentAdapter(NotificationAdapter(log.append))
+        po.mAddContentAdapter(Veto())
+        self.assertRaises(ValueError, setattr, item, "price", 5)
+        self.assertRaises(ValueError, po.items.append, Item())
+        self.assertRaises(ValueError, po.items.pop)
+        self.assertRaises(ValueError, po.tags.__setitem__, "a", 1)
+        self.assertEqual((item.price, list(po.items), dict(po.tags)), (0, [item], {}))
+        self.assertEqual(po.items.index(item), 0)
+        self.assertEqual(log, [])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,101 @@
+import unittest
+
+from pmf.core import *
+from pmf.adapters import ChangeRecorder, NotificationAdapter
+from pmf.derived import Derived
+from pmf.query import Query
+
+calls = []
+
+class Line(MObject):
+    price = Feature(default=0)
+    qty = Feature(default=1)
+    note = Feature()
+
+class Order(MObject):
+    lines = ListFeature(containment=True)
+    discount = Feature(default=0)
+
+    def _total(order):
+        calls.append(order)
+        return sum(line.price * line.qty for line in order.lines) - order.discount
+    total = Derived(_total)
+    big = Derived(lambda order: order.total > 100)
+
+class Book(MObject):
+    orders = ListFeature(containment=True)
+
+class Double(MObject):
+    double = Derived(lambda d: d.x * 2)
+
+class DerivedTest(unittest.TestCase):
+    def setUp(self):
+        del calls[:]
+        self.order = Order()
+        self.a = Line()
+        self.a.price = 10
+        self.b = Line()
+        self.b.price = 20
+        self.b.qty = 2
+        self.order.lines.extend([self.a, self.b])
+
+    def testCaching(self):
+        order = self.order
+        self.assertEqual(order.total, 50)
+        self.assertEqual(order.total, 50)
+        self.a.note = "unrelated"
+        self.assertEqual((order.total, len(calls)), (50, 1))
+        self.a.price = 15
+        self.assertEqual((order.total, len(calls)), (55, 2))
+        order.lines.remove(self.b)
+        self.assertEqual(order.total, 15)
+        self.b.price = 1000
+        self.assertEqual((order.total, len(calls)), (15, 3))
+        self.assertEqual(self.b._mAdapters, ())
+
+    def testDerivedOfDerived(self):
+        self.assertFalse(self.order.big)
+        self.b.price = 100
+        self.assertTrue(self.order.big)
+
+    def testReadOnly(self):
+        self.assertRaises(AttributeError, setattr, self.order, "total", 3)
+
+    def testDynamicClasses(self):
+        d = Double()
+        d.x = 2
+        self.assertEqual(d.double, 4)
+        d.x = 5
+        self.assertEqual(d.double, 10)
+
+    def testInsideBatch(self):
+        seen = []
+        self.a.mAddAdapter(NotificationAdapter(seen.append))
+        self.assertEqual(self.order.total, 50)
+        with Batch():
+            self.a.price = 5
+            self.assertEqual(self.order.total, 45)
+            line = Line()
+            self.order.lines.append(line)
+            line.price = 2
+            self.assertEqual(self.order.total, 47)
+            self.assertEqual(seen, [])
+        self.assertEqual(len(seen), 1)
+
+    def testQueryAndUndo(self):
+        book = Book()
+        query = Query(Order, lambda order: order.big)
+        book.mAddContentAdapter(query)
+        book.orders.append(self.order)
+        self.assertEqual(list(query.matches), [])
+        self.b.price = 500
+        self.assertEqual(list(query.matches), [self.order])
+        recorder = ChangeRecorder()
+        book.mAddContentAdapter(recorder)
+        self.b.price = 1
+        self.assertEqual((self.order.total, list(query.matches)), (12, []))
+        recorder.undo()
+        self.assertEqual((self.order.total, list(query.matches)), (1010, [self.order]))
+
+if __name__ == "__main__":
+    unittest.main()
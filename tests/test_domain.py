@@ -0,0 +1,106 @@
+import threading
+import unittest
+
+from pmf.core import *
+from pmf.adapters import NotificationAdapter
+from pmf.domain import EditingDomain, ReadWriteLock
+from tests.models import *
+
+class EditingDomainTest(unittest.TestCase):
+    def setUp(self):
+        self.po = PurchaseOrder()
+        self.item = Item()
+        self.item.price = 1
+        self.po.items.append(self.item)
+        self.domain = EditingDomain(self.po, maxChanges=None)
+
+    def testTransactions(self):
+        po = self.po
+        with self.domain.transaction("a"):
+            po.comment = "a"
+            po.items.append(Item())
+        try:
+            with self.domain.transaction("b"):
+                po.comment = "b"
+                self.item.upc = "x"
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertEqual((po.comment, len(po.items), self.item.upc), ("a", 2, None))
+        self.domain.undo()
+        self.assertEqual((po.comment, len(po.items)), (None, 1))
+        self.domain.redo()
+        self.assertEqual((po.comment, len(po.items)), ("a", 2))
+
+    def testNestedTransactions(self):
+        with self.domain.transaction():
+            self.po.comment = 5
+            try:
+                with self.domain.transaction():
+                    self.po.comment = 6
+                    raise KeyError
+            except KeyError:
+                pass
+            self.assertEqual(self.po.comment, 5)
+
+    def testChangesOutsideTransactionsAreRejected(self):
+        seen = []
+        self.po.mAddContentAdapter(NotificationAdapter(seen.append))
+        for change in [lambda: setattr(self.item, "price", 5),
+                       lambda: self.po.items.append(Item()),
+                       lambda: self.po.tags.__setitem__("a", 1),
+                       lambda: self.po.items.pop()]:
+            self.assertRaises(RuntimeError, change)
+        with Batch():
+            self.assertRaises(RuntimeError, setattr, self.item, "price", 7)
+        self.assertEqual((self.item.price, len(self.po.items), dict(self.po.tags)), (1, 1, {}))
+        self.assertEqual(seen, [])
+
+    def testNoTransactionWithinABatch(self):
+        with Batch():
+            self.assertRaises(RuntimeError, self.domain.transaction().__enter__)
+        with self.domain.transaction():
+            with Batch():
+                self.po.comment = "a"
+        self.domain.undo()
+        self.assertEqual(self.po.comment, None)
+
+    def testReadersSeeWholeTransactions(self):
+        po = self.po
+        with self.domain.transaction():
+            self.item.upc = po.comment
+        results = []
+        def reader():
+            for i in range(200):
+                with self.domain.read():
+                    results.append(po.comment == self.item.upc)
+        def writer():
+            for i in range(200):
+                with self.domain.transaction():
+                    po.comment = i
+                    self.item.upc = i
+        threads = [threading.Thread(target=reader) for i in range(4)]
+        threads.append(threading.Thread(target=writer))
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertTrue(all(results))
+
+    def testNoUndoByDefault(self):
+        domain = EditingDomain(PurchaseOrder())
+        with domain.transaction():
+            domain.root.comment = 3
+        self.assertFalse(domain.recorder.canUndo())
+
+
+
+
+class ReadWriteLockTest(unittest.TestCase):
+    def testReaderCanNotUpgrade(self):
+        lock = ReadWriteLock()
+        with lock.read():
+            self.assertRaises(RuntimeError, lock.acquireWrite)
+
+if __name__ == "__main__":
+    unittest.main()
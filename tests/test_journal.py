@@ -0,0 +1,109 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from pmf.core import *
+from pmf.journal import Journal, replay
+from pmf.resources import Resource
+from tests.models import *
+
+class JournalTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.base = os.path.join(self.directory, "shop.json")
+        self.path = os.path.join(self.directory, "shop.journal")
+        self.shop = build()
+        self.resource = Resource(self.base, self.shop)
+        self.resource.save()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def journal(self, resource=None, root=None, **kw):
+        journal = Journal(resource or self.resource, self.path, **kw)
+        (root or self.shop).mAddContentAdapter(journal)
+        return journal
+
+    def testReplay(self):
+        shop = self.shop
+        journal = self.journal(syncEvery=5)
+        shop.orders[0].comment = "changed"
+        new = Item()
+        new.upc = "new"
+        shop.orders[0].items.append(new)
+        moved = shop.orders[2].items.pop(1)
+        moved.price = 555
+        shop.orders[1].items.insert(0, moved)
+        del shop.orders[0].items[0]
+        shop.orders[1].items[0].related = new
+        referred = Address()
+        shop.orders[1].items[1].related = referred
+        shop.orders[1].shipTo = referred
+        shop.main.kids.append(Dyn())
+        shop.main.kids[1].peer = shop.main.kids[0]
+        shop.orders[2].items[1:3] = [Item(), Item()]
+        shop.orders[2].items.reverse()
+        shop.orders[0].tags = {"a": 1, (1, 2): [3]}
+        shop.orders[0].tags.update({"b": 2})
+        del shop.orders[0].tags["a"]
+        customer = Customer()
+        shop.customers.append(customer)
+        shop.orders[2].customer = customer
+        shop.orders.sort(key=lambda o: o.comment)
+        journal.close()
+        replayed = replay(Resource(self.base), self.path)
+        self.assertEqual(snapshot(replayed), snapshot(shop))
+        self.assertEqual(len(replayed.customers[1].orders), 1)
+
+    def testTornTail(self):
+        journal = self.journal()
+        self.shop.orders[0].comment = "x"
+        journal.close()
+        with open(self.path, "ab") as stream:
+            stream.write('[1, "comm')
+        resource = Resource(self.base)
+        replayed = replay(resource, self.path)
+        self.assertEqual(snapshot(replayed), snapshot(self.shop))
+        self.assertTrue(open(self.path).read().endswith("\n"))
+        journal = self.journal(resource, replayed, syncEvery=1)
+        item = Item()
+        item.upc = "after"
+        replayed.orders[0].items.append(item)
+        journal.close()
+        self.assertEqual(replay(Resource(self.base), self.path).orders[0].items[-1].upc, "after")
+
+    def testCheckpoint(self):
+        journal = self.journal()
+        self.shop.orders[0].comment = "before"
+        journal.checkpoint()
+        self.assertEqual(len(open(self.path).readlines()), 1)
+        self.shop.orders[0].comment = "after"
+        journal.close()
+        replayed = replay(Resource(self.base), self.path)
+        self.assertEqual(snapshot(replayed), snapshot(self.shop))
+
+    def testObjectDetachedOverACheckpoint(self):
+        journal = self.journal()
+        items = self.shop.orders[0].items
+        removed = items.pop(0)
+        journal.checkpoint()
+        items.append(removed)
+        journal.close()
+        replayed = replay(Resource(self.base), self.path).orders[0].items
+        self.assertEqual([item.upc for item in replayed], [item.upc for item in items])
+        self.assertEqual(len(set(map(id, replayed))), len(replayed))
+
+    def testOlderJournalIsIgnored(self):
+        journal = self.journal()
+        self.shop.orders[0].comment = "journaled"
+        journal.close()
+        self.shop.mRemoveContentAdapter(journal)
+        old = open(self.path, "rb").read()
+        self.shop.orders[0].comment = "saved"
+        self.resource.save()
+        open(self.path, "wb").write(old)
+        self.assertEqual(replay(Resource(self.base), self.path).orders[0].comment, "saved")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,50 @@
+import unittest
+
+from pmf.core import *
+from pmf.adapters import NotificationAdapter
+from pmf.query import Query
+from tests.models import *
+
+class QueryTest(unittest.TestCase):
+    def setUp(self):
+        self.shop = build()
+        self.query = Query(Item, lambda item: item.price >= 2 and
+                                              item.mContainer().shipTo.street == "S0")
+        self.log = []
+        self.query.matches.mAddAdapter(NotificationAdapter(self.log.append))
+        self.shop.mAddContentAdapter(self.query)
+
+    def testMatches(self):
+        po = self.shop.orders[0]
+        self.assertEqual(list(self.query.matches), po.items[2:])
+        po.items[0].price = 5
+        self.assertTrue(po.items[0] in self.query.matches)
+        self.assertEqual(self.log[-1].eventType, ADD)
+
+    def testFollowsWhatTheConditionRead(self):
+        po = self.shop.orders[0]
+        po.shipTo.street = "elsewhere"
+        self.assertEqual(list(self.query.matches), [])
+        po.shipTo.street = "S0"
+        self.assertEqual(len(self.query.matches), 2)
+        address = po.shipTo
+        po.shipTo = Address()
+        self.assertEqual(len(self.query.matches), 0)
+        address.street = "S1"
+        po.shipTo.street = "S0"
+        self.assertEqual(len(self.query.matches), 2)
+
+    def testContentChanges(self):
+        po = self.shop.orders[0]
+        item = po.items.pop()
+        self.assertFalse(item in self.query.matches)
+        po.items.append(item)
+        self.assertTrue(item in self.query.matches)
+
+    def testRemoval(self):
+        self.shop.mRemoveContentAdapter(self.query)
+        self.assertEqual(len(self.query._dependents), 0)
+        self.assertEqual(self.shop.orders[0].shipTo._mAdapters, ())
+
+if __name__ == "__main__":
+    unittest.main()
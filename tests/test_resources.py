@@ -0,0 +1,156 @@
+import StringIO
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from pmf.core import *
+from pmf.adapters import NotificationAdapter
+from pmf.resources import Resource, dump, load
+from tests.models import *
+
+class ResourceTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "shop.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def testRoundTrip(self):
+        shop = build()
+        po = shop.orders[0]
+        po.notes["a"] = Item()
+        po.notes[(1, "x")] = Item()
+        po.tags = {"k": [1, 2, {"z": None}], 3: 4.5}
+        po.refs = [shop.orders[1], shop.orders[1].items[2], shop.customers[0]]
+        shop.main.kids.append(Dyn())
+        shop.main.kids[1].x = shop.main.kids[0]
+        Resource(self.path).save(shop)
+        json.loads(open(self.path).read())
+        loaded = Resource(self.path).load()
+        self.assertEqual(snapshot(loaded), snapshot(shop))
+        po = loaded.orders[0]
+        self.assertTrue(po.customer is loaded.customers[0])
+        self.assertEqual(list(loaded.customers[0].orders), list(loaded.orders))
+        self.assertTrue(po.items[0].related is po.items[3])
+        self.assertTrue(po.notes[(1, "x")].mContainer() is po)
+        self.assertTrue(loaded.main.kids[1].x is loaded.main.kids[0])
+        self.assertEqual(po.items.index(po.items[2]), 2)
+        seen = []
+        po.mAddAdapter(NotificationAdapter(seen.append))
+        po.comment = "changed"
+        self.assertEqual(len(seen), 1)
+
+    def testReferencesOutsideTheTree(self):
+        po = PurchaseOrder()
+        po.refs = [Item()]
+        self.assertRaises(ValueError, dump, po, StringIO.StringIO())
+
+    def testReferenceToContentOfAnotherFeature(self):
+        order = Order()
+        address = Address()
+        order.addresses.append(address)
+        order.shipTo = address
+        order.billTo = Address()
+        order.other = order.billTo
+        stream = StringIO.StringIO()
+        dump(order, stream)
+        loaded = load(StringIO.StringIO(stream.getvalue()))
+        self.assertTrue(loaded.shipTo is loaded.addresses[0])
+        self.assertTrue(loaded.other is loaded.billTo)
+        resource = Resource(self.path)
+        resource.save(order)
+        other = Address()
+        order.addresses.append(other)
+        order.shipTo = other
+        resource.save(incremental=True)
+        loaded = Resource(self.path).load()
+        self.assertTrue(loaded.shipTo is loaded.addresses[1])
+
+
+
+
+class DeltaTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "shop.json")
+        self.shop = build()
+        self.resource = Resource(self.path, maxDeltas=3)
+        self.resource.save(self.shop)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def testOnlyChangesAreAppended(self):
+        shop = self.shop
+        self.assertFalse(shop.mIsDirty())
+        size = os.path.getsize(self.path)
+        shop.orders[1].items[2].price = 99
+        self.assertTrue(shop.orders[1].items[2].mIsDirty())
+        self.assertFalse(shop.orders[1].mIsDirty())
+        self.resource.save(incremental=True)
+        self.assertFalse(shop.orders[1].items[2].mIsDirty())
+        self.assertTrue(os.path.getsize(self.path) - size < 200)
+        self.assertEqual(Resource(self.path).load().orders[1].items[2].price, 99)
+
+    def testStructuralChanges(self):
+        shop = self.shop
+        new = Item()
+        new.upc = "new"
+        shop.orders[0].items.append(new)
+        moved = shop.orders[2].items.pop(1)
+        shop.orders[1].items.insert(0, moved)
+        del shop.orders[0].items[0]
+        shop.orders[1].items[0].related = new
+        shop.main.kids.append(Dyn())
+        shop.main.kids[1].peer = shop.main.kids[0]
+        shop.orders[2].shipTo = Address()
+        self.resource.save(incremental=True)
+        resource = Resource(self.path, maxDeltas=3)
+        loaded = resource.load()
+        self.assertEqual(snapshot(loaded), snapshot(shop))
+        self.assertTrue(loaded.orders[1].items[0].related is loaded.orders[0].items[-1])
+        loaded.orders[0].items[0].price = 1234
+        resource.save(incremental=True)
+        self.assertEqual(snapshot(Resource(self.path).load()), snapshot(loaded))
+
+    def testCompaction(self):
+        for n in range(4):
+            self.shop.orders[0].comment = n
+            self.resource.save(incremental=True)
+        self.assertFalse('"delta"' in open(self.path).read())
+        self.shop.orders[0].comment = "after"
+        self.resource.save(incremental=True)
+        self.assertEqual(Resource(self.path).load().orders[0].comment, "after")
+
+    def testFailedDeltaLeavesFile(self):
+        shop = self.shop
+        size = os.path.getsize(self.path)
+        item = shop.orders[0].items[0]
+        item.price = 2
+        new = Item()
+        shop.orders[0].items.append(new)
+        item.related = Item()
+        self.assertRaises(ValueError, self.resource.save, incremental=True)
+        self.assertEqual(os.path.getsize(self.path), size)
+        self.assertTrue(item.mIsDirty() and new._mOid is None)
+        item.related = None
+        self.resource.save(incremental=True)
+        self.assertFalse(item.mIsDirty())
+        loaded = Resource(self.path).load()
+        self.assertEqual((loaded.orders[0].items[0].price, len(loaded.orders[0].items)), (2, 5))
+
+    def testObjectDetachedOverAFullSave(self):
+        items = self.shop.orders[0].items
+        removed = items.pop(0)
+        self.resource.save()
+        items.append(removed)
+        self.resource.save(incremental=True)
+        loaded = Resource(self.path).load().orders[0].items
+        self.assertEqual([item.upc for item in loaded], [item.upc for item in items])
+        self.assertEqual(len(set(map(id, loaded))), len(loaded))
+
+if __name__ == "__main__":
+    unittest.main()
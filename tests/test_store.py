@@ -0,0 +1,141 @@
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import unittest
+
+from pmf.core import *
+from pmf.store import SQLiteStore
+from tests.models import *
+
+class SQLiteStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "shop.db")
+        self.shop = build()
+        store = SQLiteStore(self.path)
+        store.save(self.shop)
+        store.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def testLoadReadsOnFirstUse(self):
+        store = SQLiteStore(self.path)
+        root = store.load()
+        self.assertTrue(root._mLoader is not None)
+        orders = root.orders
+        self.assertTrue(all(o._mLoader is not None for o in orders))
+        self.assertEqual(orders[1].comment, "po1")
+        self.assertTrue(orders[0]._mLoader is not None)
+        self.assertEqual(snapshot(root), snapshot(self.shop))
+        store.close()
+
+    def testChangesAreWrittenBehind(self):
+        store = SQLiteStore(self.path)
+        root = store.load()
+        new = Item()
+        new.upc = "new"
+        root.orders[0].items.append(new)
+        moved = root.orders[2].items.pop(1)
+        moved.price = 555
+        root.orders[1].items.insert(0, moved)
+        root.orders[0].items[0].related = None
+        del root.orders[0].items[0]
+        root.orders[1].items[0].related = new
+        root.orders[2].shipTo = Address()
+        customer = Customer()
+        root.customers.append(customer)
+        root.orders[2].customer = customer
+        root.orders.reverse()
+        store.flush()
+        other = SQLiteStore(self.path)
+        self.assertEqual(snapshot(other.load()), snapshot(root))
+        other.close()
+        count = sqlite3.connect(self.path).execute("SELECT count(*) FROM objects").fetchone()[0]
+        self.assertEqual(count, 1 + len(list(root.mAllContents())))
+        store.close()
+
+    def testLargeModelIsReadLazily(self):
+        big = Shop()
+        big.orders = []
+        for n in range(500):
+            po = PurchaseOrder()
+            for k in range(5):
+                item = Item()
+                item.price = k
+                po.items.append(item)
+            big.orders.append(po)
+        store = SQLiteStore(self.path)
+        store.save(big)
+        store.close()
+        store = SQLiteStore(self.path)
+        root = store.load()
+        self.assertEqual(root.orders[300].items[3].price, 3)
+        loaded = [o for o in store._objects.values() if o._mLoader is None]
+        self.assertEqual(len(loaded), 3)
+        root.orders[300].items[3].price = 42
+        store.close()
+        self.assertEqual(SQLiteStore(self.path).load().orders[300].items[3].price, 42)
+
+    def testCloseStopsKeepingTheTree(self):
+        store = SQLiteStore(self.path)
+        root = store.load()
+        store.close()
+        root.orders[0].comment = "after close"
+        store.flush()
+        self.assertNotEqual(SQLiteStore(self.path).load().orders[0].comment, "after close")
+
+    def testThreads(self):
+        shop = self.shop
+        for n in range(30):
+            po = PurchaseOrder()
+            for k in range(10):
+                item = Item()
+                item.upc = "u%d" % k
+                item.price = k
+                po.items.append(item)
+            shop.orders.append(po)
+        store = SQLiteStore(self.path, batchSize=7)
+        store.save(shop)
+        store.close()
+        expected = snapshot(shop)
+        interval = sys.getcheckinterval()
+        sys.setcheckinterval(1)
+        try:
+            store = SQLiteStore(self.path, batchSize=7)
+            root = store.load()
+            results = []
+            errors = []
+            def run(work, n):
+                try:
+                    start.wait()
+                    work(n)
+                except Exception as e:
+                    errors.append(e)
+            def read(n):
+                results.append(snapshot(root))
+            def write(n):
+                for po in root.orders[n::8]:
+                    for item in po.items:
+                        item.price += 1
+            for work in (read, write):
+                start = threading.Event()
+                threads = [threading.Thread(target=run, args=(work, n)) for n in range(8)]
+                for thread in threads:
+                    thread.start()
+                start.set()
+                for thread in threads:
+                    thread.join()
+                self.assertEqual(errors, [])
+        finally:
+            sys.setcheckinterval(interval)
+        self.assertTrue(all(result == expected for result in results))
+        store.close()
+        prices = [i.price for i in SQLiteStore(self.path).load().orders[-1].items]
+        self.assertEqual(prices, range(1, 11))
+
+if __name__ == "__main__":
+    unittest.main()